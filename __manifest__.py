@@ -33,6 +33,11 @@
         'security/user_groups.xml',
         'security/ir.model.access.csv',
         'views/backupprocess_view.xml',
+        'views/backup_artifact_view.xml',
+        'views/backup_run_view.xml',
+        'views/backup_job_view.xml',
+        'views/bandwidth_limit_view.xml',
+        'views/backup_restore_view.xml',
         'views/menu.xml',
         'data/backupprocess_data.xml',
     ],
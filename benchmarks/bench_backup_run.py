@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Run complete backups of synthetic databases and record how long every stage takes.
+
+The SFTP server and the ``/xmlrpc/db`` endpoint of the backed up server
+are stand-ins running in this process (see ``standins.py``), so only
+Odoo and PostgreSQL are needed. The script:
+
+1. copies ``--template`` into ``--databases`` new databases, each with
+   ``--size-mb`` of incompressible data and a filestore of
+   ``--filestore-files`` files of ``--filestore-kb``;
+2. creates one backup configuration per database in ``--database``, which
+   must have the module installed and no other backup configuration;
+3. calls ``schedule_backup_process`` and runs the backup job worker until
+   the run is over;
+4. writes the per-stage latency, throughput and memory peak as JSON, and
+   compares them with ``--compare`` when given;
+5. drops everything it created, unless ``--keep`` is given.
+
+Run it with the Python interpreter of Odoo:
+
+    python benchmarks/bench_backup_run.py -c /etc/odoo/odoo.conf -d bench --template odoo_template \\
+        --databases 4 --size-mb 200 --backup-type zip --compression zstd --output results/zstd.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import odoo  # noqa: E402
+from odoo import api, SUPERUSER_ID  # noqa: E402
+
+from standins import DbListStandIn, MemorySampler, SftpStandIn  # noqa: E402
+
+BLOCK_SIZE = 1024 * 1024
+STAGES = ('dump', 'stream', 'handshake', 'upload', 'retention', 'mail')
+
+
+def create_databases(args):
+    """Copy the template into the synthetic databases and fill them."""
+    names = ['%s_%02d' % (args.prefix, index) for index in range(args.databases)]
+    for name in names:
+        odoo.service.db.exp_duplicate_database(args.template, name)
+        with odoo.sql_db.db_connect(name).cursor() as cr:
+            cr.execute("CREATE TABLE bench_payload (id serial PRIMARY KEY, data bytea)")
+            for index in range(args.size_mb):
+                cr.execute("INSERT INTO bench_payload (data) VALUES (%s)", (os.urandom(BLOCK_SIZE),))
+        filestore = os.path.join(odoo.tools.config.filestore(name), 'bench')
+        for index in range(args.filestore_files):
+            path = os.path.join(filestore, '%02x' % (index % 256))
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, '%06d' % index), 'wb') as fp:
+                fp.write(os.urandom(args.filestore_kb * 1024))
+    return names
+
+
+def drop_databases(names):
+    for name in names:
+        try:
+            odoo.service.db.exp_drop(name)
+        except Exception as e:
+            print('Could not drop %s: %s' % (name, e), file=sys.stderr)
+
+
+def run_backups(env, args, names, sftp, db_list, folder):
+    """Configure one backup per synthetic database and run them like the crons would.
+
+    :return: the run record and its wall-clock duration
+    """
+    backup_model = env['dailybackup.backupprocess']
+    if backup_model.search_count([]):
+        raise SystemExit('%s already has backup configurations, use a dedicated database.' % env.cr.dbname)
+    params = env['ir.config_parameter'].sudo()
+    params.set_param('dailybackup.max_workers', args.workers)
+    params.set_param('dailybackup.max_workers_per_host', args.workers_per_host)
+    for name in names:
+        backup_model.create({
+            'name': name,
+            'host': '127.0.0.1',
+            'port': str(db_list.port),
+            'folder': folder,
+            'backup_type': args.backup_type,
+            'compression': args.compression,
+            'checksum_algorithm': args.checksum,
+            'sftp_write': not args.no_sftp,
+            'sftp_host': '127.0.0.1',
+            'sftp_port': sftp.port,
+            'sftp_user': sftp.user,
+            'sftp_password': sftp.password,
+            'sftp_path': '/backups',
+            'stream_upload': args.stream,
+            'multipart_upload': args.multipart,
+            'multipart_threshold_mb': 1,
+        })
+    env.cr.commit()
+
+    start = time.time()
+    run = backup_model.schedule_backup_process()
+    env.cr.commit()
+    deadline = start + args.timeout
+    while env['dailybackup.backup.job'].search_count([('run_id', '=', run.id), ('state', '=', 'pending')]):
+        if time.time() > deadline:
+            raise SystemExit('The run did not finish within %ss.' % args.timeout)
+        env['dailybackup.backup.job'].run_backup_jobs(max_seconds=args.tick)
+        env.cr.commit()
+    wall_clock = time.time() - start
+    env.invalidate_all()
+    return run, wall_clock
+
+
+def collect(run, wall_clock, args, sftp, db_list, memory):
+    lines = run.line_ids
+    stages = {}
+    for stage in STAGES:
+        values = [line['%s_duration' % stage] for line in lines]
+        stages[stage] = {
+            'total_s': round(sum(values), 3),
+            'max_s': round(max(values or [0.0]), 3),
+            'mean_s': round(sum(values) / len(values), 3) if values else 0.0,
+        }
+    bytes_written = sum(lines.mapped('bytes_written'))
+    bytes_uploaded = sum(lines.mapped('bytes_uploaded'))
+    return {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'parameters': vars(args),
+        'run': {
+            'state': run.state,
+            'wall_clock_s': round(wall_clock, 3),
+            'sequential_s': round(run.sequential_duration, 3),
+            'records': len(lines),
+            'failed': len(lines.filtered(lambda line: line.state == 'failed')),
+            'bytes_written': bytes_written,
+            'bytes_uploaded': bytes_uploaded,
+            'throughput_mb_s': round(bytes_written / 1024.0 / 1024.0 / wall_clock, 2) if wall_clock else 0.0,
+            'handshakes': run.handshake_count,
+            'sessions_reused': run.session_reuse_count,
+        },
+        'stages': stages,
+        'records': [{
+            'database': line.database,
+            'state': line.state,
+            'duration_s': round(line.duration, 3),
+            'bytes_written': line.bytes_written,
+            'throughput_mb_s': round(line.throughput, 2),
+            'retries': line.retry_count,
+            'error': line.error or None,
+        } for line in lines],
+        'memory': memory.as_dict(),
+        'sftp': dict(sftp.stats.values),
+        'db_list_calls': db_list.calls,
+    }
+
+
+def compare(results, previous):
+    """Print the relative change of the main figures against an earlier result file."""
+    rows = [('wall clock (s)', ('run', 'wall_clock_s')), ('throughput (MB/s)', ('run', 'throughput_mb_s')),
+            ('memory peak (MB)', ('memory', 'peak_mb'))]
+    rows += [('%s total (s)' % stage, ('stages', stage, 'total_s')) for stage in STAGES]
+    for label, keys in rows:
+        old, new = previous, results
+        for key in keys:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if old is None or new is None:
+            continue
+        change = '%+.1f%%' % ((new - old) * 100.0 / old) if old else 'n/a'
+        print('%-22s %12s -> %12s  %s' % (label, old, new, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', required=True, help='Odoo configuration file')
+    parser.add_argument('-d', '--database', required=True, help='database with the module installed')
+    parser.add_argument('--template', required=True, help='Odoo database copied into the synthetic databases')
+    parser.add_argument('--prefix', default='dailybackup_bench')
+    parser.add_argument('--databases', type=int, default=2)
+    parser.add_argument('--size-mb', type=int, default=50, help='incompressible data added to every database')
+    parser.add_argument('--filestore-files', type=int, default=100)
+    parser.add_argument('--filestore-kb', type=int, default=64)
+    parser.add_argument('--backup-type', default='zip', choices=('zip', 'dump', 'incremental', 'physical'))
+    parser.add_argument('--compression', default='none', choices=('none', 'zstd', 'lz4'))
+    parser.add_argument('--checksum', default='sha256', choices=('sha256', 'blake3'))
+    parser.add_argument('--stream', action='store_true', help='stream the dumps to the SFTP server')
+    parser.add_argument('--multipart', action='store_true', help='upload over several SFTP channels')
+    parser.add_argument('--no-sftp', action='store_true', help='only write local backups')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--workers-per-host', type=int, default=4)
+    parser.add_argument('--sftp-latency', type=float, default=0.0, help='simulated seconds per SFTP request')
+    parser.add_argument('--tick', type=int, default=60, help='seconds per call of the job worker')
+    parser.add_argument('--timeout', type=int, default=3600)
+    parser.add_argument('--output', help='JSON file, benchmarks/results/<date>.json by default')
+    parser.add_argument('--compare', help='earlier JSON result to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the databases, configurations and files')
+    args = parser.parse_args()
+
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database])
+    work_dir = tempfile.mkdtemp(prefix='dailybackup-bench-')
+    folder = os.path.join(work_dir, 'local')
+    sftp_root = os.path.join(work_dir, 'sftp')
+    os.makedirs(sftp_root)
+    names = create_databases(args)
+    try:
+        with SftpStandIn(sftp_root, latency=args.sftp_latency) as sftp, DbListStandIn(names) as db_list:
+            with api.Environment.manage(), odoo.registry(args.database).cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                try:
+                    with MemorySampler() as memory:
+                        run, wall_clock = run_backups(env, args, names, sftp, db_list, folder)
+                    results = collect(run, wall_clock, args, sftp, db_list, memory)
+                finally:
+                    if not args.keep:
+                        configurations = env['dailybackup.backupprocess'].search([('name', 'in', names)])
+                        env['dailybackup.backup.run'].search(
+                            [('line_ids.backup_id', 'in', configurations.ids)]).unlink()
+                        configurations.unlink()
+                        cr.commit()
+    finally:
+        if not args.keep:
+            drop_databases(names)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         '%s.json' % datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=4)
+    print(json.dumps(results['run'], indent=4))
+    print('Results written to %s' % output)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp))
+
+
+if __name__ == '__main__':
+    main()
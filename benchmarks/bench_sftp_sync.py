@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""Compare the SFTP sync and retention strategies against a local SFTP stand-in.
+
+The stand-in keeps the remote directory in memory, counts every call that
+would be a round trip to a real server and can add a fixed latency per
+call. Run it with a plain Python interpreter, Odoo is not needed:
+
+    python benchmarks/bench_sftp_sync.py --remote-files 10000 --latency 0.0005
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib import sftp_sync  # noqa: E402
+
+DB_NAME = 'bench'
+
+
+class LocalSftpStandIn(object):
+    """The subset of ``paramiko.SFTPClient`` used by the backup module."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.files = {}
+        self.round_trips = 0
+
+    def _call(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def stat(self, path):
+        self._call()
+        try:
+            return self.files[os.path.basename(path)]
+        except KeyError:
+            raise IOError('No such file')
+
+    def listdir(self, path='.'):
+        self._call()
+        return list(self.files)
+
+    def listdir_attr(self, path='.'):
+        self._call()
+        return list(self.files.values())
+
+    def put(self, localpath, remotepath):
+        self._call()
+        name = os.path.basename(remotepath)
+        self.files[name] = sftp_sync.RemoteFile(name, os.path.getsize(localpath), time.time())
+        return self.files[name]
+
+    def remove(self, path):
+        self._call()
+        del self.files[os.path.basename(path)]
+
+    unlink = remove
+
+
+def make_fixture(local_dir, remote_files, local_files, days):
+    sftp_files = {}
+    now = time.time()
+    for index in range(remote_files):
+        name = '%s_%s.zip' % (
+            (datetime.datetime.now() - datetime.timedelta(minutes=index)).strftime('%Y_%m_%d_%H_%M_%S'), DB_NAME)
+        # One remote file in ten is older than the retention period.
+        age = (days + 1) * 86400 if index % 10 == 0 else 3600
+        sftp_files[name] = sftp_sync.RemoteFile(name, 1024, now - age)
+    for index in range(local_files):
+        name = 'local_%05d_%s.zip' % (index, DB_NAME)
+        with open(os.path.join(local_dir, name), 'wb') as fp:
+            fp.write(b'x' * 1024)
+    return sftp_files
+
+
+def legacy_sync(sftp, local_dir, days):
+    """The algorithm the module used before: a stat per local file, a full rescan per local file."""
+    for f in os.listdir(local_dir):
+        if DB_NAME in f:
+            fullpath = os.path.join(local_dir, f)
+            try:
+                sftp.stat(f)
+            except IOError:
+                sftp.put(fullpath, f)
+        for file in sftp.listdir('.'):
+            if DB_NAME in file:
+                attr = sftp.stat(file)
+                delta = datetime.datetime.now() - datetime.datetime.fromtimestamp(attr.st_mtime)
+                if delta.days >= days and stat.S_ISREG(attr.st_mode):
+                    sftp.unlink(file)
+
+
+def snapshot_sync(sftp, local_dir, days):
+    """The algorithm used now: one listing of each side, then uploads and a batch of deletes."""
+    match = lambda name: DB_NAME in name
+    local = sftp_sync.local_snapshot(local_dir, match)
+    remote = sftp_sync.remote_snapshot(sftp, '.')
+    for name in sftp_sync.files_to_upload(local, remote):
+        remote[name] = sftp.put(os.path.join(local_dir, name), name)
+    expired = sftp_sync.expired_files(remote, match, days)
+    sftp_sync.remove_files(sftp, '.', expired, remote)
+
+
+def run(strategy, args):
+    local_dir = tempfile.mkdtemp(prefix='dailybackup-bench-')
+    try:
+        sftp = LocalSftpStandIn(latency=args.latency)
+        sftp.files = make_fixture(local_dir, args.remote_files, args.local_files, args.days)
+        start = time.time()
+        strategy(sftp, local_dir, args.days)
+        return {
+            'seconds': round(time.time() - start, 4),
+            'round_trips': sftp.round_trips,
+            'remote_files_left': len(sftp.files),
+        }
+    finally:
+        shutil.rmtree(local_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--remote-files', type=int, default=10000)
+    parser.add_argument('--local-files', type=int, default=5)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per round trip')
+    parser.add_argument('--skip-legacy', action='store_true', help='only run the snapshot strategy')
+    args = parser.parse_args()
+
+    results = {'parameters': vars(args), 'snapshot': run(snapshot_sync, args)}
+    if not args.skip_legacy:
+        results['legacy'] = run(legacy_sync, args)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""In-process stand-ins for the servers a backup run talks to.
+
+- ``SftpStandIn``: a paramiko SFTP server serving a local directory, which
+  also answers ``sha256sum``/``b3sum`` like a shell so uploads can be
+  verified, with an optional latency per request.
+- ``DbListStandIn``: an XML-RPC ``/xmlrpc/db`` endpoint listing a fixed set
+  of databases, in place of the Odoo server the backups are configured for.
+- ``MemorySampler``: the peak resident memory of this process during a block.
+
+They only need paramiko, so they can also be used without Odoo.
+"""
+
+import os
+import resource
+import shlex
+import socket
+import threading
+import time
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+
+from lib import integrity
+
+HASH_COMMANDS = {'sha256sum': 'sha256', 'b3sum': 'blake3'}
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {'connections': 0, 'requests': 0, 'bytes_received': 0, 'bytes_sent': 0, 'hash_commands': 0}
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.values[name] += value
+
+
+class _Handle(SFTPHandle):
+
+    def __init__(self, interface, flags=0):
+        super(_Handle, self).__init__(flags)
+        self._interface = interface
+
+    def read(self, offset, length):
+        self._interface._request()
+        data = super(_Handle, self).read(offset, length)
+        if isinstance(data, bytes):
+            self._interface.stats.add('bytes_sent', len(data))
+        return data
+
+    def write(self, offset, data):
+        self._interface._request()
+        self._interface.stats.add('bytes_received', len(data))
+        return super(_Handle, self).write(offset, data)
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _SftpInterface(SFTPServerInterface):
+    """Serves the root directory of the stand-in, as if it were ``/`` on the server."""
+
+    def __init__(self, ssh_server, *args, **kwargs):
+        super(_SftpInterface, self).__init__(ssh_server, *args, **kwargs)
+        self._server = ssh_server.standin
+        self.stats = self._server.stats
+
+    def _request(self):
+        self.stats.add('requests')
+        if self._server.latency:
+            time.sleep(self._server.latency)
+
+    def _realpath(self, path):
+        return self._server.root + self.canonicalize(path)
+
+    def list_folder(self, path):
+        self._request()
+        path = self._realpath(path)
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        self._request()
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        self._request()
+        path = self._realpath(path)
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), getattr(attr, 'st_mode', None) or 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(self, flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        self._request()
+        try:
+            os.remove(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self._request()
+        if os.path.exists(self._realpath(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        self._request()
+        try:
+            os.replace(self._realpath(oldpath), self._realpath(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        self._request()
+        try:
+            os.mkdir(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        self._request()
+        try:
+            os.rmdir(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        self._request()
+        try:
+            SFTPServer.set_file_attr(self._realpath(path), attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class _SshServer(paramiko.ServerInterface):
+
+    def __init__(self, standin):
+        self.standin = standin
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.standin.user, self.standin.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.standin._exec, args=(channel, command.decode('utf-8')), daemon=True).start()
+        return True
+
+
+class SftpStandIn(object):
+    """SFTP server on ``127.0.0.1`` serving ``root``, in threads of this process.
+
+    Use it as a context manager; ``port`` is known once it is started.
+
+    :param latency: seconds added to every SFTP request, to mimic a remote server
+    """
+
+    def __init__(self, root, user='bench', password='bench', latency=0.0):
+        self.root = os.path.abspath(root)
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.stats = _Stats()
+        self.port = None
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._socket = None
+        self._transports = []
+        self._stopped = threading.Event()
+
+    def __enter__(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(64)
+        self._socket.settimeout(0.2)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, name='sftp stand-in', daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        for transport in self._transports:
+            transport.close()
+        self._socket.close()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                conn, address = self._socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self.stats.add('connections')
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, _SftpInterface)
+            transport.start_server(server=_SshServer(self))
+            self._transports.append(transport)
+
+    def _exec(self, channel, command):
+        """Answer ``sha256sum -- <path>`` (and ``b3sum``) like a shell would, fail anything else."""
+        try:
+            args = shlex.split(command)
+            algorithm = HASH_COMMANDS.get(args[0]) if args else None
+            if not algorithm or not integrity.is_available(algorithm):
+                channel.sendall_stderr(('%s: command not found\n' % (args[0] if args else '')).encode('utf-8'))
+                channel.send_exit_status(127)
+                return
+            self.stats.add('hash_commands')
+            path = args[-1]
+            digest = integrity.new_hash(algorithm)
+            with open(self.root + os.path.normpath('/' + path), 'rb') as fp:
+                for block in iter(lambda: fp.read(integrity.BLOCK_SIZE), b''):
+                    digest.update(block)
+            channel.sendall(('%s  %s\n' % (digest.hexdigest(), path)).encode('utf-8'))
+            channel.send_exit_status(0)
+        except Exception as e:
+            channel.sendall_stderr(str(e).encode('utf-8'))
+            channel.send_exit_status(1)
+        finally:
+            channel.close()
+
+
+class _DbRequestHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/xmlrpc/db',)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DbListStandIn(object):
+    """``/xmlrpc/db`` endpoint on ``127.0.0.1`` answering ``list`` with ``databases``."""
+
+    def __init__(self, databases, latency=0.0):
+        self.databases = list(databases)
+        self.latency = latency
+        self.calls = 0
+        self.port = None
+        self._server = None
+
+    def list(self, document=False):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.databases
+
+    def __enter__(self):
+        self._server = SimpleXMLRPCServer(('127.0.0.1', 0), requestHandler=_DbRequestHandler, logRequests=False,
+                                          allow_none=True)
+        self._server.register_function(self.list, 'list')
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='db list stand-in', daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _rss_kb():
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MemorySampler(object):
+    """Sample the resident memory of this process while the block runs.
+
+    ``peak_kb`` is the highest sample, ``baseline_kb`` the memory when the
+    block started; ``children_peak_kb`` is the largest child process
+    (pg_dump, pg_basebackup, ...) that finished so far.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.baseline_kb = self.peak_kb = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, _rss_kb())
+
+    def __enter__(self):
+        self.baseline_kb = self.peak_kb = _rss_kb()
+        self._thread = threading.Thread(target=self._sample, name='memory sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        self.peak_kb = max(self.peak_kb, _rss_kb())
+
+    @property
+    def children_peak_kb(self):
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    def as_dict(self):
+        return {
+            'baseline_mb': round(self.baseline_kb / 1024.0, 1),
+            'peak_mb': round(self.peak_kb / 1024.0, 1),
+            'peak_increase_mb': round((self.peak_kb - self.baseline_kb) / 1024.0, 1),
+            'children_peak_mb': round(self.children_peak_kb / 1024.0, 1),
+        }
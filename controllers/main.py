@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import odoo
+from odoo import http, SUPERUSER_ID
+from odoo.http import request
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BackupMetrics(http.Controller):
+
+    @http.route('/dailybackup/metrics', type='http', auth='none', methods=['GET'], csrf=False)
+    def metrics(self, token=None, **kw):
+        """Prometheus scrape endpoint.
+
+        Only served when the ``dailybackup.metrics_token`` system parameter is
+        set, and the scraper must pass it as ``?token=``.
+        """
+        if not request.db:
+            return request.not_found()
+        registry = odoo.registry(request.db)
+        with registry.cursor() as cr:
+            env = odoo.api.Environment(cr, SUPERUSER_ID, {})
+            expected = env['ir.config_parameter'].get_param('dailybackup.metrics_token')
+            if not expected or token != expected:
+                logger.info('Function: metrics - refused scrape from %s' % request.httprequest.remote_addr)
+                return request.not_found()
+            body = env['dailybackup.backup.run']._prometheus_metrics()
+        return request.make_response(body, headers=[('Content-Type', 'text/plain; version=0.0.4')])
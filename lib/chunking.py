@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+import zipfile
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_EXTENSION = 'incremental'
+CHUNKS_DIRECTORY = 'chunks'
+
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# A boundary is cut after a line whose CRC has its 13 low bits at zero,
+# which gives chunks of about one megabyte on a plain SQL dump.
+BOUNDARY_MASK = (1 << 13) - 1
+FILE_CHUNK_SIZE = 4 * 1024 * 1024
+GARBAGE_MIN_AGE = 24 * 3600
+# A remote chunk a new backup reuses is touched when it is older than this, so
+# the garbage collection of another database does not delete it meanwhile.
+REMOTE_TOUCH_AGE = GARBAGE_MIN_AGE // 2
+
+
+def split_lines(stream, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE, mask=BOUNDARY_MASK):
+    """Cut a text-like stream (a plain SQL dump) into content-defined chunks.
+
+    Boundaries only depend on the content of the lines around them, so an
+    insertion in one table only changes the chunks around it and every
+    other chunk keeps its hash from one dump to the next.
+    """
+    chunk = bytearray()
+    while True:
+        line = stream.readline(max_size)
+        if not line:
+            break
+        chunk += line
+        if len(chunk) >= max_size or (len(chunk) >= min_size and not zlib.crc32(line) & mask):
+            yield bytes(chunk)
+            chunk = bytearray()
+    if chunk:
+        yield bytes(chunk)
+
+
+def split_file(path, size=FILE_CHUNK_SIZE):
+    """Cut a binary file in fixed-size chunks.
+
+    Filestore files never change once written (Odoo names them after their
+    own checksum), so fixed-size chunks are stable across runs.
+    """
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class ChunkStore(object):
+    """Directory of zlib-compressed chunks named after the SHA-256 of their content.
+
+    The hashes already stored are kept in a plain-text ``index`` file, so
+    checking for an existing chunk needs neither a directory scan nor a
+    ``stat`` per chunk.
+
+    The store is shared by every database of the folder: a backup writes
+    its chunks and its manifest under the shared lock of the store, the
+    garbage collection runs under the exclusive one (see ``locked``).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, 'index')
+        self.lock_path = os.path.join(root, 'lock')
+        if not os.path.isdir(root):
+            os.makedirs(root, exist_ok=True)
+        self.hashes = self._read_index()
+        self.new_hashes = []
+        self.new_bytes = 0
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return set()
+        with open(self.index_path) as fp:
+            return set(line.strip() for line in fp if line.strip())
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        """Hold the lock of the store, shared by default, exclusive for the garbage collection.
+
+        The index is read again once the lock is held: a garbage collection
+        may have removed chunks since the store was opened.
+        """
+        with open(self.lock_path, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self.hashes = self._read_index()
+                yield self
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def path(self, chunk_hash):
+        return os.path.join(self.root, chunk_hash)
+
+    def put(self, data):
+        """Store ``data`` unless a chunk with the same content exists, return its hash."""
+        chunk_hash = hashlib.sha256(data).hexdigest()
+        if chunk_hash not in self.hashes:
+            tmp_path = self.path(chunk_hash) + '.tmp'
+            with open(tmp_path, 'wb') as fp:
+                fp.write(zlib.compress(data, 6))
+            os.rename(tmp_path, self.path(chunk_hash))
+            with open(self.index_path, 'a') as fp:
+                fp.write(chunk_hash + '\n')
+            self.hashes.add(chunk_hash)
+            self.new_hashes.append(chunk_hash)
+            self.new_bytes += len(data)
+        return chunk_hash
+
+    def get(self, chunk_hash):
+        with open(self.path(chunk_hash), 'rb') as fp:
+            return zlib.decompress(fp.read())
+
+    def collect_garbage(self, referenced, min_age=GARBAGE_MIN_AGE):
+        """Delete the chunks that no manifest references anymore.
+
+        To be called under the exclusive lock of the store, with the
+        chunks of the manifests read under that lock. Chunks younger than
+        ``min_age`` seconds are kept all the same.
+        """
+        referenced = set(referenced)
+        limit = time.time() - min_age
+        removed = 0
+        for chunk_hash in self.hashes - referenced:
+            try:
+                if os.stat(self.path(chunk_hash)).st_mtime > limit:
+                    continue
+                os.remove(self.path(chunk_hash))
+            except OSError:
+                pass
+            self.hashes.discard(chunk_hash)
+            removed += 1
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.writelines(chunk_hash + '\n' for chunk_hash in sorted(self.hashes))
+        os.rename(tmp_path, self.index_path)
+        return removed
+
+
+def read_manifest(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def manifest_chunks(manifest):
+    """Return the set of chunk hashes a manifest refers to."""
+    hashes = set(manifest['dump'])
+    for entry in manifest['filestore'].values():
+        hashes.update(entry['chunks'])
+    return hashes
+
+
+def build_manifest(store, db_name, dump_stream, filestore_path, odoo_manifest, previous=None):
+    """Chunk a plain SQL dump and a filestore into ``store``.
+
+    Filestore files with the same size and modification time as in the
+    ``previous`` manifest reuse its chunk list without being read again.
+
+    :return: the manifest as a dict
+    """
+    previous_files = previous['filestore'] if previous else {}
+    manifest = {
+        'version': 1,
+        'database': db_name,
+        'odoo_manifest': odoo_manifest,
+        'dump': [store.put(chunk) for chunk in split_lines(dump_stream)],
+        'filestore': {},
+    }
+    if filestore_path and os.path.isdir(filestore_path):
+        for dirpath, dirnames, filenames in os.walk(filestore_path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                relpath = os.path.relpath(path, filestore_path)
+                stat = os.stat(path)
+                known = previous_files.get(relpath)
+                if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime \
+                        and all(chunk_hash in store.hashes for chunk_hash in known['chunks']):
+                    chunks = known['chunks']
+                else:
+                    chunks = [store.put(chunk) for chunk in split_file(path)]
+                manifest['filestore'][relpath] = {
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime,
+                    'chunks': chunks,
+                }
+    manifest['new_chunks'] = len(store.new_hashes)
+    manifest['new_bytes'] = store.new_bytes
+    return manifest
+
+
+def rebuild_archive(manifest, store, zip_path):
+    """Rebuild the zip archive ``odoo.service.db.restore_db`` expects from a manifest."""
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        archive.writestr('manifest.json', json.dumps(manifest['odoo_manifest'], indent=4))
+        with archive.open('dump.sql', 'w', force_zip64=True) as fp:
+            for chunk_hash in manifest['dump']:
+                fp.write(store.get(chunk_hash))
+        for relpath, entry in sorted(manifest['filestore'].items()):
+            with archive.open(os.path.join('filestore', relpath), 'w', force_zip64=True) as fp:
+                for chunk_hash in entry['chunks']:
+                    fp.write(store.get(chunk_hash))
+    return zip_path
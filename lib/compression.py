@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+EXTENSIONS = {
+    'zstd': '.zst',
+    'lz4': '.lz4',
+}
+PACKAGES = {
+    'zstd': 'zstandard',
+    'lz4': 'lz4',
+}
+BLOCK_SIZE = 1024 * 1024
+# Level used when none is given. Levels are not comparable between codecs:
+# lz4 switches to its much slower high-compression mode from level 3.
+DEFAULT_LEVELS = {
+    'zstd': 3,
+    'lz4': 0,
+    'zlib': 6,
+}
+
+
+def is_available(codec):
+    if codec == 'zstd':
+        return zstandard is not None
+    if codec == 'lz4':
+        return lz4_frame is not None
+    return codec == 'zlib'
+
+
+def check_available(codec):
+    if not is_available(codec):
+        raise ImportError('The %s compression needs the python package %s. Please install it on your system. '
+                          '(python3 -m pip install %s)' % (codec, PACKAGES[codec], PACKAGES[codec]))
+
+
+def _compressor(codec, level, threads):
+    check_available(codec)
+    level = level or DEFAULT_LEVELS[codec]
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level, threads=threads or 0).compressobj()
+    if codec == 'lz4':
+        return _Lz4Compressor(level)
+    # Same compression as the zip archives made by Odoo, as a reference.
+    return zlib.compressobj(level)
+
+
+class _Lz4Compressor(object):
+    """Give the lz4 frame compressor the ``compress``/``flush`` interface of zlib."""
+
+    def __init__(self, level):
+        self._compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        out = self._compressor.compress(data)
+        if self._header:
+            out, self._header = self._header + out, b''
+        return out
+
+    def flush(self):
+        out = self._compressor.flush()
+        if self._header:
+            out, self._header = self._header + out, b''
+        return out
+
+
+class CompressingWriter(object):
+    """Non-seekable file object compressing everything written to it into ``stream``.
+
+    ``close`` writes the end of the compressed frame but leaves ``stream``
+    open, so it can sit between ``dump_db`` and any sink: a local file, the
+    streaming pipe or a tee of both.
+    """
+
+    def __init__(self, stream, codec, level=None, threads=None):
+        self.stream = stream
+        self.codec = codec
+        self._compressor = _compressor(codec, level, threads)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        out = self._compressor.compress(data)
+        if out:
+            self.bytes_out += len(out)
+            self.stream.write(out)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        out = self._compressor.flush()
+        self.bytes_out += len(out)
+        self.stream.write(out)
+        self.closed = True
+
+
+def open_reader(stream, codec):
+    """File object reading the decompressed content of ``stream``."""
+    check_available(codec)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    if codec == 'lz4':
+        return lz4_frame.LZ4FrameFile(stream, 'rb')
+    raise ValueError('Unknown compression %s' % codec)
+
+
+def codec_of(filename):
+    """Compression of a backup file according to its extension, None when it is not compressed."""
+    for codec, extension in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return codec
+    return None
+
+
+class _NullSink(object):
+
+    def write(self, data):
+        return len(data)
+
+
+def benchmark(sample_path, codecs, levels=None, threads=None):
+    """Compress the file ``sample_path`` with every codec and measure it.
+
+    :param levels: dict of the level of some codecs, the others use their default one
+    :return: list of dicts with ``codec``, ``level``, ``seconds``, ``mb_per_second`` and ``ratio``
+    """
+    levels = levels or {}
+    results = []
+    for codec in codecs:
+        if not is_available(codec):
+            results.append({'codec': codec, 'error': 'python package %s is not installed' % PACKAGES[codec]})
+            continue
+        level = levels.get(codec) or DEFAULT_LEVELS[codec]
+        writer = CompressingWriter(_NullSink(), codec, level=level, threads=threads)
+        start = time.time()
+        with open(sample_path, 'rb') as fp:
+            for block in iter(lambda: fp.read(BLOCK_SIZE), b''):
+                writer.write(block)
+        writer.close()
+        seconds = max(time.time() - start, 1e-6)
+        results.append({
+            'codec': codec,
+            'level': level,
+            'seconds': seconds,
+            'mb_per_second': writer.bytes_in / 1024.0 / 1024.0 / seconds,
+            'ratio': writer.bytes_in / float(writer.bytes_out or 1),
+        })
+    return results
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import shutil
+import subprocess
+import tempfile
+import zipfile
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+ALGORITHMS = ('sha256', 'blake3')
+PACKAGES = {
+    'blake3': 'blake3',
+}
+BLOCK_SIZE = 1024 * 1024
+
+
+class IntegrityError(Exception):
+    """A backup is not what it should be."""
+
+
+def is_available(algorithm):
+    if algorithm == 'blake3':
+        return blake3 is not None
+    return algorithm in hashlib.algorithms_available
+
+
+def new_hash(algorithm='sha256'):
+    if algorithm == 'blake3':
+        if blake3 is None:
+            raise ImportError('BLAKE3 checksums need the python package blake3. Please install it on your system. '
+                              '(python3 -m pip install blake3)')
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+
+class HashingWriter(object):
+    """Non-seekable file object hashing everything written through it into ``stream``.
+
+    Wrapped around the dump, it gives the checksum of the backup without
+    reading the file a second time.
+    """
+
+    def __init__(self, stream, algorithm='sha256'):
+        self.stream = stream
+        self.algorithm = algorithm
+        self._hash = new_hash(algorithm)
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self.stream.write(data)
+
+    def flush(self):
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class HashingReader(object):
+    """File object hashing everything read from ``stream``."""
+
+    def __init__(self, stream, algorithm='sha256'):
+        self.stream = stream
+        self.algorithm = algorithm
+        self._hash = new_hash(algorithm)
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self._hash.update(data)
+        self.size += len(data)
+        return data
+
+    def drain(self):
+        """Read what the consumer left, so the digest covers the whole file."""
+        for block in iter(lambda: self.read(BLOCK_SIZE), b''):
+            pass
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def verify_zip(stream, required=('manifest.json', 'dump.sql')):
+    """Check every member of an Odoo zip backup against its CRC.
+
+    A seekable file (a local backup) is read where it is, any other
+    stream is copied to a temporary file first: zipfile needs to seek to
+    the central directory at the end.
+
+    :param required: members the archive must have
+
+    :return: the manifest of the backup
+    :raise IntegrityError: when the archive is damaged or incomplete
+    """
+    if getattr(stream, 'seekable', None) and stream.seekable():
+        return _verify_zip_file(stream, required)
+    with tempfile.TemporaryFile() as spool:
+        shutil.copyfileobj(stream, spool, BLOCK_SIZE)
+        spool.seek(0)
+        return _verify_zip_file(spool, required)
+
+
+def _verify_zip_file(fp, required):
+    try:
+        with zipfile.ZipFile(fp) as archive:
+            names = set(archive.namelist())
+            for name in required:
+                if name not in names:
+                    raise IntegrityError('%s is missing from the archive' % name)
+            bad = archive.testzip()
+            if bad:
+                raise IntegrityError('%s is damaged in the archive' % bad)
+            return json.loads(archive.read('manifest.json').decode('utf-8'))
+    except zipfile.BadZipfile as e:
+        raise IntegrityError(str(e))
+
+
+def list_pg_archive(stream, command, env=None):
+    """Feed a custom-format dump to ``pg_restore --list``.
+
+    :param command: the pg_restore command line, reading the archive on its standard input
+    :return: number of entries in the table of contents
+    :raise IntegrityError: when pg_restore cannot read the archive
+    """
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        pop = subprocess.Popen(command, env=env, stdin=subprocess.PIPE, stdout=out, stderr=err)
+        try:
+            for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+                pop.stdin.write(block)
+        except BrokenPipeError:
+            # pg_restore stops reading once it has the table of contents.
+            pass
+        finally:
+            try:
+                pop.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = pop.wait()
+        if returncode:
+            err.seek(0)
+            raise IntegrityError('pg_restore exited with code %s: %s' % (
+                returncode, err.read().decode('utf-8', 'replace').strip()))
+        out.seek(0)
+        return sum(1 for line in out if line.strip() and not line.startswith(b';'))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import threading
+import time
+
+_local = threading.local()
+
+
+class RecordMetrics(object):
+    """Stage durations and counters collected while one record is backed up."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.error = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.time() - start
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def fail(self, error):
+        """Remember an error that was handled without interrupting the backup."""
+        self.error = '%s\n%s' % (self.error, error) if self.error else str(error)
+
+    def duration(self):
+        return time.time() - self.start
+
+
+def start_record():
+    """Collect the metrics of the current thread in a new RecordMetrics and return it."""
+    _local.metrics = RecordMetrics()
+    return _local.metrics
+
+
+def stop_record():
+    metrics = getattr(_local, 'metrics', None)
+    _local.metrics = None
+    return metrics
+
+
+def current():
+    """RecordMetrics of the current thread; a throw-away one outside of a backup run."""
+    return getattr(_local, 'metrics', None) or RecordMetrics()
+
+
+def stage(name):
+    return current().stage(name)
+
+
+def add(name, value=1):
+    current().add(name, value)
+
+
+def fail(error):
+    current().fail(error)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(metrics):
+    """Render metrics in the Prometheus text exposition format.
+
+    :param metrics: list of ``(name, type, help, samples)`` where samples is
+        a list of ``(labels_dict, value)``
+    """
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in samples:
+            label_text = ','.join('%s="%s"' % (key, _escape(labels[key])) for key in sorted(labels))
+            lines.append('%s%s %s' % (name, label_text and '{%s}' % label_text, float(value)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import shlex
+import threading
+
+from .integrity import new_hash
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+STATE_EXTENSION = '.upload'
+REMOTE_HASH_COMMANDS = {
+    'sha256': 'sha256sum',
+    'blake3': 'b3sum',
+}
+
+
+def file_hash(path, algorithm='sha256'):
+    digest = new_hash(algorithm)
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remote_file_hash(ssh, remote_path, algorithm='sha256'):
+    """Let the server hash one of its files, so it does not need to be downloaded.
+
+    :return: the hex digest, or None when the server cannot run the command
+    """
+    command = REMOTE_HASH_COMMANDS.get(algorithm)
+    if not command:
+        return None
+    try:
+        stdin, stdout, stderr = ssh.exec_command('%s -- %s' % (command, shlex.quote(remote_path)), timeout=3600)
+        output = stdout.read().decode('utf-8', 'replace')
+        if stdout.channel.recv_exit_status():
+            return None
+    except Exception as e:
+        logger.info('Function: remote_file_hash - %s is not available on the server: %s' % (command, e))
+        return None
+    return output.split()[0].lower() if output.strip() else None
+
+
+class UploadVerificationError(IOError):
+    """The remote copy does not match the local file."""
+
+
+class MultipartUpload(object):
+    """Upload one large file over several SFTP channels, resumable.
+
+    The file is cut in ``part_size`` ranges that ``channels`` threads write
+    at their offset in a remote ``.part`` file. Finished ranges are
+    recorded in a local state file next to the archive, so an interrupted
+    upload only sends the missing ranges on the next attempt. Once all
+    ranges are there the remote size and checksum are verified and the
+    ``.part`` file is renamed to its final name.
+    """
+
+    def __init__(self, ssh, local_path, remote_path, part_size=64 * 1024 * 1024, channels=4,
+                 expected_hash=None, algorithm='sha256', throttle=None):
+        self.ssh = ssh
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.remote_tmp_path = remote_path + '.part'
+        self.state_path = local_path + STATE_EXTENSION
+        self.part_size = max(int(part_size), BLOCK_SIZE)
+        self.channels = max(int(channels), 1)
+        self.expected_hash = expected_hash
+        self.algorithm = algorithm
+        self.throttle = throttle
+        self._lock = threading.Lock()
+        self.size = os.path.getsize(local_path)
+        self.parts = max(1, -(-self.size // self.part_size))
+        self.done = set()
+        self.resumed_parts = 0
+        self.verified = None
+
+    def _open_channel(self):
+        return self.ssh.open_sftp()
+
+    def _load_state(self, sftp):
+        if not os.path.exists(self.state_path):
+            return False
+        try:
+            with open(self.state_path) as fp:
+                state = json.load(fp)
+        except ValueError:
+            return False
+        stat = os.stat(self.local_path)
+        if state.get('remote_tmp_path') != self.remote_tmp_path or state.get('size') != stat.st_size \
+                or state.get('mtime') != stat.st_mtime or state.get('part_size') != self.part_size:
+            return False
+        try:
+            remote_size = sftp.stat(self.remote_tmp_path).st_size
+        except IOError:
+            return False
+        # A range that ends past the remote file was never written, whatever the state says.
+        self.done = set(index for index in state.get('done', [])
+                        if min((index + 1) * self.part_size, self.size) <= remote_size)
+        self.resumed_parts = len(self.done)
+        return True
+
+    def _save_state(self):
+        # Called with the lock held.
+        stat = os.stat(self.local_path)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump({
+                'remote_tmp_path': self.remote_tmp_path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'part_size': self.part_size,
+                'done': sorted(self.done),
+            }, fp)
+        os.rename(tmp_path, self.state_path)
+
+    def _write_part(self, remote_file, local_file, index):
+        """Write one range and return once the server acknowledged all of it.
+
+        The blocks are pipelined, but the last one is sent un-pipelined:
+        paramiko then waits for the answer of every write still in flight
+        and raises the first error, which it otherwise silently drops.
+        """
+        offset = index * self.part_size
+        end = min(offset + self.part_size, self.size)
+        local_file.seek(offset)
+        remote_file.seek(offset)
+        remote_file.set_pipelined(True)
+        while offset < end:
+            block = local_file.read(min(BLOCK_SIZE, end - offset))
+            if not block:
+                raise IOError('%s is shorter than expected' % self.local_path)
+            self.before_write(len(block))
+            offset += len(block)
+            if offset >= end:
+                remote_file.set_pipelined(False)
+            remote_file.write(block)
+        remote_file.flush()
+
+    def before_write(self, size):
+        """Hook called before every block is sent, throttles the upload when a ``throttle`` is given."""
+        if self.throttle:
+            self.throttle(size)
+
+    def _worker(self, pending, errors):
+        sftp = None
+        try:
+            sftp = self._open_channel()
+            with open(self.local_path, 'rb') as local_file, sftp.open(self.remote_tmp_path, 'r+b') as remote_file:
+                while not errors:
+                    with self._lock:
+                        if not pending:
+                            return
+                        index = pending.pop()
+                    self._write_part(remote_file, local_file, index)
+                    with self._lock:
+                        self.done.add(index)
+                        self._save_state()
+        except Exception as e:
+            logger.exception('Function: MultipartUpload._worker - upload of %s failed' % self.local_path)
+            errors.append(e)
+        finally:
+            if sftp:
+                sftp.close()
+
+    def run(self):
+        """Upload, verify and move the file into place.
+
+        :return: the SFTPAttributes of the remote file
+        """
+        sftp = self._open_channel()
+        try:
+            if not self._load_state(sftp):
+                self.done = set()
+                with sftp.open(self.remote_tmp_path, 'wb'):
+                    pass
+                with self._lock:
+                    self._save_state()
+            pending = sorted(set(range(self.parts)) - self.done, reverse=True)
+            logger.info('Function: MultipartUpload.run - Parameters: local_path: %s - parts: %s - resumed: %s - '
+                        'channels: %s' % (self.local_path, self.parts, self.resumed_parts, self.channels))
+
+            errors = []
+            threads = []
+            for index in range(min(self.channels, len(pending))):
+                thread = threading.Thread(target=self._worker, args=(pending, errors),
+                                          name='dailybackup-upload-%d' % index)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+
+            self.verified = self.verify(sftp)
+            sftp.posix_rename(self.remote_tmp_path, self.remote_path)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            return sftp.stat(self.remote_path)
+        finally:
+            sftp.close()
+
+    def verify(self, sftp):
+        """Compare the size and the checksum of the remote copy.
+
+        :return: True when the checksum matched, None when the server could not compute it
+        """
+        remote_size = sftp.stat(self.remote_tmp_path).st_size
+        if remote_size != self.size:
+            # Start from scratch next time.
+            os.remove(self.state_path)
+            raise UploadVerificationError('Remote size %s of %s differs from local size %s' % (
+                remote_size, self.remote_tmp_path, self.size))
+        remote_hash = remote_file_hash(self.ssh, self.remote_tmp_path, self.algorithm)
+        if remote_hash is None:
+            logger.info('Function: MultipartUpload.verify - no remote %s for %s, only the size was checked' % (
+                self.algorithm, self.remote_tmp_path))
+            return None
+        local_hash = self.expected_hash or file_hash(self.local_path, self.algorithm)
+        if remote_hash != local_hash:
+            os.remove(self.state_path)
+            raise UploadVerificationError('Remote %s of %s differs from the local file' % (
+                self.algorithm, self.remote_tmp_path))
+        return True
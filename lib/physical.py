@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import os
+import re
+import shutil
+import signal
+import subprocess
+import tarfile
+import time
+
+logger = logging.getLogger(__name__)
+
+# Completed WAL segments (timeline, log, segment) and timeline history files, as written by pg_receivewal.
+WAL_SEGMENT_RE = re.compile(r'^[0-9A-F]{24}$')
+WAL_HISTORY_RE = re.compile(r'^[0-9A-F]{8}\.history$')
+PID_FILE = 'pg_receivewal.pid'
+LOG_FILE = 'pg_receivewal.log'
+BASE_MEMBER = 'base.tar'
+
+
+def is_wal_file(filename):
+    """Tell whether ``filename`` is a completed WAL segment or a timeline history file.
+
+    The segment pg_receivewal is still writing ends with ``.partial`` and
+    is left out until it is complete.
+    """
+    return bool(WAL_SEGMENT_RE.match(filename) or WAL_HISTORY_RE.match(filename))
+
+
+def slot_name(database):
+    """Replication slot name for ``database``: lower case letters, digits and underscores only."""
+    return 'dailybackup_' + re.sub(r'[^a-z0-9_]', '_', database.lower())
+
+
+def _running_pid(pid_file):
+    """Pid of the pg_receivewal written in ``pid_file`` when it still runs, None otherwise."""
+    try:
+        with open(pid_file) as fp:
+            pid = int(fp.read().strip())
+        os.kill(pid, 0)
+    except (IOError, OSError, ValueError):
+        return None
+    cmdline = '/proc/%s/cmdline' % pid
+    if os.path.exists(cmdline):
+        # The pid may have been reused by another process since.
+        with open(cmdline, 'rb') as fp:
+            if b'pg_receivewal' not in fp.read():
+                return None
+    return pid
+
+
+def ensure_receiver(command, wal_dir, slot, env=None):
+    """Start pg_receivewal on ``wal_dir`` unless it runs already.
+
+    It is started in its own session, so it keeps streaming when the
+    worker that started it is recycled. The replication slot makes the
+    server keep the WAL the receiver did not get yet.
+
+    :param command: path of pg_receivewal
+    :return: tuple ``(pid, started)``
+    """
+    os.makedirs(wal_dir, exist_ok=True)
+    pid_file = os.path.join(wal_dir, PID_FILE)
+    pid = _running_pid(pid_file)
+    if pid:
+        return pid, False
+    subprocess.check_call([command, '--slot=%s' % slot, '--create-slot', '--if-not-exists'], env=env)
+    with open(os.path.join(wal_dir, LOG_FILE), 'ab') as log:
+        pop = subprocess.Popen([command, '--directory=%s' % wal_dir, '--slot=%s' % slot, '--no-password'],
+                               env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    with open(pid_file, 'w') as fp:
+        fp.write(str(pop.pid))
+    logger.info('Function: ensure_receiver - Parameters: wal_dir: %s - slot: %s - pid: %s' % (wal_dir, slot, pop.pid))
+    return pop.pid, True
+
+
+def find_receivers():
+    """pg_receivewal processes running on this host, by the replication slot they stream from.
+
+    :return: dict ``{slot: [pid, ...]}``, empty where ``/proc`` is not available
+    """
+    receivers = {}
+    if not os.path.isdir('/proc'):
+        return receivers
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % entry, 'rb') as fp:
+                args = fp.read().decode('utf-8', 'replace').split('\0')
+        except (IOError, OSError):
+            continue
+        if not args or os.path.basename(args[0]) != 'pg_receivewal':
+            continue
+        for arg in args:
+            if arg.startswith('--slot='):
+                receivers.setdefault(arg[len('--slot='):], []).append(int(entry))
+    return receivers
+
+
+def _wait_exit(pid, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def stop_receiver(wal_dir, slot, timeout=10):
+    """Stop the pg_receivewal of ``wal_dir`` and every other one streaming from ``slot``.
+
+    pg_receivewal writes out what it received before it exits on SIGTERM;
+    one that does not exit within ``timeout`` seconds is killed.
+
+    :param wal_dir: None when it is not known
+    :return: the pids stopped
+    """
+    pid_file = wal_dir and os.path.join(wal_dir, PID_FILE)
+    pids = set(find_receivers().get(slot, []))
+    pid = pid_file and _running_pid(pid_file)
+    if pid:
+        pids.add(pid)
+    for pid in sorted(pids):
+        try:
+            os.kill(pid, signal.SIGTERM)
+            if not _wait_exit(pid, timeout):
+                os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    if pid_file and os.path.exists(pid_file):
+        os.remove(pid_file)
+    if pids:
+        logger.info('Function: stop_receiver - Parameters: wal_dir: %s - slot: %s - pids: %s' % (
+            wal_dir, slot, sorted(pids)))
+    return sorted(pids)
+
+
+def drop_slot(command, slot, env=None):
+    """Drop the replication slot, so the server no longer keeps WAL for it.
+
+    :param command: path of pg_receivewal
+    :return: False when the slot did not exist
+    """
+    pop = subprocess.run([command, '--drop-slot', '--slot=%s' % slot, '--no-password'], env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if pop.returncode:
+        error = pop.stderr.decode('utf-8', 'replace').strip()
+        if 'does not exist' in error:
+            return False
+        raise Exception('pg_receivewal --drop-slot exited with code %s: %s' % (pop.returncode, error))
+    logger.info('Function: drop_slot - Parameters: slot: %s' % slot)
+    return True
+
+
+def last_segment_age(wal_dir, now=None):
+    """Seconds since the last WAL segment was completed, None when there is none yet."""
+    if not os.path.isdir(wal_dir):
+        return None
+    mtimes = [entry.stat().st_mtime for entry in os.scandir(wal_dir) if WAL_SEGMENT_RE.match(entry.name)]
+    if not mtimes:
+        return None
+    return (now or datetime.datetime.now()).timestamp() - max(mtimes)
+
+
+def expired_wal(snapshot, oldest_backup, margin=3600):
+    """WAL segments of a snapshot written before the oldest base backup still kept.
+
+    A segment is complete, and so written, after the base backups that
+    need it started; ``margin`` seconds cover the clock of a remote server.
+
+    :param snapshot: dict ``{filename: stat}`` of a WAL directory
+    :param oldest_backup: naive UTC datetime at which the oldest base backup started
+    :return: the names to remove, history files are always kept
+    """
+    cutoff = (oldest_backup - datetime.datetime(1970, 1, 1)).total_seconds() - margin
+    return sorted(name for name, attr in snapshot.items()
+                  if WAL_SEGMENT_RE.match(name) and attr.st_mtime < cutoff)
+
+
+def extract_base(archive, data_dir):
+    """Extract the ``base.tar`` of a physical backup into the empty directory ``data_dir``.
+
+    The tar is read as a stream, straight from the zip member.
+    """
+    if os.path.isdir(data_dir) and os.listdir(data_dir):
+        raise ValueError('The data directory %s is not empty' % data_dir)
+    os.makedirs(data_dir, mode=0o700, exist_ok=True)
+    root = os.path.realpath(data_dir)
+    with archive.open(BASE_MEMBER) as member, tarfile.open(fileobj=member, mode='r|') as tar:
+        for info in tar:
+            _check_tar_member(root, info)
+            tar.extract(info, root)
+    os.chmod(data_dir, 0o700)
+
+
+def _check_tar_member(root, info):
+    """Refuse a member of the base backup that would be written, or link, outside ``root``.
+
+    The links already extracted are followed, so a member cannot get out
+    through a symbolic link of an earlier one.
+    """
+    parent = os.path.realpath(os.path.dirname(os.path.join(root, info.name)))
+    paths = [os.path.normpath(os.path.join(parent, os.path.basename(info.name)))]
+    if info.issym():
+        paths.append(os.path.realpath(os.path.join(parent, info.linkname)))
+    elif info.islnk():
+        paths.append(os.path.realpath(os.path.join(root, info.linkname)))
+    if info.isdev() or any(path != root and not path.startswith(root + os.sep) for path in paths):
+        raise ValueError('Unsafe member in the base backup: %s' % info.name)
+
+
+def extract_filestore(archive, path):
+    """Extract the ``filestore/`` members of a backup archive into ``path``."""
+    root = os.path.abspath(path)
+    count = 0
+    for info in archive.infolist():
+        if not info.filename.startswith('filestore/') or info.filename.endswith('/'):
+            continue
+        destination = os.path.abspath(os.path.join(root, info.filename[len('filestore/'):]))
+        if not destination.startswith(root + os.sep):
+            raise ValueError('Unsafe path in the archive: %s' % info.filename)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with archive.open(info) as src, open(destination, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        count += 1
+    return count
+
+
+def write_recovery_config(data_dir, wal_dir, pg_major, target_time=None):
+    """Make the restored cluster replay the archived WAL, up to ``target_time`` when given.
+
+    PostgreSQL 12 and later read the settings from ``postgresql.auto.conf``
+    plus a ``recovery.signal`` file, older versions from ``recovery.conf``.
+
+    :param target_time: time to stop at, e.g. ``'2024-05-01 10:30:00+00'``
+    """
+    lines = ["restore_command = 'cp \"%s/%%f\" \"%%p\"'" % wal_dir.replace("'", "''")]
+    if target_time:
+        lines.append("recovery_target_time = '%s'" % target_time)
+        lines.append("recovery_target_action = 'promote'")
+    if pg_major >= 12:
+        with open(os.path.join(data_dir, 'postgresql.auto.conf'), 'a') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        open(os.path.join(data_dir, 'recovery.signal'), 'w').close()
+    else:
+        with open(os.path.join(data_dir, 'recovery.conf'), 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from . import compression
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+# pg_restore --verbose: "processing item" for the items restored by the leader, "finished item" for the workers.
+PG_RESTORE_ITEM_RE = re.compile(r'(processing|finished) item \d+')
+
+
+class ProgressReporter(object):
+    """Collect progress from several threads and pass it on at most every ``interval`` seconds.
+
+    ``callback`` gets a dict of the values changed since its last call.
+    """
+
+    def __init__(self, callback, interval=2.0):
+        self.callback = callback
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last = 0.0
+
+    def update(self, **values):
+        with self._lock:
+            self._pending.update(values)
+            if time.time() - self._last < self.interval:
+                return
+            pending, self._pending = self._pending, {}
+            self._last = time.time()
+            # Under the lock, so two threads do not report out of order.
+            self.callback(pending)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last = time.time()
+            if pending:
+                self.callback(pending)
+
+
+class _CountingReader(object):
+
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        self.progress(self.count)
+        return data
+
+
+def download(stream, path, codec=None, progress=None):
+    """Copy ``stream`` into the local file ``path``, decompressing it on the way.
+
+    :param progress: called with the number of bytes read from ``stream``
+    :return: size of the file written
+    """
+    source = _CountingReader(stream, progress) if progress else stream
+    if codec:
+        source = compression.open_reader(source, codec)
+    with open(path, 'wb') as fp:
+        shutil.copyfileobj(source, fp, BLOCK_SIZE)
+    return os.path.getsize(path)
+
+
+class _Process(object):
+    """A command whose standard error is read line by line on a thread and passed to ``on_line``."""
+
+    def __init__(self, command, env=None, on_line=None, stdin=None):
+        self.name = os.path.basename(command[0])
+        self.on_line = on_line
+        self.error_tail = collections.deque(maxlen=20)
+        self.pop = subprocess.Popen(command, env=env, stdin=stdin, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read, name='%s output' % self.name, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        for line in iter(self.pop.stderr.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip()
+            self.error_tail.append(line)
+            if self.on_line:
+                self.on_line(line)
+
+    def wait(self):
+        """:raise Exception: when the command failed, with the end of its output"""
+        returncode = self.pop.wait()
+        self._reader.join()
+        if returncode:
+            raise Exception('%s exited with code %s: %s' % (self.name, returncode, '\n'.join(self.error_tail)))
+
+
+def count_archive_items(pg_restore, path, env=None):
+    """Number of entries in the table of contents of a custom-format dump."""
+    output = subprocess.check_output([pg_restore, '--list', path], env=env)
+    return sum(1 for line in output.splitlines() if line.strip() and not line.startswith(b';'))
+
+
+def restore_dump(pg_restore, path, database, jobs=1, env=None, progress=None):
+    """Restore a custom-format dump with ``jobs`` parallel connections.
+
+    :param pg_restore: path of pg_restore
+    :param progress: called with the number of items restored so far
+    """
+    done = [0]
+
+    def on_line(line):
+        if PG_RESTORE_ITEM_RE.search(line):
+            done[0] += 1
+            if progress:
+                progress(done[0])
+    command = [pg_restore, '--no-owner', '--verbose', '--jobs=%s' % max(jobs, 1), '--dbname=%s' % database, path]
+    _Process(command, env, on_line).wait()
+    return done[0]
+
+
+def restore_sql_member(psql, zip_path, member, database, env=None, progress=None):
+    """Feed a plain SQL member of a zip archive to psql, without extracting it first.
+
+    :param psql: path of psql
+    :param progress: called with the number of bytes sent to psql
+    """
+    process = _Process([psql, '--quiet', '--no-psqlrc', '--dbname=%s' % database], env, stdin=subprocess.PIPE)
+    pop = process.pop
+    sent = 0
+    try:
+        with zipfile.ZipFile(zip_path) as archive, archive.open(member) as fp:
+            for block in iter(lambda: fp.read(BLOCK_SIZE), b''):
+                pop.stdin.write(block)
+                sent += len(block)
+                if progress:
+                    progress(sent)
+    except BrokenPipeError:
+        # psql died, its exit code tells why.
+        pass
+    finally:
+        try:
+            pop.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+    return sent
+
+
+def extract_members(zip_path, prefix, destination, threads=4, progress=None):
+    """Extract the members of ``zip_path`` under ``prefix`` into ``destination`` with ``threads`` threads.
+
+    Every thread reads the archive through its own file handle.
+
+    :param progress: called with the number of files extracted so far
+    :return: number of files extracted
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        members = [info for info in archive.infolist()
+                   if info.filename.startswith(prefix) and not info.filename.endswith('/')]
+    root = os.path.abspath(destination)
+    local = threading.local()
+    handles = []
+    done = [0]
+    lock = threading.Lock()
+
+    def extract(info):
+        target = os.path.abspath(os.path.join(root, info.filename[len(prefix):]))
+        if not target.startswith(root + os.sep):
+            raise ValueError('Unsafe path in the archive: %s' % info.filename)
+        if not hasattr(local, 'archive'):
+            local.archive = zipfile.ZipFile(zip_path)
+            with lock:
+                handles.append(local.archive)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with local.archive.open(info) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, BLOCK_SIZE)
+        with lock:
+            done[0] += 1
+            count = done[0]
+        if progress:
+            progress(count)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+            # list() re-raises the first error of a worker.
+            list(executor.map(extract, members))
+    finally:
+        for archive in handles:
+            archive.close()
+    return len(members)
+
+
+def count_members(zip_path, prefix):
+    """Number of files under ``prefix`` in a zip archive."""
+    with zipfile.ZipFile(zip_path) as archive:
+        return sum(1 for name in archive.namelist() if name.startswith(prefix) and not name.endswith('/'))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+PERIODS = (
+    ('daily', lambda date: date.date()),
+    ('weekly', lambda date: tuple(date.isocalendar()[:2])),
+    ('monthly', lambda date: (date.year, date.month)),
+)
+
+
+def gfs_keep(backups, daily=0, weekly=0, monthly=0):
+    """Grandfather-father-son retention: the backups to keep out of ``backups``.
+
+    The newest backup of each of the last ``daily`` days, ``weekly`` ISO
+    weeks and ``monthly`` months that have a backup is kept, as well as
+    the newest backup overall. Periods without backup do not count, so a
+    server that was down for a week still keeps ``daily`` backups. A
+    backup may be kept for several reasons, e.g. the last one of a day is
+    often the last one of its week as well.
+
+    :param backups: iterable of ``(key, datetime)``
+    :return: dict ``{key: [reasons]}`` of the backups to keep, the others may be removed
+    """
+    ordered = sorted(backups, key=lambda backup: backup[1], reverse=True)
+    keep = {}
+    if ordered:
+        keep[ordered[0][0]] = ['latest']
+    counts = {'daily': daily, 'weekly': weekly, 'monthly': monthly}
+    for name, period_of in PERIODS:
+        seen = set()
+        for key, date in ordered:
+            if len(seen) >= (counts[name] or 0):
+                break
+            period = period_of(date)
+            if period not in seen:
+                # Newest first: the first backup of a period is its newest one.
+                seen.add(period)
+                keep.setdefault(key, []).append(name)
+    return keep
+
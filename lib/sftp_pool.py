@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import hashlib
+import logging
+import threading
+import time
+
+import paramiko
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SftpConnectionPool(object):
+    """Keep SSH/SFTP sessions open and hand them out again.
+
+    Sessions are keyed on ``(host, port, user)`` and a hash of the
+    password, so a configuration never gets a session another one opened
+    with other credentials. A session is used by one caller at a time;
+    when it is given back it waits in the pool until the next caller for
+    the same key, or until it stayed idle longer than ``max_idle``
+    seconds. Before reuse a session is health-checked and replaced when
+    the server dropped it.
+    """
+
+    def __init__(self, timeout=20, retries=3, backoff=1.0, max_idle=300):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = {}
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {
+                'handshakes': 0,
+                'handshake_time': 0.0,
+                'reused': 0,
+                'reconnects': 0,
+                'failures': 0,
+            }
+
+    def _connect(self, host, port, user, password):
+        attempt = 0
+        while True:
+            start = time.time()
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                with metrics.stage('handshake'):
+                    ssh.connect(host, port, user, password, timeout=self.timeout)
+                    sftp = ssh.open_sftp()
+            except Exception as e:
+                ssh.close()
+                attempt += 1
+                with self._lock:
+                    self.stats['failures'] += 1
+                if attempt > self.retries or isinstance(e, paramiko.AuthenticationException):
+                    raise
+                metrics.add('retries')
+                delay = self.backoff * 2 ** (attempt - 1)
+                logger.info('Function: SftpConnectionPool._connect - connection to %s:%s failed (%s), '
+                            'retrying in %.1fs' % (host, port, e, delay))
+                time.sleep(delay)
+                continue
+            with self._lock:
+                self.stats['handshakes'] += 1
+                self.stats['handshake_time'] += time.time() - start
+            metrics.add('handshakes')
+            return ssh, sftp
+
+    @staticmethod
+    def _is_alive(ssh, sftp):
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            sftp.normalize('.')
+        except Exception:
+            return False
+        return True
+
+    def _checkout(self, key, password):
+        self.close_idle()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                entry = idle.pop() if idle else None
+            if entry is None:
+                return self._connect(key[0], key[1], key[2], password)
+            ssh, sftp, released = entry
+            if self._is_alive(ssh, sftp):
+                with self._lock:
+                    self.stats['reused'] += 1
+                metrics.add('sessions_reused')
+                return ssh, sftp
+            ssh.close()
+            with self._lock:
+                self.stats['reconnects'] += 1
+
+    def _checkin(self, key, ssh, sftp):
+        try:
+            # The next user starts from the login directory.
+            sftp.chdir(None)
+        except Exception:
+            ssh.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((ssh, sftp, time.time()))
+
+    @contextlib.contextmanager
+    def session(self, host, port, user, password):
+        """Context manager giving an ``(ssh_client, sftp_client)`` tuple.
+
+        A session that raised an error is closed instead of going back to
+        the pool, since its channel may be in an unknown state.
+        """
+        key = (host, int(port or 22), user, hashlib.sha256((password or '').encode('utf-8')).hexdigest())
+        ssh, sftp = self._checkout(key, password)
+        try:
+            yield ssh, sftp
+        except Exception:
+            ssh.close()
+            raise
+        self._checkin(key, ssh, sftp)
+
+    def close_idle(self, max_idle=None):
+        max_idle = self.max_idle if max_idle is None else max_idle
+        limit = time.time() - max_idle
+        to_close = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                to_close.extend(entry for entry in idle if entry[2] <= limit)
+                idle[:] = [entry for entry in idle if entry[2] > limit]
+        for ssh, sftp, released in to_close:
+            ssh.close()
+        return len(to_close)
+
+    def close_all(self):
+        """Close every idle session, typically at the end of a backup run."""
+        return self.close_idle(max_idle=-1)
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['handshake_avg'] = stats['handshakes'] and stats['handshake_time'] / stats['handshakes']
+        return stats
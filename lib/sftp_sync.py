@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import os
+import stat
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteFile(object):
+    """Name, size and modification time of a file in a remote snapshot."""
+
+    def __init__(self, filename, st_size, st_mtime, st_mode=stat.S_IFREG):
+        self.filename = filename
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+        self.st_mode = st_mode
+
+
+def remote_snapshot(sftp, path):
+    """List a remote directory once, with the attributes of every entry.
+
+    :return: dict ``{filename: SFTPAttributes}``
+    """
+    return dict((attr.filename, attr) for attr in sftp.listdir_attr(path))
+
+
+def local_snapshot(path, match):
+    """Return ``{filename: os.stat_result}`` for the regular files of ``path`` accepted by ``match``."""
+    snapshot = {}
+    for entry in os.scandir(path):
+        if match(entry.name) and entry.is_file():
+            snapshot[entry.name] = entry.stat()
+    return snapshot
+
+
+def files_to_upload(local, remote):
+    """Names of the local files missing on the remote side or with a different size there.
+
+    A size mismatch means an earlier upload was interrupted, so the file
+    is sent again.
+    """
+    return sorted(name for name, local_stat in local.items()
+                  if name not in remote or remote[name].st_size != local_stat.st_size)
+
+
+def expired_files(remote, match, days_to_keep, now=None):
+    """Names of the regular files of a snapshot accepted by ``match`` and older than ``days_to_keep``."""
+    now = now or datetime.datetime.now()
+    expired = []
+    for name, attr in remote.items():
+        if not match(name) or attr.st_mode is None or not stat.S_ISREG(attr.st_mode):
+            continue
+        if (now - datetime.datetime.fromtimestamp(attr.st_mtime)).days >= days_to_keep:
+            expired.append(name)
+    return sorted(expired)
+
+
+def remove_files(sftp, path, names, snapshot=None):
+    """Delete ``names`` from the remote directory ``path`` and drop them from ``snapshot``.
+
+    :return: the names that could not be deleted
+    """
+    failed = []
+    for name in names:
+        try:
+            sftp.remove(os.path.join(path, name))
+        except IOError as e:
+            logger.info('Function: remove_files - could not delete %s: %s' % (name, e))
+            failed.append(name)
+            continue
+        if snapshot is not None:
+            snapshot.pop(name, None)
+    return failed
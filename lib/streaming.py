@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class PipeClosedError(IOError):
+    """Raised on the writing side once the reading side gave up."""
+
+
+class TeeWriter(object):
+    """Write every block to several file objects."""
+
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+        return len(data)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+
+class SpoolingPipe(object):
+    """In-memory pipe between a producer thread and a consumer, spilling to disk when the consumer lags.
+
+    The writing side is a minimal non-seekable file object, which is what
+    ``zipfile`` and the dump functions expect from their output stream.
+    Up to ``max_buffer`` bytes wait in memory; beyond that the blocks go to
+    a temporary file of at most ``max_spool`` bytes and are read back in
+    order. A slow consumer then lags behind on disk instead of slowing down
+    the producer and, through it, every other consumer of the same dump.
+    Once the spool is full too, the producer waits until the consumer
+    emptied it: the disk used stays bounded. With ``max_spool=0`` the
+    pipe only throttles its producer, like a plain bounded buffer.
+    """
+
+    def __init__(self, max_buffer=64 * 1024 * 1024, max_spool=1024 * 1024 * 1024, chunk_size=CHUNK_SIZE):
+        self.max_buffer = max_buffer
+        self.max_spool = max_spool
+        self.chunk_size = chunk_size
+        self._condition = threading.Condition()
+        # Blocks in memory (bytes) or on the spool file ((offset, size)), in order.
+        self._entries = collections.deque()
+        self._in_memory = 0
+        self._spool = None
+        self._spool_end = 0
+        self._buffer = bytearray()
+        self._aborted = None
+        self.closed = False
+        self.bytes_written = 0
+        self.bytes_spooled = 0
+
+    # Writing side
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def write(self, data):
+        if self._aborted:
+            # Only this consumer gave up, the dump goes on for the others.
+            return len(data)
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.chunk_size:
+            self._put(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        if self._buffer:
+            self._put(bytes(self._buffer))
+        self._buffer = bytearray()
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def _put(self, block):
+        with self._condition:
+            while True:
+                if self._aborted:
+                    return
+                spooling = bool(self._entries) and isinstance(self._entries[-1], tuple)
+                # An empty pipe takes any block, so a block larger than the buffer cannot wait forever.
+                if not spooling and (self._in_memory + len(block) <= self.max_buffer or not self._entries):
+                    self._entries.append(block)
+                    self._in_memory += len(block)
+                    break
+                if self._spool_end + len(block) <= self.max_spool:
+                    if self._spool is None:
+                        self._spool = tempfile.TemporaryFile(prefix='dailybackup-spool-')
+                    self._spool.seek(self._spool_end)
+                    self._spool.write(block)
+                    self._entries.append((self._spool_end, len(block)))
+                    self._spool_end += len(block)
+                    self.bytes_spooled += len(block)
+                    break
+                # Memory and spool are full: wait for the consumer.
+                self._condition.wait()
+            self._condition.notify_all()
+
+    # Reading side
+
+    def abort(self, reason):
+        """Drop everything still buffered and ignore the next writes.
+
+        A consumer still reading gets a PipeClosedError.
+        """
+        with self._condition:
+            self._aborted = reason or 'aborted'
+            self._entries.clear()
+            self._in_memory = 0
+            self._close_spool()
+            self._condition.notify_all()
+
+    def _close_spool(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self._spool_end = 0
+
+    def chunks(self):
+        while True:
+            with self._condition:
+                while not self._entries and not self.closed and not self._aborted:
+                    self._condition.wait()
+                if self._aborted:
+                    self._close_spool()
+                    # The dump did not complete, the consumer must not keep what it got.
+                    raise PipeClosedError('Writing side of the pipe failed: %s' % self._aborted)
+                if not self._entries:
+                    self._close_spool()
+                    return
+                entry = self._entries.popleft()
+                if isinstance(entry, tuple):
+                    self._spool.seek(entry[0])
+                    block = self._spool.read(entry[1])
+                    if not self._entries:
+                        # Caught up with the producer, the spool starts over.
+                        self._close_spool()
+                else:
+                    block = entry
+                    self._in_memory -= len(block)
+                # Room for a producer waiting on a full pipe.
+                self._condition.notify_all()
+            yield block
+
+
+def fan_out(producer, consumers, max_buffer=64 * 1024 * 1024, max_spool=1024 * 1024 * 1024):
+    """Run ``producer(stream)`` once and give its output to every consumer in parallel.
+
+    Each ``consumer(chunks)`` runs on its own thread and reads its own
+    SpoolingPipe, so a slow or failing consumer does not hold up the
+    others until its spool of ``max_spool`` bytes is full. An error of the
+    producer stops every consumer.
+
+    :param consumers: list of callables
+    :return: tuple ``(bytes_written, errors)``, ``errors`` maps the index of
+        every consumer that failed to its exception
+    :raise: the error of the producer
+    """
+    pipes = [SpoolingPipe(max_buffer=max_buffer, max_spool=max_spool) for consumer in consumers]
+    errors = {}
+
+    def run_consumer(index):
+        try:
+            consumers[index](pipes[index].chunks())
+        except Exception as e:
+            if not isinstance(e, PipeClosedError):
+                logger.exception('Function: fan_out - consumer %s failed' % index)
+            errors[index] = e
+            pipes[index].abort(str(e))
+
+    threads = []
+    for index in range(len(consumers)):
+        thread = threading.Thread(target=run_consumer, args=(index,), name='dailybackup-fan-out-%d' % index)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        producer(TeeWriter(*pipes))
+    except Exception as e:
+        for pipe in pipes:
+            pipe.abort(str(e))
+        for thread in threads:
+            thread.join()
+        raise
+    for pipe in pipes:
+        pipe.close()
+    for thread in threads:
+        thread.join()
+    return pipes[0].bytes_written if pipes else 0, errors
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import contextlib
+import ftplib
+import logging
+import os
+import shutil
+import stat
+import time
+
+from .sftp_sync import RemoteFile
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+TMP_EXTENSION = '.part'
+
+
+class Target(object):
+    """A directory backups are copied to.
+
+    Files are written under a temporary name and renamed once complete,
+    so a listing never shows a partial backup under its final name.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def listdir(self):
+        """:return: dict ``{filename: RemoteFile}`` of the directory"""
+        raise NotImplementedError
+
+    def open_write(self, name):
+        """Context manager giving a file object to write ``name`` into."""
+        raise NotImplementedError
+
+    def open_read(self, name):
+        """Context manager giving a file object reading ``name``."""
+        raise NotImplementedError
+
+    def remove(self, name):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def put(self, local_path, name, throttle=None):
+        """Copy a local file to the target, calling ``throttle(size)`` before every block."""
+        with open(local_path, 'rb') as local_file, self.open_write(name) as remote_file:
+            for block in iter(lambda: local_file.read(BLOCK_SIZE), b''):
+                if throttle:
+                    throttle(len(block))
+                remote_file.write(block)
+
+    def remove_files(self, names):
+        """Remove ``names``, return the names that could not be removed."""
+        failed = []
+        for name in names:
+            try:
+                self.remove(name)
+            except Exception as e:
+                logger.info('Function: Target.remove_files - could not remove %s: %s' % (name, e))
+                failed.append(name)
+        return failed
+
+
+class LocalTarget(Target):
+    """A directory of the server, typically a NFS mount or a synced object storage bucket."""
+
+    def listdir(self):
+        snapshot = {}
+        if not os.path.isdir(self.path):
+            return snapshot
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                st = entry.stat()
+                snapshot[entry.name] = RemoteFile(entry.name, st.st_size, st.st_mtime, st.st_mode)
+        return snapshot
+
+    @contextlib.contextmanager
+    def open_write(self, name):
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, name)
+        try:
+            with open(path + TMP_EXTENSION, 'wb') as fp:
+                yield fp
+        except Exception:
+            if os.path.exists(path + TMP_EXTENSION):
+                os.remove(path + TMP_EXTENSION)
+            raise
+        os.replace(path + TMP_EXTENSION, path)
+
+    @contextlib.contextmanager
+    def open_read(self, name):
+        with open(os.path.join(self.path, name), 'rb') as fp:
+            yield fp
+
+    def remove(self, name):
+        os.remove(os.path.join(self.path, name))
+
+    def put(self, local_path, name, throttle=None):
+        if throttle:
+            return super(LocalTarget, self).put(local_path, name, throttle)
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, name)
+        shutil.copyfile(local_path, path + TMP_EXTENSION)
+        os.replace(path + TMP_EXTENSION, path)
+
+
+class SftpTarget(Target):
+    """A directory on a SFTP server, on an open ``SFTPClient``."""
+
+    def __init__(self, sftp, path):
+        super(SftpTarget, self).__init__(path)
+        self.sftp = sftp
+        self._ensure_dir()
+
+    def _ensure_dir(self):
+        try:
+            self.sftp.stat(self.path)
+        except IOError:
+            current = ''
+            for element in self.path.split('/'):
+                current += element + '/'
+                try:
+                    self.sftp.stat(current)
+                except IOError:
+                    self.sftp.mkdir(current)
+
+    def listdir(self):
+        return dict((attr.filename, attr) for attr in self.sftp.listdir_attr(self.path))
+
+    @contextlib.contextmanager
+    def open_write(self, name):
+        path = os.path.join(self.path, name)
+        try:
+            with self.sftp.open(path + TMP_EXTENSION, 'wb') as fp:
+                fp.set_pipelined(True)
+                yield fp
+        except Exception:
+            try:
+                self.sftp.remove(path + TMP_EXTENSION)
+            except IOError:
+                pass
+            raise
+        self.sftp.posix_rename(path + TMP_EXTENSION, path)
+
+    @contextlib.contextmanager
+    def open_read(self, name):
+        with self.sftp.open(os.path.join(self.path, name), 'rb') as fp:
+            fp.prefetch()
+            yield fp
+
+    def remove(self, name):
+        self.sftp.remove(os.path.join(self.path, name))
+
+
+class _SocketWriter(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, data):
+        self.conn.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class FtpTarget(Target):
+    """A directory on a FTP server, optionally over TLS."""
+
+    def __init__(self, host, port, user, password, path, use_tls=False, passive=True, timeout=20):
+        super(FtpTarget, self).__init__(path)
+        self.ftp = ftplib.FTP_TLS(timeout=timeout) if use_tls else ftplib.FTP(timeout=timeout)
+        self.ftp.connect(host, int(port or 21))
+        self.ftp.login(user or 'anonymous', password or '')
+        if use_tls:
+            self.ftp.prot_p()
+        self.ftp.set_pasv(passive)
+        self._ensure_dir()
+
+    def _ensure_dir(self):
+        try:
+            self.ftp.cwd(self.path)
+        except ftplib.error_perm:
+            current = ''
+            for element in self.path.split('/'):
+                current += element + '/'
+                try:
+                    self.ftp.cwd(current)
+                except ftplib.error_perm:
+                    self.ftp.mkd(current)
+            self.ftp.cwd(self.path)
+
+    def listdir(self):
+        snapshot = {}
+        try:
+            entries = list(self.ftp.mlsd(self.path, facts=['type', 'size', 'modify']))
+        except ftplib.error_perm:
+            # No MLSD on the server: one SIZE and MDTM per file.
+            entries = []
+            for name in self.ftp.nlst(self.path):
+                name = os.path.basename(name)
+                path = os.path.join(self.path, name)
+                try:
+                    size = self.ftp.size(path)
+                    modify = self.ftp.sendcmd('MDTM ' + path).split()[-1]
+                except ftplib.error_perm:
+                    continue
+                entries.append((name, {'type': 'file', 'size': size, 'modify': modify}))
+        for name, facts in entries:
+            if facts.get('type', 'file') != 'file':
+                continue
+            mtime = calendar.timegm(time.strptime(facts['modify'][:14], '%Y%m%d%H%M%S'))
+            snapshot[name] = RemoteFile(name, int(facts['size']), mtime, stat.S_IFREG)
+        return snapshot
+
+    @contextlib.contextmanager
+    def open_write(self, name):
+        path = os.path.join(self.path, name)
+        self.ftp.voidcmd('TYPE I')
+        conn = self.ftp.transfercmd('STOR ' + path + TMP_EXTENSION)
+        try:
+            yield _SocketWriter(conn)
+        except Exception:
+            conn.close()
+            try:
+                self.ftp.voidresp()
+                self.ftp.delete(path + TMP_EXTENSION)
+            except ftplib.all_errors:
+                pass
+            raise
+        conn.close()
+        self.ftp.voidresp()
+        self.ftp.rename(path + TMP_EXTENSION, path)
+
+    @contextlib.contextmanager
+    def open_read(self, name):
+        self.ftp.voidcmd('TYPE I')
+        conn = self.ftp.transfercmd('RETR ' + os.path.join(self.path, name))
+        fp = conn.makefile('rb')
+        try:
+            yield fp
+        finally:
+            fp.close()
+            conn.close()
+            try:
+                self.ftp.voidresp()
+            except ftplib.all_errors:
+                pass
+
+    def remove(self, name):
+        self.ftp.delete(os.path.join(self.path, name))
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import re
+import threading
+import time
+
+WINDOW_RE = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$')
+
+
+class TokenBucket(object):
+    """Limit a byte rate shared by several threads.
+
+    The bucket holds up to ``burst`` bytes and refills at ``rate`` bytes
+    per second. ``consume`` takes what it needs right away and sleeps
+    until the bucket would have held it, so concurrent uploads share the
+    rate instead of each getting it in full.
+    """
+
+    def __init__(self, rate, burst=None):
+        self._lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self.configure(rate, burst)
+        self._tokens = self.burst
+        self._last = time.time()
+
+    def configure(self, rate, burst=None):
+        with self._lock:
+            self.rate = float(rate)
+            self.burst = float(burst or rate)
+
+    def consume(self, amount):
+        """Block until ``amount`` bytes may be sent."""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(key, rate, burst=None):
+    """Shared bucket of ``key`` (e.g. the SFTP host), None when ``rate`` is not limited."""
+    if not rate or rate <= 0:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate, burst)
+        elif bucket.rate != rate or bucket.burst != float(burst or rate):
+            bucket.configure(rate, burst)
+        return bucket
+
+
+def put_callback(throttle):
+    """Callback for ``SFTPClient.put`` that throttles with ``throttle(bytes)``."""
+    sent = [0]
+
+    def callback(transferred, total):
+        throttle(transferred - sent[0])
+        sent[0] = transferred
+    return callback
+
+
+def parse_windows(text):
+    """Parse time windows such as ``"22:00-06:00, 12:00-13:30"``.
+
+    A window may go over midnight.
+
+    :return: list of ``(start_minute, end_minute)`` tuples
+    :raise ValueError: when a window is malformed
+    """
+    windows = []
+    for part in (text or '').split(','):
+        part = part.strip().replace(' ', '')
+        if not part:
+            continue
+        match = WINDOW_RE.match(part)
+        if not match:
+            raise ValueError('Invalid time window %r, expected HH:MM-HH:MM' % part)
+        start_hour, start_minute, end_hour, end_minute = [int(value) for value in match.groups()]
+        if start_hour > 23 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+            raise ValueError('Invalid time window %r' % part)
+        windows.append((start_hour * 60 + start_minute, end_hour * 60 + end_minute))
+    return windows
+
+
+def seconds_until_window(windows, now=None):
+    """Seconds to wait before one of the ``windows`` opens, 0 inside a window or without windows.
+
+    :param now: naive local datetime, the current time by default
+    """
+    if not windows:
+        return 0
+    now = now or datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    waits = []
+    for start, end in windows:
+        if start <= end:
+            inside = start <= minute < end
+        else:
+            inside = minute >= start or minute < end
+        if inside:
+            return 0
+        waits.append((start - minute) % (24 * 60))
+    return min(waits) * 60 - now.second
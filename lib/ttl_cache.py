@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+
+class TtlCache(object):
+    """Thread-safe cache whose entries expire ``ttl`` seconds after being loaded."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader, ttl=None):
+        """Return the cached value of ``key``, calling ``loader()`` when it is missing or expired."""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] < ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Load outside the lock, a slow server must not block the other keys.
+        value = loader()
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+        return value
+
+    def invalidate(self, key=None):
+        """Forget ``key``, or every entry when no key is given."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TaskResult(object):
+    """Outcome of one task run by the KeyedWorkerPool."""
+
+    def __init__(self, label, key):
+        self.label = label
+        self.key = key
+        self.ok = False
+        self.result = None
+        self.error = None
+        self.duration = 0.0
+
+
+class KeyedWorkerPool(object):
+    """Run callables on a bounded number of threads.
+
+    Every task carries a key (for example the database host). At most
+    ``max_workers`` tasks run at the same time, and at most ``max_per_key``
+    of them share the same key. A task whose key is saturated is skipped
+    over, so a busy host never blocks tasks for the other hosts.
+    """
+
+    def __init__(self, max_workers=4, max_per_key=2):
+        self.max_workers = max(1, int(max_workers or 1))
+        self.max_per_key = max(1, int(max_per_key or 1))
+        self._condition = threading.Condition()
+        self._pending = []
+        self._running = {}
+        self._results = []
+
+    def _next_task(self):
+        # Called with the condition held.
+        while True:
+            if not self._pending:
+                return None
+            for index, task in enumerate(self._pending):
+                if self._running.get(task[0], 0) < self.max_per_key:
+                    self._running[task[0]] = self._running.get(task[0], 0) + 1
+                    return self._pending.pop(index)
+            self._condition.wait()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                task = self._next_task()
+            if task is None:
+                return
+            key, label, fnct, args = task
+            result = TaskResult(label, key)
+            start = time.time()
+            try:
+                result.result = fnct(*args)
+                result.ok = True
+            except Exception as e:
+                logger.exception('Function: KeyedWorkerPool - task %s failed' % label)
+                result.error = str(e)
+            result.duration = time.time() - start
+            with self._condition:
+                self._running[key] -= 1
+                self._results.append(result)
+                self._condition.notify_all()
+
+    def run(self, tasks):
+        """Run ``tasks`` and block until all of them are done.
+
+        :param tasks: iterable of ``(key, label, callable, args)`` tuples
+        :return: tuple ``(results, wall_clock_seconds)``
+        """
+        self._pending = list(tasks)
+        self._running = {}
+        self._results = []
+        start = time.time()
+        threads = []
+        for index in range(min(self.max_workers, len(self._pending))):
+            thread = threading.Thread(target=self._worker, name='dailybackup-worker-%d' % index)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return self._results, time.time() - start
+
+
+class KeySlots(object):
+    """Count the tasks running per key, for workers that pick their own tasks."""
+
+    def __init__(self, max_per_key=2):
+        self.max_per_key = max(1, int(max_per_key or 1))
+        self._lock = threading.Lock()
+        self._running = {}
+
+    def full_keys(self):
+        with self._lock:
+            return [key for key, count in self._running.items() if count >= self.max_per_key]
+
+    def acquire(self, key):
+        """Take a slot for ``key``, return False when it has none left."""
+        with self._lock:
+            if self._running.get(key, 0) >= self.max_per_key:
+                return False
+            self._running[key] = self._running.get(key, 0) + 1
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._running[key] -= 1
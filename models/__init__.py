@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from . import backup_artifact
+from . import backup_run
+from . import backup_job
+from . import bandwidth_limit
 from . import backupprocess
-
+from . import backup_target
+from . import backup_restore
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, tools, _
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import re
+import time
+
+from ..lib import chunking
+from ..lib import compression
+from ..lib import integrity
+from ..lib import physical
+from ..lib.multipart_upload import STATE_EXTENSION
+
+logger = logging.getLogger(__name__)
+
+# <timestamp>_<database>.<type>[.<compression>], as written by the backups.
+BACKUP_FILE_RE = re.compile(r'^(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2})_(.+)\.(zip|dump|incremental|physical)(\.zst|\.lz4)?$')
+
+
+def parse_backup_filename(filename):
+    """Split a backup file name.
+
+    :return: tuple ``(utc_datetime, database)``, or None when the name is not one of ours
+    """
+    match = BACKUP_FILE_RE.match(filename)
+    if not match:
+        return None
+    # The timestamp in the name is in the local time of the server.
+    local_time = time.strptime(match.group(1), '%Y_%m_%d_%H_%M_%S')
+    return datetime.datetime.utcfromtimestamp(time.mktime(local_time)), match.group(2)
+
+
+class BackupArtifact(models.Model):
+    _name = 'dailybackup.backup.artifact'
+    _description = 'Backup file'
+    _order = 'backup_date desc, id desc'
+
+    name = fields.Char('File name', required=True)
+    backup_id = fields.Many2one('dailybackup.backupprocess', 'Backup configuration', ondelete='cascade', index=True)
+    database = fields.Char('Database', index=True)
+    path = fields.Char('Path', help='Full path of the file, on the local or on the remote server.')
+    location = fields.Selection([('local', 'Local'), ('remote', 'Remote')], 'Location', required=True,
+                                default='local', index=True)
+    target_id = fields.Many2one('dailybackup.backup.target', 'Target', ondelete='set null', index=True,
+                                help='Other target the file was sent to, empty for the SFTP server of the backup.')
+    size = fields.Float('Size (bytes)', digits=(20, 0))
+    checksum = fields.Char('Checksum', help='Computed while the backup was written.')
+    checksum_algorithm = fields.Selection([('sha256', 'SHA-256'), ('blake3', 'BLAKE3')], 'Checksum algorithm',
+                                          default='sha256')
+    checksum_verified = fields.Boolean('Remote checksum verified',
+                                       help='The SFTP server computed the same checksum after the upload.')
+    check_state = fields.Selection([('unchecked', 'Not checked'), ('ok', 'Restorable'), ('corrupt', 'Corrupt')],
+                                   'Restore check', default='unchecked', required=True, index=True)
+    check_date = fields.Datetime('Checked on')
+    check_message = fields.Text('Check result')
+    backup_date = fields.Datetime('Created on', required=True, index=True, default=fields.Datetime.now)
+    state = fields.Selection([('present', 'Present'), ('deleted', 'Deleted')], 'State', default='present',
+                             required=True, index=True)
+
+    @api.model
+    def _record(self, backup, path, location='local', size=None, checksum=None, backup_date=None,
+                algorithm='sha256', verified=False, target=None):
+        """Add a file produced or uploaded by ``backup`` to the catalog."""
+        name = os.path.basename(path)
+        if size is None and location == 'local' and os.path.exists(path):
+            size = os.path.getsize(path)
+        artifact = self.create({
+            'name': name,
+            'backup_id': backup.id,
+            'database': backup.name,
+            'path': path,
+            'location': location,
+            'size': size or 0,
+            'checksum': checksum,
+            'checksum_algorithm': algorithm,
+            'checksum_verified': verified,
+            'target_id': target.id if target else False,
+            'backup_date': backup_date or fields.Datetime.now(),
+        })
+        logger.info('Function: _record - Parameters: path: %s - location: %s - size: %s' % (path, location, size))
+        return artifact
+
+    @api.model
+    def _record_committed(self, backup, path, target=None, **values):
+        """Same as ``_record``, on a cursor of its own committed at once.
+
+        Used for the files an upload job copied before it failed: its own
+        transaction is rolled back, while the files stay on the server.
+        """
+        with self.env['dailybackup.backupprocess']._new_env() as env:
+            return env[self._name]._record(env[backup._name].browse(backup.id), path,
+                                           target=target and env[target._name].browse(target.id), **values).id
+
+    @api.multi
+    def _delete_local_files(self):
+        """Delete the local files of the artifacts and mark them as deleted."""
+        for artifact in self.filtered(lambda a: a.location == 'local'):
+            logger.info("Delete local out-of-date file: " + artifact.path)
+            for path in (artifact.path, artifact.path + STATE_EXTENSION):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self.write({'state': 'deleted'})
+        return True
+
+    @api.multi
+    @contextlib.contextmanager
+    def _open(self):
+        """Open the backup file for reading, on the local disk, on the SFTP server or on its target."""
+        self.ensure_one()
+        if self.location == 'local':
+            with open(self.path, 'rb') as fp:
+                yield fp
+            return
+        if self.target_id:
+            with self.target_id._connect() as target, target.open_read(self.name) as fp:
+                yield fp
+            return
+        with self.backup_id._sftp_session() as (s, sftp):
+            with sftp.open(self.path, 'rb') as fp:
+                fp.prefetch()
+                yield fp
+
+    @api.multi
+    def _missing_chunks(self, manifest):
+        """Chunks of an incremental manifest that are not in the chunk store next to it."""
+        self.ensure_one()
+        chunks_path = os.path.join(os.path.dirname(self.path), chunking.CHUNKS_DIRECTORY)
+        if self.location == 'local':
+            present = set(os.listdir(chunks_path)) if os.path.isdir(chunks_path) else set()
+        else:
+            with self.backup_id._sftp_session() as (s, sftp):
+                try:
+                    present = set(sftp.listdir(chunks_path))
+                except IOError:
+                    present = set()
+        return chunking.manifest_chunks(manifest) - present
+
+    @api.multi
+    def _check_restore(self):
+        """Check that the backup could be restored, without restoring it.
+
+        Zip archives are opened and every member is checked against its
+        CRC, dumps are read by ``pg_restore --list`` and incremental
+        manifests must find all their chunks. The file is read once, and
+        the checksum computed while writing it is compared on the way;
+        an uncompressed local archive is checked where it is, then read
+        again for its checksum, rather than copied to a temporary file.
+        """
+        self.ensure_one()
+        artifact = self
+        try:
+            with artifact._open() as fp:
+                reader = integrity.HashingReader(fp, artifact.checksum_algorithm or 'sha256')
+                codec = compression.codec_of(artifact.name)
+                data = compression.open_reader(reader, codec) if codec else reader
+                # zipfile can seek in the local file itself.
+                archive = fp if artifact.location == 'local' and not codec else data
+                if artifact.name.endswith('.' + chunking.MANIFEST_EXTENSION):
+                    missing = artifact._missing_chunks(json.loads(data.read().decode('utf-8')))
+                    if missing:
+                        raise integrity.IntegrityError('%s chunks are missing' % len(missing))
+                    message = _('All the chunks are present.')
+                elif '.physical' in artifact.name:
+                    manifest = integrity.verify_zip(archive, required=('manifest.json', physical.BASE_MEMBER))
+                    message = _('Base backup of PostgreSQL %s starting at WAL %s.') % (
+                        manifest.get('pg_version'), manifest.get('wal_start'))
+                elif '.zip' in artifact.name:
+                    manifest = integrity.verify_zip(archive)
+                    message = _('Archive of %s (Odoo %s) with %s modules.') % (
+                        manifest.get('db_name'), manifest.get('version'), len(manifest.get('modules', {})))
+                else:
+                    entries = integrity.list_pg_archive(
+                        data, [tools.find_pg_tool('pg_restore'), '--list'], env=tools.exec_pg_environ())
+                    message = _('pg_restore lists %s entries.') % entries
+                if archive is fp and not reader.size:
+                    # zipfile read the file itself, the hash is computed on a second pass.
+                    fp.seek(0)
+                reader.drain()
+            if artifact.checksum and reader.hexdigest() != artifact.checksum:
+                raise integrity.IntegrityError(_('The %s checksum of the file changed since it was written.') %
+                                               artifact.checksum_algorithm)
+            state = 'ok'
+        except Exception as e:
+            logger.exception('Function: _check_restore - %s failed its restore check' % artifact.path)
+            state, message = 'corrupt', str(e)
+        artifact.write({'check_state': state, 'check_date': fields.Datetime.now(), 'check_message': message})
+        logger.info('Function: _check_restore - Parameters: path: %s - location: %s - state: %s' % (
+            artifact.path, artifact.location, state))
+        return state == 'ok'
+
+    @api.model
+    def _run_restore_checks(self, sample=None):
+        """Check a few backups on every call, those checked the longest ago first."""
+        if sample is None:
+            sample = int(self.env['ir.config_parameter'].sudo().get_param('dailybackup.restore_check_sample',
+                                                                          default=2))
+        self.env.cr.execute("""
+            SELECT id
+              FROM dailybackup_backup_artifact
+             WHERE state = 'present'
+             ORDER BY check_date ASC NULLS FIRST, backup_date DESC
+             LIMIT %s
+        """, (sample,))
+        artifacts = self.browse([row[0] for row in self.env.cr.fetchall()])
+        for artifact in artifacts:
+            artifact._check_restore()
+            # A long check must not lose the ones before it.
+            self.env.cr.commit()
+        return True
+
+    @api.multi
+    def action_check_restore(self):
+        for artifact in self:
+            artifact._check_restore()
+        return True
+
+    @api.multi
+    def action_restore(self):
+        """Open a new restore of the file."""
+        self.ensure_one()
+        action = self.env.ref('dailybackup.backup_restore_action').read()[0]
+        action['views'] = [(False, 'form')]
+        action['context'] = {'default_artifact_id': self.id, 'default_name': '%s_restored' % self.database}
+        return action
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, _
+from odoo.exceptions import Warning
+
+import datetime
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+import psycopg2
+from psycopg2 import errorcodes
+
+from ..lib import metrics
+from .backupprocess import SFTP_POOL
+from ..lib.worker_pool import KeyedWorkerPool, KeySlots
+
+logger = logging.getLogger(__name__)
+
+JOB_TYPES = [('dump', 'Dump'), ('upload', 'Upload'), ('prune', 'Prune'), ('notify', 'Notify')]
+# Errors of a transaction that lost a race with another one, it may simply be run again.
+CONCURRENCY_ERRORS = (errorcodes.LOCK_NOT_AVAILABLE, errorcodes.SERIALIZATION_FAILURE,
+                      errorcodes.DEADLOCK_DETECTED)
+OUTCOME_TRIES = 5
+# Seconds a finished job is kept from the other workers while its outcome is stored.
+OUTCOME_LEASE = 3600
+
+
+class BackupJob(models.Model):
+    """One step of the backup of a record, run by the backup job worker.
+
+    A scheduled run only creates the ``dump`` job of every record; each
+    job queues the next step of its record when it is done. After the dump
+    every destination of the record goes through its own jobs, and the
+    final ones (the mail) wait for all of them. Jobs are
+    committed one by one, so a worker that is killed loses at most the job
+    it was running. Its attempt is committed before it runs, so that job
+    is picked up again after the retry delay, and fails once it used all
+    its attempts.
+    """
+    _name = 'dailybackup.backup.job'
+    _description = 'Backup job'
+    _order = 'priority, size, id'
+
+    name = fields.Char('Job', required=True)
+    backup_id = fields.Many2one('dailybackup.backupprocess', 'Backup configuration', required=True,
+                                ondelete='cascade', index=True)
+    host = fields.Char('Host', related='backup_id.host', store=True)
+    run_id = fields.Many2one('dailybackup.backup.run', 'Run', ondelete='cascade', index=True)
+    line_id = fields.Many2one('dailybackup.backup.run.line', 'Run record', ondelete='cascade', index=True)
+    target_id = fields.Many2one('dailybackup.backup.target', 'Target', ondelete='cascade', index=True,
+                                help='Other target the job uploads to or prunes, empty for the SFTP server and the '
+                                     'local folder of the backup.')
+    job_type = fields.Selection(JOB_TYPES, 'Type', required=True)
+    state = fields.Selection([('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed'),
+                              ('cancelled', 'Cancelled')], 'State', default='pending', required=True, index=True)
+    priority = fields.Integer('Priority', default=10, help='Jobs with a lower priority are run first.')
+    size = fields.Float('Size (bytes)', digits=(20, 0),
+                        help='Size of the last backup of the record, among jobs of the same priority the '
+                             'smallest run first.')
+    eta = fields.Datetime('Not before', index=True, help='A job that failed waits until then for its next attempt.')
+    attempts = fields.Integer('Attempts')
+    max_attempts = fields.Integer('Max. attempts', default=3)
+    date_started = fields.Datetime('Last started on')
+    date_done = fields.Datetime('Done on')
+    duration = fields.Float('Duration (s)')
+    worker = fields.Char('Worker')
+    result = fields.Char('Result', help='Path of the backup written by a dump job.')
+    error = fields.Text('Error')
+
+    @api.model
+    def _get_retry_settings(self):
+        params = self.env['ir.config_parameter'].sudo()
+        max_attempts = int(params.get_param('dailybackup.job_max_attempts', default=3))
+        retry_delay = int(params.get_param('dailybackup.job_retry_delay', default=300))
+        return max_attempts, retry_delay
+
+    @api.model
+    def _enqueue_run(self, records):
+        """Start a run: one run line and one dump job per record.
+
+        Records still busy with a previous run are left out.
+        """
+        busy = self.search([('backup_id', 'in', records.ids), ('state', '=', 'pending')]).mapped('backup_id')
+        records -= busy
+        run = self.env['dailybackup.backup.run'].create({'name': fields.Datetime.now()})
+        for rec in records:
+            line = self.env['dailybackup.backup.run.line'].create({
+                'run_id': run.id,
+                'backup_id': rec.id,
+                'database': rec.name,
+            })
+            self._enqueue(rec, 'dump', line)
+        if busy:
+            logger.info('Function: _enqueue_run - still busy with a previous run: %s' % ', '.join(busy.mapped('name')))
+        logger.info('Function: _enqueue_run - Parameters: run: %s - records: %s' % (run.name, len(records)))
+        if not records:
+            run._finish(0.0)
+        return run
+
+    @api.model
+    def _enqueue(self, backup, job_type, line, error=None, target=None):
+        max_attempts, retry_delay = self._get_retry_settings()
+        last_backup = self.env['dailybackup.backup.artifact'].search([('backup_id', '=', backup.id)], limit=1)
+        name = '%s: %s' % (backup.name, dict(JOB_TYPES)[job_type])
+        if target:
+            name += ' (%s)' % target.name
+        return self.create({
+            'name': name,
+            'backup_id': backup.id,
+            'run_id': line.run_id.id,
+            'line_id': line.id,
+            'target_id': target.id if target else False,
+            'job_type': job_type,
+            'priority': backup.upload_priority,
+            'size': last_backup.size,
+            'max_attempts': max_attempts,
+            'error': error,
+        })
+
+    @api.model
+    def _claim(self, full_hosts=()):
+        """Lock the next job that can run now, skipping the jobs locked by other workers.
+
+        The row lock is held by the transaction of this environment until
+        the job is finished: when the worker dies the lock goes away and the
+        job, still pending, is claimed again. ``FOR NO KEY UPDATE`` still
+        lets the job cursor insert rows referring to the job.
+
+        :param full_hosts: hosts that already run as many jobs as they may
+        """
+        query = """
+            SELECT id
+              FROM dailybackup_backup_job
+             WHERE state = 'pending'
+               AND (eta IS NULL OR eta <= %s)
+        """
+        params = [fields.Datetime.now()]
+        if full_hosts:
+            query += " AND COALESCE(host, '') NOT IN %s"
+            params.append(tuple(full_hosts))
+        query += " ORDER BY priority, size, id LIMIT 1 FOR NO KEY UPDATE SKIP LOCKED"
+        self.env.cr.execute(query, params)
+        row = self.env.cr.fetchone()
+        return self.browse(row and row[0])
+
+    @api.model
+    def _retry_eta(self, attempts):
+        """Time of the next attempt of a job that used ``attempts``: exponential backoff."""
+        max_attempts, retry_delay = self._get_retry_settings()
+        return fields.Datetime.now() + datetime.timedelta(seconds=retry_delay * 2 ** (max(attempts, 1) - 1))
+
+    @api.multi
+    def _start_attempt(self):
+        """Count the attempt and commit it before the job runs, then lock the job again.
+
+        The job gets the ``eta`` of its next attempt right away: when the
+        worker is killed while running it (``limit_time_real``, out of
+        memory, restart) it is picked up after the retry delay, like a job
+        that failed. While it runs, the lock keeps other workers off it.
+
+        :return: False when another worker took the job meanwhile
+        """
+        self.ensure_one()
+        attempts = self.attempts + 1
+        self.write({
+            'attempts': attempts,
+            'eta': self._retry_eta(attempts),
+            'date_started': fields.Datetime.now(),
+            'worker': self._worker_name(),
+        })
+        self.env.cr.commit()
+        self.env.cr.execute("SELECT id FROM dailybackup_backup_job WHERE id = %s AND state = 'pending' "
+                            "FOR NO KEY UPDATE SKIP LOCKED", (self.id,))
+        return bool(self.env.cr.fetchone())
+
+    @api.multi
+    def _execute(self):
+        """Run the job on a cursor of its own, then store its outcome on another short one.
+
+        The locking cursor stays open as long as the job runs: it must not
+        write the run record, which the other branches of the record write
+        meanwhile.
+        """
+        self.ensure_one()
+        job = self
+        backup_model = self.env['dailybackup.backupprocess']
+        started = fields.Datetime.now()
+        wait = job._seconds_until_upload_window()
+        if wait:
+            # Not an attempt: the job just waits for the upload window of its server.
+            job.write({'eta': fields.Datetime.now() + datetime.timedelta(seconds=wait)})
+            logger.info('Function: _execute - job %s waits %ss for its upload window' % (job.name, wait))
+            return False
+        if job.attempts >= job.max_attempts:
+            # The last attempt never finished: its worker was killed.
+            job._failed(_('The worker running the job stopped before it finished (%s attempts).') % job.attempts,
+                        started, 0.0)
+            return True
+        if not job._start_attempt():
+            return False
+        record_metrics = metrics.start_record()
+        logger.info('Function: _execute - Parameters: job: %s - attempt: %s' % (job.name, job.attempts))
+        result = error = None
+        try:
+            with backup_model._new_env() as env:
+                backup = env['dailybackup.backupprocess'].browse(job.backup_id.id)
+                result = getattr(backup, '_job_%s' % job.job_type)(job.with_env(env))
+        except Exception as e:
+            logger.exception('Function: _execute - job %s failed' % job.name)
+            record_metrics.fail(e)
+            error = e
+        finally:
+            metrics.stop_record()
+        # Release the lock of the job, with an eta that keeps the other workers off it until the outcome is
+        # stored: the eta of the attempt may already have passed during a long dump or upload.
+        job.write({'eta': fields.Datetime.now() + datetime.timedelta(seconds=OUTCOME_LEASE)})
+        self.env.cr.commit()
+        job._store_outcome(result, error, started, record_metrics)
+        return True
+
+    @api.multi
+    def _store_outcome(self, result, error, started, record_metrics):
+        """Store the outcome of the job and the metrics of its record on a new, short transaction.
+
+        Two branches of a record ending at the same time both update its
+        run record: the one that loses the race fails to serialize and is
+        run again, so it sees the other branch done.
+        """
+        self.ensure_one()
+        for attempt in range(1, OUTCOME_TRIES + 1):
+            try:
+                with self.env['dailybackup.backupprocess']._new_env() as env:
+                    env.invalidate_all()
+                    job = self.with_env(env)
+                    job.line_id._lock()
+                    if error is None:
+                        job._done(result, started, record_metrics.duration())
+                    else:
+                        job._failed(error, started, record_metrics.duration())
+                    job.line_id._add_metrics(record_metrics)
+                return True
+            except psycopg2.OperationalError as e:
+                if e.pgcode not in CONCURRENCY_ERRORS or attempt == OUTCOME_TRIES:
+                    raise
+                logger.info('Function: _store_outcome - job %s: concurrent update, attempt %s' % (self.name, attempt))
+                time.sleep(random.uniform(0.1, 0.5 * attempt))
+
+    @api.multi
+    def _seconds_until_upload_window(self):
+        """Seconds the job waits for the upload window of the server it sends data to, 0 when it may run now.
+
+        A streamed dump waits until the last of its destinations opens.
+        """
+        self.ensure_one()
+        backup = self.backup_id
+        if self.job_type == 'upload':
+            if self.target_id:
+                return self.target_id._seconds_until_upload_window()
+            return backup._seconds_until_upload_window()
+        if self.job_type == 'dump' and backup._streams_dump():
+            waits = [target._seconds_until_upload_window() for target in backup.target_ids]
+            if backup.sftp_write is True:
+                waits.append(backup._seconds_until_upload_window())
+            return max(waits or [0])
+        return 0
+
+    @api.multi
+    def _line_busy(self):
+        """Tell whether other jobs of the run record are still pending.
+
+        The run record is locked first, so of two branches ending at the
+        same time the second one waits for the first one, then sees it
+        done when its transaction is run again (see ``_store_outcome``).
+        """
+        self.ensure_one()
+        self.line_id._lock()
+        return bool(self.search_count([('line_id', '=', self.line_id.id), ('state', '=', 'pending'),
+                                       ('id', '!=', self.id)]))
+
+    @api.multi
+    def _next_steps(self):
+        """Steps of the plan of the record to queue now that this job is done.
+
+        :return: list of ``(job_type, target)``
+        """
+        self.ensure_one()
+        branches, final = self.backup_id._job_plan()
+        if self.job_type == 'dump':
+            return [branch[0] for branch in branches] or final[:1]
+        step = (self.job_type, self.target_id.id)
+        for chain in branches + [final]:
+            steps = [(job_type, target.id) for job_type, target in chain]
+            if step in steps:
+                index = steps.index(step)
+                if index + 1 < len(chain):
+                    return [chain[index + 1]]
+                if chain is final:
+                    return []
+                break
+        # End of a branch: the final steps wait for the other branches.
+        if self._line_busy():
+            return []
+        return final[:1]
+
+    @api.multi
+    def _done(self, result, started, duration):
+        self.ensure_one()
+        self.write({
+            'state': 'done',
+            'date_started': started,
+            'date_done': fields.Datetime.now(),
+            'duration': duration,
+            'worker': self._worker_name(),
+            'result': result if isinstance(result, str) else False,
+        })
+        if result is False:
+            # Nothing to back up (the database is gone), the record stops here.
+            self.line_id.write({'state': 'skipped'})
+            return True
+        steps = self._next_steps()
+        for job_type, target in steps:
+            self._enqueue(self.backup_id, job_type, self.line_id, target=target)
+        if not steps and self.line_id.state == 'queued' and not self._line_busy():
+            self.line_id.write({'state': 'done'})
+        return True
+
+    @api.multi
+    def _failed(self, error, started, duration):
+        """Retry the job later with an exponential backoff, or give up after ``max_attempts``.
+
+        The attempt was already counted by ``_start_attempt``.
+        """
+        self.ensure_one()
+        attempts = self.attempts
+        values = {
+            'date_started': started,
+            'duration': duration,
+            'worker': self._worker_name(),
+            'error': str(error),
+        }
+        if attempts < self.max_attempts:
+            values['eta'] = self._retry_eta(attempts)
+            self.write(values)
+            logger.info('Function: _failed - job %s will be retried at %s' % (self.name, values['eta']))
+            return True
+
+        values['state'] = 'failed'
+        self.write(values)
+        self.line_id.write({'state': 'failed'})
+        if self.job_type != 'notify' and not self._line_busy():
+            # The other destinations are done: the final steps report the failure.
+            for job_type, target in self.backup_id._job_plan()[1][:1]:
+                self._enqueue(self.backup_id, job_type, self.line_id, error=str(error), target=target)
+        return True
+
+    @api.model
+    def _worker_name(self):
+        return '%s:%s:%s' % (socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+    @api.model
+    def run_backup_jobs(self, max_seconds=None):
+        """Run pending jobs on parallel threads, called by the backup job worker cron.
+
+        New jobs are claimed until ``max_seconds`` (the
+        ``dailybackup.job_tick_seconds`` parameter by default) have passed,
+        so every tick stays short; whatever is left waits for the next tick.
+        """
+        if max_seconds is None:
+            max_seconds = int(self.env['ir.config_parameter'].sudo().get_param(
+                'dailybackup.job_tick_seconds', default=60))
+        max_workers, max_workers_per_host = self.env['dailybackup.backupprocess']._get_worker_limits()
+        deadline = time.time() + max_seconds
+        slots = KeySlots(max_per_key=max_workers_per_host)
+
+        pool = KeyedWorkerPool(max_workers=max_workers, max_per_key=1)
+        tasks = [(index, 'job worker %s' % index, self._work, (deadline, slots)) for index in range(max_workers)]
+        SFTP_POOL.reset_stats()
+        try:
+            results, wall_clock = pool.run(tasks)
+        finally:
+            # The cron worker may wait long for its next tick: do not keep the sessions open meanwhile.
+            SFTP_POOL.close_all()
+        processed = sum(result.result or 0 for result in results)
+
+        with self.env['dailybackup.backupprocess']._new_env() as env:
+            env['dailybackup.backup.run']._finish_completed()
+        if processed:
+            logger.info('Function: run_backup_jobs - %s jobs done in %.1fs' % (processed, wall_clock))
+            logger.info('Function: run_backup_jobs - SFTP sessions: %(handshakes)s handshakes '
+                        '(%(handshake_avg).2fs on average), %(reused)s reused, %(reconnects)s reconnected, '
+                        '%(failures)s failed attempts' % SFTP_POOL.summary())
+        return processed
+
+    @api.model
+    def _work(self, deadline, slots):
+        """Claim and run jobs one by one until the deadline or until none is left."""
+        backup_model = self.env['dailybackup.backupprocess']
+        processed = 0
+        while time.time() < deadline:
+            try:
+                with backup_model._new_env() as env:
+                    job = env[self._name]._claim(slots.full_keys())
+                    if not job:
+                        break
+                    host = job.host or ''
+                    if not slots.acquire(host):
+                        # Another thread took the last slot of the host meanwhile.
+                        env.cr.rollback()
+                        continue
+                    try:
+                        if job._execute():
+                            processed += 1
+                    finally:
+                        slots.release(host)
+            except psycopg2.OperationalError as e:
+                if e.pgcode not in CONCURRENCY_ERRORS:
+                    raise
+                # Another worker changed the job meanwhile, it is looked at again on the next claim.
+                logger.info('Function: _work - concurrent update, claiming again: %s' % e)
+        return processed
+
+    @api.multi
+    def action_retry(self):
+        self.filtered(lambda job: job.state in ('failed', 'cancelled')).write({
+            'state': 'pending',
+            'eta': False,
+            'attempts': 0,
+        })
+        self.mapped('line_id').filtered(lambda line: line.state == 'failed').write({'state': 'queued'})
+        self.mapped('run_id').filtered(lambda run: run.state != 'running').write({'state': 'running'})
+        return True
+
+    @api.multi
+    def action_cancel(self):
+        jobs = self.filtered(lambda job: job.state == 'pending')
+        if len(jobs) != len(self):
+            raise Warning(_('Only pending jobs can be cancelled.'))
+        jobs.write({'state': 'cancelled'})
+        jobs.mapped('line_id').write({'state': 'failed'})
+        return True
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, tools, _
+from odoo.exceptions import ValidationError, Warning
+import odoo
+
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+import psycopg2
+
+from ..lib import chunking
+from ..lib import compression
+from ..lib import restore as restore_lib
+
+logger = logging.getLogger(__name__)
+
+DBNAME_RE = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9_.-]+$')
+
+
+class BackupRestore(models.Model):
+    """Restore of a backup file into a new database of this server, run by the restore cron.
+
+    The file is streamed from where it is stored, decompressed on the
+    way. Dumps are restored by ``pg_restore --jobs``; zip archives feed
+    their SQL dump to psql straight from the archive while the filestore
+    is extracted by several threads at the same time. Progress is
+    committed on a cursor of its own, so the form shows it while the
+    restore runs.
+    """
+    _name = 'dailybackup.backup.restore'
+    _description = 'Backup restore'
+    _order = 'id desc'
+
+    @api.model
+    def _default_jobs(self):
+        params = self.env['ir.config_parameter'].sudo()
+        return int(params.get_param('dailybackup.restore_jobs', default=0)) or min(os.cpu_count() or 1, 8)
+
+    @api.model
+    def _default_extract_threads(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param('dailybackup.restore_extract_threads',
+                                                                     default=4))
+
+    name = fields.Char('New database', required=True,
+                       help='Database created by the restore, it must not exist yet.')
+    artifact_id = fields.Many2one('dailybackup.backup.artifact', 'Backup file', required=True, ondelete='cascade',
+                                  domain=[('state', '=', 'present')])
+    backup_id = fields.Many2one('dailybackup.backupprocess', 'Backup configuration', related='artifact_id.backup_id',
+                                store=True)
+    copy = fields.Boolean('This database is a copy', default=True,
+                          help='Give the restored database a new UUID, like Odoo does for a copy, so it does not '
+                               'collide with the original one (e.g. for the enterprise subscription).')
+    jobs = fields.Integer('Parallel restore jobs', default=_default_jobs,
+                          help='Connections pg_restore uses at the same time for a dump backup.')
+    extract_threads = fields.Integer('Filestore threads', default=_default_extract_threads,
+                                     help='Threads extracting the filestore of a zip backup, while its SQL dump is '
+                                          'restored.')
+    state = fields.Selection([('draft', 'Draft'), ('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'),
+                              ('failed', 'Failed')], 'State', default='draft', required=True, index=True)
+    stage = fields.Selection([('download', 'Download'), ('restore', 'Database and filestore'),
+                              ('finalize', 'Loading the registry')], 'Stage')
+    download_progress = fields.Float('Download (%)')
+    database_progress = fields.Float('Database (%)')
+    filestore_progress = fields.Float('Filestore (%)')
+    bytes_total = fields.Float('File size (bytes)', digits=(20, 0))
+    bytes_done = fields.Float('Downloaded (bytes)', digits=(20, 0))
+    date_start = fields.Datetime('Started on')
+    date_done = fields.Datetime('Done on')
+    duration = fields.Float('Duration (s)')
+    error = fields.Text('Error')
+
+    @api.constrains('name')
+    def _check_name(self):
+        for rec in self:
+            if not DBNAME_RE.match(rec.name or ''):
+                raise ValidationError(_('%s is not a valid database name: use letters, digits, "_", "-" and ".".')
+                                      % rec.name)
+
+    @api.constrains('artifact_id')
+    def _check_artifact(self):
+        for rec in self:
+            name = rec.artifact_id.name
+            if '.physical' in name:
+                raise ValidationError(_('Physical backups restore a whole PostgreSQL cluster, use '
+                                        'restore_physical_backup for them.'))
+            if name.endswith('.' + chunking.MANIFEST_EXTENSION) and rec.artifact_id.location != 'local':
+                raise ValidationError(_('Incremental backups can only be restored from the local folder, where '
+                                        'their chunks are.'))
+
+    @api.multi
+    def action_start(self):
+        for rec in self:
+            if odoo.service.db.exp_db_exist(rec.name):
+                raise Warning(_('The database %s already exists.') % rec.name)
+        self.write({'state': 'queued', 'stage': False, 'error': False, 'download_progress': 0.0,
+                    'database_progress': 0.0, 'filestore_progress': 0.0, 'bytes_done': 0.0})
+        return True
+
+    @api.model
+    def run_restores(self):
+        """Run the queued restores, one after the other."""
+        while True:
+            self.env.cr.execute("""
+                SELECT id
+                  FROM dailybackup_backup_restore
+                 WHERE state = 'queued'
+                 ORDER BY id
+                 LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+            """)
+            row = self.env.cr.fetchone()
+            if not row:
+                return True
+            restore = self.browse(row[0])
+            restore.write({'state': 'running', 'date_start': fields.Datetime.now(), 'stage': 'download',
+                           'bytes_total': restore.artifact_id.size})
+            # Progress is written by other cursors from now on, this one must not hold the row.
+            self.env.cr.commit()
+            restore._execute()
+            self.env.cr.commit()
+
+    @api.multi
+    def _report(self, values):
+        """Store progress on a cursor of its own, so it can be seen while the restore runs."""
+        self.ensure_one()
+        try:
+            with self.env['dailybackup.backupprocess']._new_env() as env:
+                self.with_env(env).write(values)
+        except psycopg2.Error:
+            # Progress is only informative, the restore goes on.
+            logger.warning('Function: _report - could not store the progress of restore %s' % self.id, exc_info=True)
+
+    @api.multi
+    def _execute(self):
+        self.ensure_one()
+        restore = self
+        artifact = restore.artifact_id
+        started = time.time()
+        reporter = restore_lib.ProgressReporter(restore._report)
+        filestore_path = tools.config.filestore(restore.name)
+        created = False
+        tmp_dir = tempfile.mkdtemp(prefix='dailybackup-restore-')
+        logger.info('Function: _execute - Parameters: restore: %s - path: %s - location: %s - jobs: %s' % (
+            restore.name, artifact.path, artifact.location, restore.jobs))
+        try:
+            if odoo.service.db.exp_db_exist(restore.name):
+                raise Warning(_('The database %s already exists.') % restore.name)
+            if os.path.isdir(filestore_path) and os.listdir(filestore_path):
+                raise Warning(_('The filestore %s already exists.') % filestore_path)
+            path = restore._download(tmp_dir, reporter)
+            reporter.update(stage='restore')
+            odoo.service.db._create_empty_database(restore.name)
+            created = True
+            if zipfile.is_zipfile(path):
+                restore._restore_zip(path, filestore_path, reporter)
+            else:
+                restore._restore_dump(path, reporter)
+            reporter.update(stage='finalize')
+            reporter.flush()
+            restore._finalize()
+        except Exception as e:
+            logger.exception('Function: _execute - restore of %s failed' % restore.name)
+            reporter.flush()
+            if created:
+                restore._drop()
+            restore._report({'state': 'failed', 'error': str(e), 'date_done': fields.Datetime.now(),
+                             'duration': time.time() - started})
+            return False
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        restore._report({'state': 'done', 'date_done': fields.Datetime.now(), 'duration': time.time() - started,
+                         'download_progress': 100.0, 'database_progress': 100.0, 'filestore_progress': 100.0})
+        logger.info('Function: _execute - Parameters: restore: %s - duration: %.1fs' % (
+            restore.name, time.time() - started))
+        return True
+
+    @api.multi
+    def _download(self, tmp_dir, reporter):
+        """Bring the backup file to the local disk, uncompressed, and return its path.
+
+        A local file that is not compressed is used where it is.
+        """
+        self.ensure_one()
+        artifact = self.artifact_id
+        if artifact.name.endswith('.' + chunking.MANIFEST_EXTENSION):
+            manifest = chunking.read_manifest(artifact.path)
+            store = chunking.ChunkStore(os.path.join(os.path.dirname(artifact.path), chunking.CHUNKS_DIRECTORY))
+            path = chunking.rebuild_archive(manifest, store, os.path.join(tmp_dir, 'restore.zip'))
+            reporter.update(download_progress=100.0)
+            return path
+        codec = compression.codec_of(artifact.name)
+        if artifact.location == 'local' and not codec:
+            reporter.update(download_progress=100.0, bytes_done=artifact.size)
+            return artifact.path
+        total = artifact.size or 0.0
+
+        def progress(count):
+            reporter.update(bytes_done=count, download_progress=min(count * 100.0 / total, 100.0) if total else 0.0)
+        path = os.path.join(tmp_dir, 'restore')
+        with artifact._open() as fp:
+            size = restore_lib.download(fp, path, codec, progress)
+        reporter.update(download_progress=100.0)
+        logger.info('Function: _download - Parameters: path: %s - size: %s' % (artifact.path, size))
+        return path
+
+    @api.multi
+    def _restore_dump(self, path, reporter):
+        """Restore a custom-format dump with ``jobs`` connections."""
+        self.ensure_one()
+        pg_restore = tools.find_pg_tool('pg_restore')
+        env = tools.exec_pg_environ()
+        total = restore_lib.count_archive_items(pg_restore, path, env)
+        restore_lib.restore_dump(
+            pg_restore, path, self.name, self.jobs, env,
+            lambda done: reporter.update(database_progress=min(done * 100.0 / total, 100.0) if total else 0.0))
+        reporter.update(filestore_progress=100.0)
+
+    @api.multi
+    def _restore_zip(self, path, filestore_path, reporter):
+        """Restore the SQL dump of a zip archive while its filestore is extracted."""
+        self.ensure_one()
+        with zipfile.ZipFile(path) as archive:
+            dump_size = archive.getinfo('dump.sql').file_size
+        files = restore_lib.count_members(path, 'filestore/')
+        # The thread must not use the cursor of this environment.
+        database_name, errors = self.name, []
+
+        def restore_database():
+            try:
+                restore_lib.restore_sql_member(
+                    tools.find_pg_tool('psql'), path, 'dump.sql', database_name, tools.exec_pg_environ(),
+                    lambda sent: reporter.update(
+                        database_progress=min(sent * 100.0 / dump_size, 100.0) if dump_size else 0.0))
+            except Exception as e:
+                errors.append(e)
+        database = threading.Thread(target=restore_database, name='restore %s' % database_name)
+        database.start()
+        try:
+            restore_lib.extract_members(
+                path, 'filestore/', filestore_path, self.extract_threads,
+                lambda done: reporter.update(filestore_progress=done * 100.0 / files))
+        finally:
+            database.join()
+        reporter.update(filestore_progress=100.0)
+        if errors:
+            raise errors[0]
+        logger.info('Function: _restore_zip - Parameters: restore: %s - dump.sql: %s bytes - filestore files: %s' % (
+            self.name, dump_size, files))
+
+    @api.multi
+    def _finalize(self):
+        """Load the new database, like Odoo does at the end of its own restore."""
+        self.ensure_one()
+        registry = odoo.modules.registry.Registry.new(self.name)
+        with registry.cursor() as cr:
+            env = api.Environment(cr, odoo.SUPERUSER_ID, {})
+            if self.copy:
+                env['ir.config_parameter'].init(force=True)
+            if tools.config['unaccent']:
+                try:
+                    with cr.savepoint():
+                        cr.execute("CREATE EXTENSION unaccent")
+                except psycopg2.Error:
+                    pass
+
+    @api.multi
+    def _drop(self):
+        """Remove what a failed restore left behind."""
+        self.ensure_one()
+        try:
+            odoo.service.db.exp_drop(self.name)
+        except Exception:
+            logger.exception('Function: _drop - could not drop %s' % self.name)
+        shutil.rmtree(tools.config.filestore(self.name), ignore_errors=True)
+
+    @api.multi
+    def action_retry(self):
+        return self.action_start()
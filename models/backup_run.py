@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+
+import calendar
+import logging
+
+from ..lib import metrics
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('dump', 'stream', 'handshake', 'upload', 'retention', 'mail')
+
+
+class BackupRun(models.Model):
+    _name = 'dailybackup.backup.run'
+    _description = 'Backup run'
+    _order = 'start_date desc, id desc'
+
+    name = fields.Char('Run', required=True)
+    start_date = fields.Datetime('Started on', required=True, index=True, default=fields.Datetime.now)
+    end_date = fields.Datetime('Finished on')
+    state = fields.Selection([('running', 'Running'), ('done', 'Done'), ('partial', 'Partially failed'),
+                              ('failed', 'Failed')], 'State', default='running', required=True, index=True)
+    duration = fields.Float('Duration (s)', help='Wall-clock time of the run.')
+    sequential_duration = fields.Float('Sequential duration (s)',
+                                       help='Sum of the durations of the records, i.e. the time the run would '
+                                            'take without parallel workers.')
+    time_saved = fields.Float('Time saved (s)')
+    record_count = fields.Integer('Records')
+    failed_count = fields.Integer('Failed records')
+    bytes_written = fields.Float('Bytes written', digits=(20, 0))
+    throughput = fields.Float('Throughput (MB/s)', digits=(16, 2))
+    handshake_count = fields.Integer('SFTP handshakes')
+    session_reuse_count = fields.Integer('SFTP sessions reused')
+    line_ids = fields.One2many('dailybackup.backup.run.line', 'run_id', 'Records')
+
+    @api.multi
+    def _finish(self, wall_clock=None):
+        """Sum the lines of the run up once all its records are done.
+
+        :param wall_clock: duration of the run, the time since it started by default
+        """
+        now = fields.Datetime.now()
+        for run in self:
+            lines = run.line_ids
+            failed = lines.filtered(lambda l: l.state == 'failed')
+            sequential = sum(lines.mapped('duration'))
+            bytes_written = sum(lines.mapped('bytes_written'))
+            duration = (now - run.start_date).total_seconds() if wall_clock is None else wall_clock
+            if not lines or len(failed) == len(lines):
+                state = 'failed' if lines else 'done'
+            else:
+                state = 'partial' if failed else 'done'
+            run.write({
+                'end_date': now,
+                'state': state,
+                'duration': duration,
+                'sequential_duration': sequential,
+                'time_saved': max(sequential - duration, 0.0),
+                'record_count': len(lines),
+                'failed_count': len(failed),
+                'bytes_written': bytes_written,
+                'throughput': duration and bytes_written / 1024.0 / 1024.0 / duration,
+                'handshake_count': sum(lines.mapped('handshake_count')),
+                'session_reuse_count': sum(lines.mapped('session_reuse_count')),
+            })
+        return True
+
+    @api.model
+    def _finish_completed(self):
+        """Finish the running runs whose records are all done."""
+        runs = self.search([('state', '=', 'running')])
+        completed = runs.filtered(lambda run: not run.line_ids.filtered(lambda line: line.state == 'queued'))
+        completed._finish()
+        return completed
+
+    @api.model
+    def _prometheus_metrics(self):
+        """Metrics of the last run of every database, in the Prometheus text format."""
+        lines = self.env['dailybackup.backup.run.line']
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (database) id
+              FROM dailybackup_backup_run_line
+             WHERE state != 'queued'
+             ORDER BY database, start_date DESC, id DESC
+        """)
+        lines = lines.browse([row[0] for row in self.env.cr.fetchall()])
+        self.env.cr.execute("""
+            SELECT database, max(start_date)
+              FROM dailybackup_backup_run_line
+             WHERE state = 'done'
+             GROUP BY database
+        """)
+        last_success = self.env.cr.fetchall()
+        last_run = self.search([('state', '!=', 'running')], limit=1)
+
+        stage_samples = []
+        for line in lines:
+            for stage in STAGES:
+                stage_samples.append(({'database': line.database, 'stage': stage}, line['%s_duration' % stage]))
+        return metrics.render_prometheus([
+            ('dailybackup_stage_duration_seconds', 'gauge', 'Duration of each stage of the last backup.',
+             stage_samples),
+            ('dailybackup_duration_seconds', 'gauge', 'Duration of the last backup.',
+             [({'database': line.database}, line.duration) for line in lines]),
+            ('dailybackup_bytes_written', 'gauge', 'Size of the last backup.',
+             [({'database': line.database}, line.bytes_written) for line in lines]),
+            ('dailybackup_throughput_megabytes_per_second', 'gauge', 'Dump and upload throughput of the last backup.',
+             [({'database': line.database}, line.throughput) for line in lines]),
+            ('dailybackup_retries', 'gauge', 'Retries during the last backup.',
+             [({'database': line.database}, line.retry_count) for line in lines]),
+            ('dailybackup_success', 'gauge', '1 when the last backup succeeded.',
+             [({'database': line.database}, line.state == 'done') for line in lines]),
+            ('dailybackup_last_success_timestamp_seconds', 'gauge', 'Start time of the last successful backup.',
+             [({'database': database}, calendar.timegm(fields.Datetime.to_datetime(date).timetuple()))
+              for database, date in last_success]),
+            ('dailybackup_run_duration_seconds', 'gauge', 'Wall-clock time of the last run.',
+             [({}, last_run.duration)] if last_run else []),
+            ('dailybackup_run_time_saved_seconds', 'gauge', 'Time saved by the parallel workers in the last run.',
+             [({}, last_run.time_saved)] if last_run else []),
+        ])
+
+
+class BackupRunLine(models.Model):
+    _name = 'dailybackup.backup.run.line'
+    _description = 'Backup run record'
+    _order = 'start_date desc, id desc'
+
+    run_id = fields.Many2one('dailybackup.backup.run', 'Run', ondelete='cascade', index=True)
+    backup_id = fields.Many2one('dailybackup.backupprocess', 'Backup configuration', ondelete='cascade', index=True)
+    database = fields.Char('Database', index=True)
+    start_date = fields.Datetime('Started on', default=fields.Datetime.now, index=True)
+    state = fields.Selection([('queued', 'Queued'), ('done', 'Done'), ('skipped', 'Skipped'), ('failed', 'Failed')],
+                             'State', required=True, default='queued', index=True)
+    error = fields.Text('Error')
+    duration = fields.Float('Duration (s)')
+    dump_duration = fields.Float('Dump (s)')
+    stream_duration = fields.Float('Stream dump to SFTP (s)')
+    handshake_duration = fields.Float('SFTP handshake (s)')
+    upload_duration = fields.Float('Upload (s)')
+    retention_duration = fields.Float('Retention (s)')
+    mail_duration = fields.Float('Mail (s)')
+    bytes_written = fields.Float('Bytes written', digits=(20, 0))
+    bytes_uploaded = fields.Float('Bytes uploaded', digits=(20, 0))
+    throughput = fields.Float('Throughput (MB/s)', digits=(16, 2),
+                              help='Bytes written divided by the time spent dumping and uploading.')
+    retry_count = fields.Integer('Retries')
+    handshake_count = fields.Integer('SFTP handshakes')
+    session_reuse_count = fields.Integer('SFTP sessions reused')
+
+    @api.multi
+    def _lock(self):
+        """Lock the lines until the end of the transaction, the first statement of a short one."""
+        if self.ids:
+            self.env.cr.execute("SELECT id FROM dailybackup_backup_run_line WHERE id IN %s FOR UPDATE",
+                                (tuple(self.ids),))
+        return True
+
+    @api.multi
+    def _add_metrics(self, record_metrics):
+        """Add the metrics of one job of the record to the line."""
+        for line in self:
+            values = dict(('%s_duration' % stage, line['%s_duration' % stage] + record_metrics.stages.get(stage, 0.0))
+                          for stage in STAGES)
+            bytes_written = line.bytes_written + record_metrics.counters.get('bytes_written', 0)
+            busy = values['dump_duration'] + values['stream_duration'] + values['upload_duration']
+            values.update({
+                'duration': line.duration + record_metrics.duration(),
+                'bytes_written': bytes_written,
+                'bytes_uploaded': line.bytes_uploaded + record_metrics.counters.get('bytes_uploaded', 0),
+                'throughput': busy and bytes_written / 1024.0 / 1024.0 / busy,
+                'retry_count': line.retry_count + record_metrics.counters.get('retries', 0),
+                'handshake_count': line.handshake_count + record_metrics.counters.get('handshakes', 0),
+                'session_reuse_count': line.session_reuse_count + record_metrics.counters.get('sessions_reused', 0),
+            })
+            if record_metrics.error:
+                values['error'] = '%s\n%s' % (line.error, record_metrics.error) if line.error else record_metrics.error
+            line.write(values)
+        return True
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, _
+from odoo.exceptions import ValidationError, Warning
+
+import contextlib
+import logging
+import os
+
+from ..lib import metrics
+from ..lib import sftp_sync
+from ..lib import targets
+from .backupprocess import SFTP_POOL
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def open_target(params):
+    """Connect to a target described by ``params`` (see ``BackupTarget._connection_params``).
+
+    Only plain values are used, so the worker threads of a fan-out can
+    connect without touching the ORM.
+    """
+    if params['target_type'] == 'local':
+        yield targets.LocalTarget(params['path'])
+    elif params['target_type'] == 'sftp':
+        with SFTP_POOL.session(params['host'], params['port'], params['user'], params['password']) as (s, sftp):
+            yield targets.SftpTarget(sftp, params['path'])
+    else:
+        target = targets.FtpTarget(params['host'], params['port'], params['user'], params['password'],
+                                   params['path'], use_tls=params['use_tls'], passive=params['passive'])
+        try:
+            yield target
+        finally:
+            target.close()
+
+
+class BackupTarget(models.Model):
+    _name = 'dailybackup.backup.target'
+    _description = 'Backup target'
+    _order = 'sequence, id'
+
+    backup_id = fields.Many2one('dailybackup.backupprocess', 'Backup configuration', required=True,
+                                ondelete='cascade', index=True)
+    name = fields.Char('Name', required=True)
+    sequence = fields.Integer('Sequence', default=10)
+    active = fields.Boolean('Active', default=True)
+    target_type = fields.Selection([('sftp', 'SFTP'), ('ftp', 'FTP'), ('local', 'Local directory / NFS')], 'Type',
+                                   required=True, default='sftp')
+    host = fields.Char('Host', help='IP address or host name of the server.')
+    port = fields.Integer('Port', help='22 for SFTP and 21 for FTP when empty.')
+    user = fields.Char('Username')
+    password = fields.Char('Password')
+    path = fields.Char('Path', required=True,
+                       help='Directory the backups are written to, on the server or, for a local directory, '
+                            'on this machine (e.g. a NFS mount or a directory synced to an object storage).')
+    use_tls = fields.Boolean('FTP over TLS')
+    passive = fields.Boolean('Passive mode', default=True)
+    days_to_keep = fields.Integer('Remove after x days', default=30,
+                                  help='Backups older than this are removed from the target. 0 keeps them all. '
+                                       'Not used with the daily / weekly / monthly retention of the backup.')
+
+    @api.constrains('target_type', 'host')
+    def _check_host(self):
+        for target in self:
+            if target.target_type != 'local' and not target.host:
+                raise ValidationError(_('The target %s needs a host.') % target.name)
+
+    @api.multi
+    def _connection_params(self):
+        self.ensure_one()
+        return {
+            'target_type': self.target_type,
+            'host': self.host,
+            'port': self.port or (22 if self.target_type == 'sftp' else 21),
+            'user': self.user,
+            'password': self.password,
+            'path': self.path,
+            'use_tls': self.use_tls,
+            'passive': self.passive,
+        }
+
+    @api.multi
+    @contextlib.contextmanager
+    def _connect(self, subdirectory=None):
+        """Connect to the directory of the target, or to ``subdirectory`` in it."""
+        self.ensure_one()
+        params = self._connection_params()
+        if subdirectory:
+            params['path'] = os.path.join(params['path'], subdirectory)
+        with open_target(params) as target:
+            yield target
+
+    @api.multi
+    def _upload_throttle(self):
+        self.ensure_one()
+        if self.target_type == 'local':
+            return None
+        return self.env['dailybackup.bandwidth.limit']._for_host(self.host)._throttle()
+
+    @api.multi
+    def _seconds_until_upload_window(self):
+        self.ensure_one()
+        if self.target_type == 'local':
+            return 0
+        return self.env['dailybackup.bandwidth.limit']._for_host(self.host)._seconds_until_window()
+
+    @api.multi
+    def _record_upload(self, path, size, checksum=None, algorithm='sha256'):
+        self.ensure_one()
+        return self.env['dailybackup.backup.artifact']._record(
+            self.backup_id, path, location='remote', size=size, checksum=checksum, algorithm=algorithm, target=self)
+
+    @api.multi
+    def _stream_consumer(self, name):
+        """Fan-out consumer writing a streamed dump to the target as ``name``.
+
+        It runs on its own thread, so everything it needs from the record
+        is read here.
+        """
+        self.ensure_one()
+        params = self._connection_params()
+        upload_throttle = self._upload_throttle()
+
+        def consume(chunks):
+            with open_target(params) as target, target.open_write(name) as fp:
+                for chunk in chunks:
+                    if upload_throttle:
+                        upload_throttle(len(chunk))
+                    fp.write(chunk)
+        return consume
+
+    @api.multi
+    def _upload_folder(self, folder_path):
+        """Copy the backups of the folder the target does not have yet.
+
+        :raise: when one of the files could not be copied, once all were tried
+        """
+        self.ensure_one()
+        backup = self.backup_id
+        upload_throttle = self._upload_throttle()
+        failed, uploaded = [], []
+        with self._connect() as target:
+            local = sftp_sync.local_snapshot(folder_path, backup._is_backup_file)
+            remote = target.listdir()
+            to_upload = sftp_sync.files_to_upload(local, remote)
+            logger.info('Function: _upload_folder - Parameters: target: %s - local files: %s - remote files: %s - '
+                        'to upload: %s' % (self.name, len(local), len(remote), len(to_upload)))
+            with metrics.stage('upload'):
+                for f in to_upload:
+                    fullpath = os.path.join(folder_path, f)
+                    try:
+                        target.put(fullpath, f, throttle=upload_throttle)
+                        metrics.add('bytes_uploaded', local[f].st_size)
+                        local_artifact = self.env['dailybackup.backup.artifact'].search(
+                            [('backup_id', '=', backup.id), ('location', '=', 'local'), ('path', '=', fullpath)],
+                            limit=1)
+                        uploaded.append((os.path.join(self.path, f), {
+                            'location': 'remote', 'size': local[f].st_size, 'checksum': local_artifact.checksum,
+                            'algorithm': local_artifact.checksum_algorithm or 'sha256'}))
+                    except Exception as e:
+                        logger.critical('Function: _upload_folder - could not copy %s to %s: %s' % (
+                            fullpath, self.name, e))
+                        failed.append('%s: %s' % (f, e))
+        artifacts = self.env['dailybackup.backup.artifact']
+        if failed:
+            # The job is rolled back, and its retry skips the files already copied: catalog them now.
+            for path, values in uploaded:
+                artifacts._record_committed(backup, path, target=self, **values)
+            raise Exception('Function: _upload_folder - could not copy to %s:\n%s' % (self.name, '\n'.join(failed)))
+        for path, values in uploaded:
+            self._record_upload(path, values['size'], values['checksum'], values['algorithm'])
+        return True
+
+    @api.multi
+    def _prune(self):
+        """Remove the old backups from the target, by age or with the daily / weekly / monthly policy of the backup."""
+        self.ensure_one()
+        backup = self.backup_id
+        gfs = backup.retention_policy == 'gfs'
+        if not gfs and self.days_to_keep <= 0:
+            return True
+        with metrics.stage('retention'), self._connect() as target:
+            remote = target.listdir()
+            if gfs:
+                expired = sorted(artifact.name for artifact in backup._expired_artifacts('remote', self)
+                                 if artifact.name in remote)
+            else:
+                expired = sftp_sync.expired_files(remote, backup._is_backup_file, self.days_to_keep)
+            failed = target.remove_files(expired)
+        removed = [f for f in expired if f not in failed]
+        if backup.backup_type == 'physical':
+            backup._prune_wal('remote', self)
+        self.env['dailybackup.backup.artifact'].search([
+            ('target_id', '=', self.id),
+            ('state', '=', 'present'),
+            ('path', 'in', [os.path.join(self.path, f) for f in removed]),
+        ]).write({'state': 'deleted'})
+        logger.info('Function: _prune - Parameters: target: %s - removed: %s - failed: %s' % (
+            self.name, len(removed), len(failed)))
+        return True
+
+    @api.multi
+    def test_connection(self):
+        self.ensure_one()
+        try:
+            with self._connect() as target:
+                count = len(target.listdir())
+        except Exception as e:
+            raise Warning(_('Connection Test Failed!') + '\n\n' + str(e))
+        finally:
+            SFTP_POOL.close_all()
+        raise Warning(_('Connection Test Succeeded!') + '\n\n' + _('%s files in %s.') % (count, self.path))
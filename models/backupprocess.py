@@ -8,7 +8,6 @@ from odoo.exceptions import ValidationError
 
 import logging
 logger = logging.getLogger(__name__)
-from ftplib import FTP
 import os
 import datetime
 
@@ -18,7 +17,13 @@ except ImportError:
     import xmlrpclib
 import time
 import base64
+import contextlib
+import json
+import shutil
 import socket
+import subprocess
+import tempfile
+import zipfile
 
 try:
     import paramiko
@@ -27,6 +32,32 @@ except ImportError:
         'This module needs paramiko to automatically write backups to the FTP through SFTP. '
         'Please install paramiko on your system. (python3 -m pip install paramiko)')
 
+from ..lib import chunking
+from ..lib import compression
+from ..lib import integrity
+from ..lib import metrics
+from ..lib import physical
+from ..lib import retention
+from ..lib import sftp_sync
+from ..lib import targets
+from ..lib import throttle
+from ..lib.multipart_upload import MultipartUpload, UploadVerificationError, file_hash, remote_file_hash
+from ..lib.sftp_pool import SftpConnectionPool
+from ..lib.streaming import TeeWriter, fan_out
+from ..lib.ttl_cache import TtlCache
+from .backup_artifact import parse_backup_filename
+
+
+# Database lists per (host, port), shared by the records, the constraint and the cron.
+DB_LIST_CACHE = TtlCache()
+DB_LIST_TIMEOUT = 30
+
+# SSH/SFTP sessions shared by all the backups of a run in this process.
+SFTP_POOL = SftpConnectionPool()
+
+# Fields deciding where the WAL of a physical backup is archived from.
+WAL_FIELDS = {'backup_type', 'name', 'wal_slot', 'folder'}
+
 
 class BackupProcess(models.Model):
     _name = 'dailybackup.backupprocess'
@@ -34,16 +65,52 @@ class BackupProcess(models.Model):
     @api.multi
     def get_db_list(self, host, port, context={}):
         try:
-            uri = 'http://' + host + ':' + port
-            conn = xmlrpclib.ServerProxy(uri + '/xmlrpc/db')
-            db_list = execute(conn, 'list')
-            logger.info('Function: get_db_list - Parameters: uri: %s - conn: %s' % (uri, conn))
-            return db_list
+            ttl = int(self.env['ir.config_parameter'].sudo().get_param('dailybackup.db_list_ttl', default=300))
+            return DB_LIST_CACHE.get((host or '', str(port or '')), lambda: self._fetch_db_list(host, port), ttl=ttl)
 
         except Exception as e:
             logger.exception("get_db_list Method")
             raise ValidationError(e)
 
+    @api.model
+    def _fetch_db_list(self, host, port):
+        if self._is_local_server(host, port):
+            # No need to go through the HTTP workers to ask ourselves.
+            db_list = odoo.service.db.list_dbs(True)
+            logger.info('Function: _fetch_db_list - Parameters: local server: %s:%s' % (host, port))
+            return db_list
+        uri = 'http://' + host + ':' + port
+        conn = xmlrpclib.ServerProxy(uri + '/xmlrpc/db', transport=TimeoutTransport(DB_LIST_TIMEOUT))
+        db_list = execute(conn, 'list')
+        logger.info('Function: _fetch_db_list - Parameters: uri: %s - conn: %s' % (uri, conn))
+        return db_list
+
+    @api.model
+    def _is_local_server(self, host, port):
+        """Tell whether ``host:port`` is the Odoo server this code runs in."""
+        if str(port or '') != str(odoo.tools.config.get('http_port')):
+            return False
+        local_hosts = {'localhost', '127.0.0.1', '::1', socket.gethostname(), socket.getfqdn()}
+        if odoo.tools.config.get('http_interface'):
+            local_hosts.add(odoo.tools.config['http_interface'])
+        return (host or '').lower() in set(name.lower() for name in local_hosts)
+
+    @api.model
+    def invalidate_db_list_cache(self, host=None, port=None):
+        """Forget the cached database list of ``host:port``, or of every server."""
+        DB_LIST_CACHE.invalidate((host or '', str(port or '')) if host else None)
+        return True
+
+    @api.multi
+    def _database_exists(self):
+        """Look the database of the record up, refreshing a cached list that does not have it."""
+        self.ensure_one()
+        if self.name in self.get_db_list(self.host, self.port):
+            return True
+        # The database may have been created after the list was cached.
+        self.invalidate_db_list_cache(self.host, self.port)
+        return self.name in self.get_db_list(self.host, self.port)
+
     @api.multi
     def _get_db_name(self):
         try:
@@ -60,12 +127,40 @@ class BackupProcess(models.Model):
     name = fields.Char('Database', help='Database you want to schedule backups for',
                        default=_get_db_name)
     folder = fields.Char('Backup Directory', help='Absolute path for storing the backups', default='db_backup')
-    backup_type = fields.Selection([('zip', 'Zip'), ('dump', 'Dump')], 'Backup Type', default='zip')
+    backup_type = fields.Selection([('zip', 'Zip'), ('dump', 'Dump'), ('incremental', 'Incremental'),
+                                    ('physical', 'Physical (pg_basebackup + WAL)')],
+                                   'Backup Type', default='zip',
+                                   help='Incremental backups split the dump and the filestore in chunks and only '
+                                        'store the chunks that changed since the previous run.\n'
+                                        'Physical backups copy the whole PostgreSQL cluster with pg_basebackup and '
+                                        'archive its WAL continuously, which allows a point-in-time restore. They '
+                                        'need a PostgreSQL user with the REPLICATION privilege.')
+    wal_switch_minutes = fields.Integer('Ship WAL every (minutes)', default=5,
+                                        help='Physical backups: when no WAL segment was completed for this long, '
+                                             'the server is asked to switch to a new one so the last changes are '
+                                             'archived and uploaded. This bounds the data lost when the server '
+                                             'is lost. 0 waits for full segments.')
+    wal_slot = fields.Char('Replication slot',
+                           help='Physical backups: replication slot used by pg_receivewal, dailybackup_<database> '
+                                'when empty. The server keeps the WAL the slot did not receive yet, watch its disk '
+                                'space when the receiver is stopped for long.')
     autoremove = fields.Boolean('Auto. Remove Backups',
                                 help='If you check this option you can choose to automaticly remove the backup after xx days')
     days_to_keep = fields.Integer('Remove after x days',
                                   help="Choose after how many days the backup should be deleted. For example:\nIf you fill in "
                                        "5 the backups will be removed after 5 days.", )
+    retention_policy = fields.Selection([('age', 'Remove after x days'), ('gfs', 'Daily / weekly / monthly')],
+                                        'Retention', default='age', required=True,
+                                        help='Remove after x days keeps every backup of the last days. Daily / '
+                                             'weekly / monthly keeps the last backup of a few days, weeks and months '
+                                             '(grandfather-father-son), on the local folder, the SFTP server and the '
+                                             'other targets alike.')
+    keep_daily = fields.Integer('Daily backups', default=7,
+                                help='Number of days whose last backup is kept.')
+    keep_weekly = fields.Integer('Weekly backups', default=4,
+                                 help='Number of weeks whose last backup is kept.')
+    keep_monthly = fields.Integer('Monthly backups', default=6,
+                                  help='Number of months whose last backup is kept.')
 
     # Columns for external server (SFTP)
     sftp_write = fields.Boolean('Write to external server with sftp',
@@ -92,13 +187,97 @@ class BackupProcess(models.Model):
     email_to_notify = fields.Char('E-mail to notify',
                                   help='Fill in the e-mail where you want to be notified that '
                                        'the backup failed on the FTP.')
+    compression = fields.Selection([('none', 'None'), ('zstd', 'Zstandard'), ('lz4', 'LZ4')], 'Compression',
+                                   default='none',
+                                   help='Compress the dump on the fly. The dump itself is then made without '
+                                        'compression. Not used by incremental backups, their chunks are '
+                                        'compressed already.')
+    compression_level = fields.Integer('Compression level', default=0,
+                                       help='Higher levels make smaller files but use more CPU. 0 uses the default '
+                                            'level of the codec: 3 for Zstandard, the fast mode for LZ4. LZ4 '
+                                            'switches to its much slower high-compression mode from level 3.')
+    compression_threads = fields.Integer('Compression threads', default=0,
+                                         help='Number of threads used by Zstandard. 0 compresses on the dumping '
+                                              'thread, -1 uses all the CPUs.')
+    benchmark_sample_mb = fields.Integer('Benchmark sample (MB)', default=256,
+                                         help='Size of the sample of the database used by the compression '
+                                              'benchmark.')
+    artifact_ids = fields.One2many('dailybackup.backup.artifact', 'backup_id', 'Backup files')
+    artifact_count = fields.Integer('Backup files', compute='_compute_artifact_count')
+    stream_upload = fields.Boolean('Stream dump to SFTP',
+                                   help='If you check this option the dump is sent to the SFTP server while it is '
+                                        'being made, without writing the whole file to the local disk first.')
+    stream_keep_local = fields.Boolean('Keep local copy',
+                                       help='Also write the streamed dump to the backup directory.')
+    stream_buffer_mb = fields.Integer('Stream buffer (MB)',
+                                      help='Maximum amount of dump data kept in memory while it waits for the upload.',
+                                      default=64)
+    stream_spool_mb = fields.Integer('Stream spool (MB)', default=1024,
+                                     help='Local disk space each destination of a streamed dump may use when it falls '
+                                          'behind the others. Once it is full the dump waits for that destination. '
+                                          'Not used with a single destination, which simply slows the dump down.')
+    multipart_upload = fields.Boolean('Parallel resumable upload',
+                                      help='Upload large backups over several SFTP channels at once. An interrupted '
+                                           'upload resumes where it stopped on the next run.')
+    multipart_threshold_mb = fields.Integer('Parallel upload from (MB)',
+                                            help='Backups smaller than this are uploaded in one stream.', default=512)
+    multipart_part_size_mb = fields.Integer('Upload part size (MB)', default=64)
+    multipart_channels = fields.Integer('Upload channels', help='Number of SFTP channels opened at the same time.',
+                                        default=4)
+    checksum_algorithm = fields.Selection([('sha256', 'SHA-256'), ('blake3', 'BLAKE3')], 'Checksum',
+                                          default='sha256', required=True,
+                                          help='Checksum computed while the backup is written. BLAKE3 is faster but '
+                                               'needs the python package blake3, and b3sum on the SFTP server to '
+                                               'verify the uploads.')
+    verify_upload = fields.Boolean('Verify uploads', default=True,
+                                   help='Let the SFTP server compute the checksum of every uploaded backup and '
+                                        'compare it with the local one. Needs shell access (sha256sum) on the '
+                                        'server, otherwise only the size is checked.')
+    target_ids = fields.One2many('dailybackup.backup.target', 'backup_id', 'Other targets',
+                                 help='Other servers or directories receiving the same backups, each with its own '
+                                      'retention.')
+    upload_priority = fields.Integer('Priority', default=10,
+                                     help='Backups with a lower priority are dumped and uploaded first. Among '
+                                          'backups with the same priority the smallest go first.')
+
+    @api.multi
+    def _compute_artifact_count(self):
+        data = self.env['dailybackup.backup.artifact'].read_group(
+            [('backup_id', 'in', self.ids), ('state', '=', 'present')], ['backup_id'], ['backup_id'])
+        counts = dict((item['backup_id'][0], item['backup_id_count']) for item in data)
+        for rec in self:
+            rec.artifact_count = counts.get(rec.id, 0)
+
+    @api.multi
+    def action_view_artifacts(self):
+        self.ensure_one()
+        action = self.env.ref('dailybackup.backup_artifact_action').read()[0]
+        action['domain'] = [('backup_id', '=', self.id)]
+        action['context'] = {'default_backup_id': self.id, 'search_default_present': 1}
+        return action
+
+    @api.multi
+    def write(self, vals):
+        receivers = self._wal_receivers() if WAL_FIELDS & set(vals) else []
+        res = super(BackupProcess, self).write(vals)
+        if receivers:
+            # The receivers of records no longer physical, or now archiving elsewhere.
+            self._stop_wal_receivers(set(receivers) - set(self._wal_receivers()))
+        return res
+
+    @api.multi
+    def unlink(self):
+        receivers = self._wal_receivers()
+        res = super(BackupProcess, self).unlink()
+        if receivers:
+            self._stop_wal_receivers(receivers)
+        return res
 
     @api.multi
     def _check_db_exist(self):
         try:
             self.ensure_one()
-            db_list = self.get_db_list(self.host, self.port)
-            if self.name in db_list:
+            if self._database_exists():
                 logger.info('Function: _check_db_exist - Parameters: db_name: %s' % self.name)
                 return True
             return False
@@ -119,24 +298,19 @@ class BackupProcess(models.Model):
         has_failed = False
 
         for rec in self:
-            db_list = self.get_db_list(rec.host, rec.port)
             path_to_write_to = rec.sftp_path
             ip_host = rec.sftp_host
             port_host = rec.sftp_port
             user_name_login = rec.sftp_user
-            password_login = rec.sftp_password
 
             logger.info('Function: test_sftp_connection - Parameters: path_to_write_to: '
-                        '%s - ip_host: %s - port_host: %s - user_name_login: %s - '
-                        'password_login: %s' % (path_to_write_to, ip_host, port_host, user_name_login, password_login))
+                        '%s - ip_host: %s - port_host: %s - user_name_login: %s' % (
+                            path_to_write_to, ip_host, port_host, user_name_login))
 
             # Connect with external server over SFTP, so we know sure that everything works.
-            s = None
             try:
-                s = paramiko.SSHClient()
-                s.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                s.connect(ip_host, port_host, user_name_login, password_login, timeout=10)
-                sftp = s.open_sftp()
+                with rec._sftp_session() as (s, sftp):
+                    sftp.normalize('.')
                 message_title = _("Function: test_sftp_connection  >> Connection Test Succeeded!\nEverything "
                                   "seems properly set up for FTP back-ups!")
             except Exception as e:
@@ -149,8 +323,7 @@ class BackupProcess(models.Model):
                     message_content += "\nYour IP address seems to be too short.\n"
                 message_content += _("Here is what we got instead:\n")
             finally:
-                if s:
-                    s.close()
+                SFTP_POOL.close_all()
 
         if has_failed:
             raise Warning(message_title + '\n\n' + message_content + "%s" % str(error))
@@ -159,237 +332,1249 @@ class BackupProcess(models.Model):
 
     @api.model
     def schedule_backup_process(self):
+        """Queue a backup of every configuration, the backup job worker does the actual work."""
         conf_ids = self.search([])
-        folder_path = ''
+        return self.env['dailybackup.backup.job']._enqueue_run(conf_ids)
+
+    @api.model
+    def _get_worker_limits(self):
+        """Read the global and per-host concurrency limits of the backup workers."""
+        params = self.env['ir.config_parameter'].sudo()
+        max_workers = int(params.get_param('dailybackup.max_workers', default=4))
+        max_workers_per_host = int(params.get_param('dailybackup.max_workers_per_host', default=2))
+        return max_workers, max_workers_per_host
 
-        for rec in conf_ids:
-            db_list = self.get_db_list(rec.host, rec.port)
+    @api.model
+    @contextlib.contextmanager
+    def _new_env(self):
+        """Environment on a new cursor, committed when the block succeeds."""
+        with api.Environment.manage():
+            with self.pool.cursor() as cr:
+                yield api.Environment(cr, self.env.uid, self.env.context)
 
-            if rec.name in db_list:
-                try:
-                    logger.info(
-                        "Function: schedule_backup_process - Folder path is " + str(rec.folder))
-                    folder_path = rec.folder if rec.folder else '//db_backup'
-                    logger.info(
-                        "Function: schedule_backup_process - Folder path is " + str(folder_path))
-
-                    if not os.path.isdir(folder_path):
-                        logger.info(
-                            "Function: schedule_backup_process - Folder is "
-                            "not directory, we will create the directory")
-                        os.makedirs(folder_path)
-                    else:
-                        logger.info(
-                            "Function: schedule_backup_process - Folder is directory")
-                except Exception as e:
-                    raise ValidationError('Function: schedule_backup_process - error is ' + str(e))
-
-                # Create name for dumpfile.
-                bkp_file = '%s_%s.%s' % (time.strftime('%Y_%m_%d_%H_%M_%S'), rec.name, rec.backup_type)
-                file_path = os.path.join(folder_path, bkp_file)
-                uri = 'http://' + rec.host + ':' + rec.port
-                conn = xmlrpclib.ServerProxy(uri + '/xmlrpc/db')
-                bkp = ''
-
-                logger.info('Function: schedule_backup_process - Parameters: bkp_file: '
-                            '%s - file_path: %s - uri: %s - conn: %s - '
-                            'bkp: %s' % (
-                                bkp_file, file_path, uri, conn, bkp))
+    @api.multi
+    def _streams_dump(self):
+        self.ensure_one()
+        return bool(self.stream_upload and self.backup_type != 'incremental' and
+                    (self.sftp_write is True or self.target_ids))
 
-                try:
-                    # try to backup database and write it away
-                    fp = open(file_path, 'wb')
-                    odoo.service.db.dump_db(rec.name, fp, rec.backup_type)
-                    fp.close()
-                except Exception as error:
-                    logger.debug(
-                        "Couldn't backup database %s. Bad database administrator "
-                        "password for server running at http://%s:%s" % (
-                            rec.name, rec.host, rec.port))
-                    logger.info(
-                        "Function: schedule_backup_process - Parameters: Couldn't backup database %s. "
-                        "Bad database administrator password for server running at http://%s:%s" % (
-                            rec.name, rec.host, rec.port))
-                    logger.debug("Exact error from the exception: " + str(error))
-                    logger.info(
-                        "Function: schedule_backup_process - Parameters: Exact error from the exception: " + str(error))
+    @api.multi
+    def _job_plan(self):
+        """Jobs a backup of this record goes through after its dump.
+
+        Every destination (the SFTP server, then each target) has its own
+        branch of jobs, so a slow destination does not hold up the others.
+        The final jobs run once all the branches are done.
+
+        :return: tuple ``(branches, final)`` of lists of ``(job_type, target)``,
+            ``target`` being empty for the SFTP server and the local folder
+        """
+        self.ensure_one()
+        no_target = self.env['dailybackup.backup.target']
+        # A streamed dump without local copy leaves nothing to upload afterwards,
+        # with a local copy the upload jobs catch up on the destinations the stream missed.
+        has_local_copy = not self._streams_dump() or self.stream_keep_local
+        branches = []
+        branch = []
+        if self.sftp_write is True and has_local_copy:
+            branch.append(('upload', no_target))
+        if self.autoremove or self.sftp_write is True:
+            branch.append(('prune', no_target))
+        if branch:
+            branches.append(branch)
+        for target in self.target_ids:
+            branches.append(([('upload', target)] if has_local_copy else []) + [('prune', target)])
+        final = [('notify', no_target)] if self.sftp_write is True or self.target_ids else []
+        return branches, final
+
+    @api.multi
+    def _job_dump(self, job):
+        """Dump the database, straight to the destinations when streaming is on.
+
+        :return: path of the backup, or False when the database does not exist
+        """
+        self.ensure_one()
+        rec = self
+        if not rec._database_exists():
+            logger.info("Function: _job_dump - database %s "
+                        "doesn't exist on http://%s:%s" % (rec.name, rec.host, rec.port))
+            return False
+
+        folder_path = rec._prepare_backup_folder()
+        if rec._streams_dump():
+            # The dump goes straight to the destinations.
+            with metrics.stage('stream'):
+                return rec._stream_dump(folder_path)
+        with metrics.stage('dump'):
+            return rec._dump_database(folder_path)
+
+    @api.multi
+    def _job_upload(self, job):
+        self.ensure_one()
+        if job.target_id:
+            return job.target_id._upload_folder(self._prepare_backup_folder())
+        self._upload_to_sftp(self._prepare_backup_folder())
+        return True
+
+    @api.multi
+    def _job_prune(self, job):
+        self.ensure_one()
+        rec = self
+        if job.target_id:
+            return job.target_id._prune()
+        # Remove all old files (on local server) in case this is configured..
+        if rec.autoremove:
+            with metrics.stage('retention'):
+                rec._remove_old_local_backups(rec._prepare_backup_folder())
+            if rec.backup_type == 'physical':
+                rec._prune_wal('local')
+        if rec.sftp_write is True:
+            with rec._sftp_session() as (s, sftp):
+                rec._remove_old_sftp_backups(sftp)
+            if rec.backup_type == 'physical':
+                rec._prune_wal('remote')
+        return True
+
+    @api.multi
+    def _job_notify(self, job):
+        self.ensure_one()
+        failed = job.search([('line_id', '=', job.line_id.id), ('state', '=', 'failed')])
+        if failed and not self.send_mail_sftp_fail:
+            return True
+        self._send_backup_mail(not failed, '\n'.join(failed.mapped('error')) or None)
+        return True
+
+    @api.multi
+    def _prepare_backup_folder(self):
+        self.ensure_one()
+        try:
+            logger.info(
+                "Function: _prepare_backup_folder - Folder path is " + str(self.folder))
+            folder_path = self.folder if self.folder else '//db_backup'
+            logger.info(
+                "Function: _prepare_backup_folder - Folder path is " + str(folder_path))
+
+            if not os.path.isdir(folder_path):
+                logger.info(
+                    "Function: _prepare_backup_folder - Folder is "
+                    "not directory, we will create the directory")
+                os.makedirs(folder_path, exist_ok=True)
+            else:
+                logger.info(
+                    "Function: _prepare_backup_folder - Folder is directory")
+            return folder_path
+        except Exception as e:
+            raise ValidationError('Function: _prepare_backup_folder - error is ' + str(e))
+
+    @api.multi
+    def _dump_database(self, folder_path):
+        self.ensure_one()
+        rec = self
+
+        # Create name for dumpfile.
+        bkp_file = rec._backup_filename()
+        file_path = os.path.join(folder_path, bkp_file)
+        part_path = file_path + '.part'
+
+        logger.info('Function: _dump_database - Parameters: bkp_file: '
+                    '%s - file_path: %s' % (bkp_file, file_path))
+
+        try:
+            # try to backup database and write it away
+            if rec.backup_type == 'incremental':
+                rec._dump_incremental(folder_path, file_path)
+                checksum = file_hash(file_path, rec.checksum_algorithm)
+            else:
+                # Written under a name that is not a backup until it is complete, so a failed dump is never
+                # uploaded or kept as one.
+                with open(part_path, 'wb') as fp:
+                    # Hashed on the way to the disk, the file is not read again.
+                    hasher = integrity.HashingWriter(fp, rec.checksum_algorithm)
+                    rec._write_dump(hasher)
+                os.rename(part_path, file_path)
+                checksum = hasher.hexdigest()
+        except Exception as error:
+            logger.info(
+                "Function: _dump_database - Parameters: Couldn't backup database %s "
+                "for server running at http://%s:%s" % (rec.name, rec.host, rec.port))
+            logger.info(
+                "Function: _dump_database - Parameters: Exact error from the exception: " + str(error))
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+            raise
+        metrics.add('bytes_written', os.path.getsize(file_path))
+        self.env['dailybackup.backup.artifact']._record(rec, file_path, checksum=checksum,
+                                                        algorithm=rec.checksum_algorithm)
+        return file_path
+
+    @api.multi
+    def _backup_filename(self):
+        self.ensure_one()
+        bkp_file = '%s_%s.%s' % (time.strftime('%Y_%m_%d_%H_%M_%S'), self.name, self.backup_type)
+        if self.backup_type != 'incremental' and self.compression != 'none':
+            bkp_file += compression.EXTENSIONS[self.compression]
+        return bkp_file
+
+    @api.multi
+    def _write_dump(self, stream):
+        """Dump the database into ``stream``, through the compression stage if one is set."""
+        self.ensure_one()
+        if self.compression == 'none':
+            if self.backup_type == 'zip':
+                # dump_db copies the whole filestore into a temporary directory first.
+                self._dump_zip(stream, zipfile.ZIP_DEFLATED)
+            elif self.backup_type == 'physical':
+                self._dump_physical(stream)
+            else:
+                odoo.service.db.dump_db(self.name, stream, self.backup_type)
+            return
+        writer = compression.CompressingWriter(stream, self.compression, level=self.compression_level,
+                                               threads=self.compression_threads)
+        self._dump_uncompressed(writer)
+        writer.close()
+        logger.info('Function: _write_dump - Parameters: compression: %s - bytes in: %s - bytes out: %s' % (
+            self.compression, writer.bytes_in, writer.bytes_out))
+
+    @api.multi
+    def _dump_uncompressed(self, stream):
+        """Write the same zip or custom-format dump as ``dump_db``, but without compression.
+
+        Compressing twice wastes CPU for almost no gain, so this output is
+        left to the compression stage.
+        """
+        self.ensure_one()
+        if self.backup_type == 'physical':
+            self._dump_physical(stream)
+        elif self.backup_type == 'zip':
+            self._dump_zip(stream, zipfile.ZIP_STORED)
+        else:
+            self._pg_dump(stream, '--no-owner', '--format=c', '--compress=0', self.name)
+
+    @api.multi
+    def _dump_zip(self, stream, compress_type):
+        """Write the zip archive of ``dump_db`` straight into ``stream``, without a temporary copy on disk.
+
+        The SQL dump is piped into the archive and the filestore is read
+        file by file, so ``stream`` may be a pipe to the destinations.
+        """
+        self.ensure_one()
+        with odoo.sql_db.db_connect(self.name).cursor() as cr:
+            manifest = json.dumps(odoo.service.db.dump_db_manifest(cr), indent=4)
+        with zipfile.ZipFile(stream, 'w', compress_type, allowZip64=True) as archive:
+            archive.writestr('manifest.json', manifest)
+            with archive.open('dump.sql', 'w', force_zip64=True) as fp:
+                self._pg_dump(fp, '--no-owner', self.name)
+            self._zip_filestore(archive)
+
+    @api.multi
+    def _zip_filestore(self, archive):
+        self.ensure_one()
+        filestore = odoo.tools.config.filestore(self.name)
+        for dirpath, dirnames, filenames in os.walk(filestore):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                archive.write(path, os.path.join('filestore', os.path.relpath(path, filestore)))
+
+    @api.multi
+    def _dump_physical(self, stream):
+        """Write a physical backup: a zip of the Odoo manifest, the pg_basebackup tar of the cluster and the filestore.
+
+        The base backup holds no WAL: the WAL it needs to be consistent,
+        and the WAL written after it, are archived by pg_receivewal, which
+        is started first when it does not run yet.
+        """
+        self.ensure_one()
+        self._ensure_wal_receiver()
+        with odoo.sql_db.db_connect(self.name).cursor() as cr:
+            manifest = odoo.service.db.dump_db_manifest(cr)
+            # The base backup starts at or after this segment.
+            cr.execute("SELECT pg_walfile_name(pg_current_wal_lsn())")
+            manifest['wal_start'] = cr.fetchone()[0]
+        manifest['backup_method'] = 'pg_basebackup'
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            archive.writestr('manifest.json', json.dumps(manifest, indent=4))
+            with archive.open(physical.BASE_MEMBER, 'w', force_zip64=True) as fp:
+                self._pg_dump(fp, '--pgdata=-', '--format=tar', '--wal-method=none', '--checkpoint=fast',
+                              '--label=dailybackup %s' % self.name, tool='pg_basebackup')
+            self._zip_filestore(archive)
+        logger.info('Function: _dump_physical - Parameters: database: %s - wal_start: %s' % (
+            self.name, manifest['wal_start']))
+
+    @api.model
+    def _pg_dump(self, stream, *args, tool='pg_dump'):
+        """Run pg_dump (or ``tool``) with ``args`` and copy its output into ``stream``."""
+        pop = subprocess.Popen((odoo.tools.find_pg_tool(tool),) + args, env=odoo.tools.exec_pg_environ(),
+                               stdout=subprocess.PIPE)
+        try:
+            shutil.copyfileobj(pop.stdout, stream, compression.BLOCK_SIZE)
+        finally:
+            pop.stdout.close()
+            returncode = pop.wait()
+        if returncode:
+            raise Exception('%s exited with code %s' % (tool, returncode))
+
+    @api.multi
+    def _wal_folder(self, folder_path):
+        """Local directory pg_receivewal archives the WAL of the record into."""
+        self.ensure_one()
+        return os.path.join(folder_path, '%s_wal' % self.name)
+
+    @api.multi
+    def _wal_slot_name(self):
+        self.ensure_one()
+        return self.wal_slot or physical.slot_name(self.name)
+
+    @api.multi
+    def _ensure_wal_receiver(self):
+        """Start pg_receivewal for the record unless it runs already.
+
+        :return: True when it was just started
+        """
+        self.ensure_one()
+        slot = self._wal_slot_name()
+        pid, started = physical.ensure_receiver(odoo.tools.find_pg_tool('pg_receivewal'),
+                                                self._wal_folder(self._prepare_backup_folder()),
+                                                slot, env=odoo.tools.exec_pg_environ())
+        self._wal_slots(add=slot)
+        return started
+
+    @api.model
+    def _wal_slots(self, add=None, remove=None):
+        """Replication slots created for this database, the only ones it may drop.
+
+        Other databases of the same PostgreSQL server may archive their WAL too.
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        slots = set(filter(None, (params.get_param('dailybackup.wal_slots') or '').split(',')))
+        if (add and add not in slots) or (remove and remove in slots):
+            slots = (slots | {add}) - {remove, None}
+            params.set_param('dailybackup.wal_slots', ','.join(sorted(slots)))
+        return slots
+
+    @api.multi
+    def _wal_receivers(self):
+        """``(slot, wal_dir)`` of the physical backups among the records."""
+        return [(rec._wal_slot_name(), rec._wal_folder(rec.folder or '//db_backup'))
+                for rec in self if rec.backup_type == 'physical']
+
+    @api.model
+    def _stop_wal_receivers(self, receivers, keep=None):
+        """Stop pg_receivewal and drop the replication slot of WAL archives nobody uses any more.
+
+        The slot would otherwise make the PostgreSQL server keep all its
+        WAL until its disk is full.
+
+        :param receivers: iterable of ``(slot, wal_dir)``, ``wal_dir`` is None when it is not known
+        :param keep: slots still in use, those of the physical backups by default
+        """
+        if keep is None:
+            keep = set(slot for slot, wal_dir in self.search([('backup_type', '=', 'physical')])._wal_receivers())
+        for slot, wal_dir in receivers:
+            if slot in keep:
+                continue
+            try:
+                physical.stop_receiver(wal_dir, slot)
+                physical.drop_slot(odoo.tools.find_pg_tool('pg_receivewal'), slot, env=odoo.tools.exec_pg_environ())
+                self._wal_slots(remove=slot)
+            except Exception:
+                logger.exception('Function: _stop_wal_receivers - could not stop the WAL archiving of slot %s' % slot)
+        return True
+
+    @api.model
+    def _stop_orphan_wal_receivers(self, live):
+        """Stop the receivers and drop the slots created for this database that no live physical backup uses.
+
+        They are left behind by records removed or changed outside of the
+        ORM, or whose database was dropped.
+        """
+        keep = set(slot for slot, wal_dir in live._wal_receivers())
+        receivers = dict((slot, None) for slot in self._wal_slots())
+        receivers.update(self.search([('backup_type', '=', 'physical'), ('id', 'not in', live.ids)])._wal_receivers())
+        self._stop_wal_receivers(receivers.items(), keep=keep)
+        return True
 
+    @api.multi
+    def _switch_wal(self):
+        """Close the current WAL segment so pg_receivewal completes it; a no-op when nothing was written."""
+        self.ensure_one()
+        try:
+            with odoo.sql_db.db_connect(self.name).cursor() as cr:
+                cr.execute("SELECT pg_switch_wal()")
+        except Exception as e:
+            # Needs a superuser, or EXECUTE on pg_switch_wal.
+            logger.info('Function: _switch_wal - could not switch the WAL of %s: %s' % (self.name, e))
+
+    @api.multi
+    @contextlib.contextmanager
+    def _wal_target(self, location='local', target=None):
+        """Connect to the WAL directory of a destination: the local folder, the SFTP server or ``target``."""
+        self.ensure_one()
+        wal_dirname = os.path.basename(self._wal_folder(''))
+        if target:
+            with target._connect(wal_dirname) as wal_target:
+                yield wal_target
+        elif location == 'local':
+            yield targets.LocalTarget(self._wal_folder(self._prepare_backup_folder()))
+        else:
+            with self._sftp_session() as (s, sftp):
+                yield targets.SftpTarget(sftp, os.path.join(self.sftp_path, wal_dirname))
+
+    @api.multi
+    def _archive_wal(self):
+        """Keep pg_receivewal running and send the completed WAL segments to the destinations.
+
+        Each destination is tried on its own, so an unreachable one only
+        delays its own copy of the WAL.
+        """
+        self.ensure_one()
+        rec = self
+        wal_dir = rec._wal_folder(rec._prepare_backup_folder())
+        started = rec._ensure_wal_receiver()
+        age = physical.last_segment_age(wal_dir)
+        if not started and rec.wal_switch_minutes > 0 and (age is None or age > rec.wal_switch_minutes * 60):
+            rec._switch_wal()
+
+        local = sftp_sync.local_snapshot(wal_dir, physical.is_wal_file)
+        destinations = []
+        if rec.sftp_write is True:
+            destinations.append((rec.sftp_host, rec._upload_throttle(), self.env['dailybackup.backup.target']))
+        for target in rec.target_ids:
+            destinations.append((target.name, target._upload_throttle(), target))
+        failed = []
+        for name, upload_throttle, target in destinations:
+            try:
+                with rec._wal_target('remote', target) as wal_target:
+                    to_upload = sftp_sync.files_to_upload(local, wal_target.listdir())
+                    for f in to_upload:
+                        wal_target.put(os.path.join(wal_dir, f), f, throttle=upload_throttle)
+                logger.info('Function: _archive_wal - Parameters: database: %s - destination: %s - '
+                            'uploaded: %s' % (rec.name, name, len(to_upload)))
+            except Exception as e:
+                logger.exception('Function: _archive_wal - could not send the WAL of %s to %s' % (rec.name, name))
+                failed.append('%s: %s' % (name, e))
+        if failed:
+            raise Exception('Function: _archive_wal - could not send the WAL of %s:\n%s' % (rec.name, '\n'.join(failed)))
+        return True
+
+    @api.model
+    def run_wal_archiving(self):
+        """Archive the WAL of the physical backups, called by the WAL archiving cron every minute.
+
+        The receivers and slots no physical backup of an existing database
+        uses any more are removed on the way.
+        """
+        live = self.browse()
+        for rec in self.search([('backup_type', '=', 'physical')]):
+            try:
+                if not rec._database_exists():
+                    logger.info('Function: run_wal_archiving - database %s is gone, its WAL archiving stops' % rec.name)
                     continue
+            except Exception:
+                # The server listing the databases may only be unreachable for a while.
+                logger.exception('Function: run_wal_archiving - could not look %s up' % rec.name)
+            live |= rec
+            try:
+                rec._archive_wal()
+            except Exception:
+                logger.exception('Function: run_wal_archiving - WAL archiving of %s failed' % rec.name)
+        try:
+            self._stop_orphan_wal_receivers(live)
+        except Exception:
+            logger.exception('Function: run_wal_archiving - could not stop the orphaned WAL receivers')
+        return True
+
+    @api.multi
+    def _prune_wal(self, location, target=None):
+        """Remove the WAL that no base backup kept on a destination needs any more.
+
+        Nothing is removed while the destination has no base backup.
+        """
+        self.ensure_one()
+        artifacts = self.env['dailybackup.backup.artifact'].search([
+            ('backup_id', '=', self.id),
+            ('location', '=', location),
+            ('target_id', '=', target.id if target else False),
+            ('state', '=', 'present'),
+        ])
+        starts = [parse_backup_filename(artifact.name)[0] for artifact in artifacts
+                  if self._is_backup_file(artifact.name)]
+        if not starts:
+            return 0
+        with self._wal_target(location, target) as wal_target:
+            expired = physical.expired_wal(wal_target.listdir(), min(starts))
+            failed = wal_target.remove_files(expired)
+        logger.info('Function: _prune_wal - Parameters: database: %s - location: %s - target: %s - removed: %s - '
+                    'failed: %s' % (self.name, location, target and target.name, len(expired) - len(failed),
+                                    len(failed)))
+        return len(expired) - len(failed)
+
+    @api.multi
+    def benchmark_compression(self):
+        """Compare the throughput and ratio of every codec on a sample of the database."""
+        self.ensure_one()
+        sample_size = max(self.benchmark_sample_mb, 1) * 1024 * 1024
+        tmp_dir = tempfile.mkdtemp(prefix='dailybackup-')
+        try:
+            # The first megabytes of an uncompressed dump are the sample.
+            sample_path = os.path.join(tmp_dir, 'sample')
+            with open(sample_path, 'wb') as fp:
+                try:
+                    self._dump_uncompressed(LimitedWriter(fp, sample_size))
+                except SampleFull:
+                    pass
+            # The level is the one of the configured codec, the others are measured at their default one.
+            results = compression.benchmark(sample_path, ['zlib', 'zstd', 'lz4'],
+                                            levels={self.compression: self.compression_level},
+                                            threads=self.compression_threads)
+            sample_mb = os.path.getsize(sample_path) / 1024.0 / 1024.0
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
+        lines = []
+        for result in results:
+            if result.get('error'):
+                lines.append('%s: %s' % (result['codec'], result['error']))
             else:
-                logger.debug("database %s doesn't exist on http://%s:%s" % (rec.name, rec.host, rec.port))
-                logger.info("Function: schedule_backup_process - database %s "
-                            "doesn't exist on http://%s:%s" % (rec.name, rec.host, rec.port))
+                lines.append('%(codec)s (level %(level)s): %(mb_per_second).1f MB/s - ratio %(ratio).2f - '
+                             '%(seconds).1fs' % result)
+        logger.info('Function: benchmark_compression - Parameters: sample_mb: %.1f - results: %s' % (
+            sample_mb, results))
+        raise Warning(_("Compression benchmark on %.1f MB of %s (%s threads)\n\n") % (
+            sample_mb, self.name, self.compression_threads) + '\n'.join(lines))
 
-            # Check if user wants to write to SFTP or not.
-            if rec.sftp_write is True:
+    @api.constrains('compression')
+    def _check_compression(self):
+        for rec in self:
+            if rec.compression != 'none' and not compression.is_available(rec.compression):
+                raise ValidationError(_('The python package %s is needed for the %s compression.') % (
+                    compression.PACKAGES[rec.compression], rec.compression))
+
+    @api.constrains('backup_type', 'target_ids')
+    def _check_targets(self):
+        for rec in self:
+            if rec.backup_type == 'incremental' and rec.target_ids:
+                raise ValidationError(_('Incremental backups can only be sent to the SFTP server, their chunk store '
+                                        'is not copied to other targets.'))
+
+    @api.constrains('keep_daily', 'keep_weekly', 'keep_monthly')
+    def _check_retention(self):
+        for rec in self:
+            if min(rec.keep_daily, rec.keep_weekly, rec.keep_monthly) < 0:
+                raise ValidationError(_('The number of backups to keep cannot be negative.'))
+
+    @api.constrains('checksum_algorithm')
+    def _check_checksum_algorithm(self):
+        for rec in self:
+            if not integrity.is_available(rec.checksum_algorithm):
+                raise ValidationError(_('The python package %s is needed for %s checksums.') % (
+                    integrity.PACKAGES[rec.checksum_algorithm], rec.checksum_algorithm))
+
+    @api.multi
+    def _get_incremental_manifests(self, folder_path):
+        """Return the paths of the incremental manifests of this database, oldest first."""
+        self.ensure_one()
+        suffix = '_%s.%s' % (self.name, chunking.MANIFEST_EXTENSION)
+        return sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith(suffix))
+
+    @api.multi
+    def _dump_incremental(self, folder_path, manifest_path):
+        """Write an incremental backup: new chunks in the chunk store plus a manifest."""
+        self.ensure_one()
+        rec = self
+        store = chunking.ChunkStore(os.path.join(folder_path, chunking.CHUNKS_DIRECTORY))
+        manifests = rec._get_incremental_manifests(folder_path)
+        previous = chunking.read_manifest(manifests[-1]) if manifests else None
+
+        with odoo.sql_db.db_connect(rec.name).cursor() as cr:
+            odoo_manifest = odoo.service.db.dump_db_manifest(cr)
+
+        # A plain SQL dump: the custom format is compressed, which would
+        # change every chunk on every run.
+        # The garbage collection of another database of the folder must not
+        # remove a chunk this backup reuses before its manifest is written.
+        with store.locked():
+            pop = subprocess.Popen([odoo.tools.find_pg_tool('pg_dump'), '--no-owner', rec.name],
+                                   env=odoo.tools.exec_pg_environ(), stdout=subprocess.PIPE)
+            try:
+                manifest = chunking.build_manifest(store, rec.name, pop.stdout,
+                                                   odoo.tools.config.filestore(rec.name), odoo_manifest,
+                                                   previous=previous)
+            finally:
+                pop.stdout.close()
+                returncode = pop.wait()
+            if returncode:
+                raise Exception('pg_dump of %s exited with code %s' % (rec.name, returncode))
+
+            tmp_path = manifest_path + '.tmp'
+            with open(tmp_path, 'w') as fp:
+                json.dump(manifest, fp)
+            os.rename(tmp_path, manifest_path)
+        logger.info('Function: _dump_incremental - Parameters: manifest_path: %s - new_chunks: %s - '
+                    'new_bytes: %s' % (manifest_path, manifest['new_chunks'], manifest['new_bytes']))
+        return manifest_path
+
+    @api.model
+    def restore_physical_backup(self, backup_path, data_dir, target_time=None, wal_dir=None, filestore_path=None):
+        """Restore a physical backup into a new PostgreSQL data directory, for a point-in-time recovery.
+
+        The base backup is extracted into ``data_dir`` and set up to replay
+        the archived WAL of ``wal_dir`` (the WAL folder next to the backup by
+        default) up to ``target_time``, or to the end of the archive. A
+        PostgreSQL server of the same major version started on ``data_dir``
+        then runs the recovery. The filestore is extracted into
+        ``filestore_path`` (``<data_dir>_filestore`` by default), to be moved
+        into the filestore of Odoo.
+        """
+        parsed = parse_backup_filename(os.path.basename(backup_path))
+        if not parsed:
+            raise ValidationError(_('%s is not a backup file.') % backup_path)
+        wal_dir = os.path.abspath(wal_dir or os.path.join(os.path.dirname(backup_path), '%s_wal' % parsed[1]))
+        filestore_path = filestore_path or data_dir.rstrip('/') + '_filestore'
+        codec = compression.codec_of(backup_path)
+        with open(backup_path, 'rb') as fp, tempfile.TemporaryFile() as spool:
+            source = fp
+            if codec:
+                # zipfile needs a seekable file.
+                shutil.copyfileobj(compression.open_reader(fp, codec), spool, compression.BLOCK_SIZE)
+                spool.seek(0)
+                source = spool
+            with zipfile.ZipFile(source) as archive:
+                manifest = json.loads(archive.read('manifest.json').decode('utf-8'))
+                physical.extract_base(archive, data_dir)
+                files = physical.extract_filestore(archive, filestore_path)
+        pg_major = int(str(manifest.get('pg_version') or '12').split('.')[0])
+        physical.write_recovery_config(data_dir, wal_dir, pg_major, target_time)
+        logger.info('Function: restore_physical_backup - Parameters: backup_path: %s - data_dir: %s - '
+                    'target_time: %s - wal_dir: %s - filestore files: %s' % (backup_path, data_dir, target_time,
+                                                                            wal_dir, files))
+        return True
+
+    @api.model
+    def restore_incremental_backup(self, manifest_path, db_name):
+        """Restore an incremental backup into a new database ``db_name``.
+
+        The manifest and the chunk store next to it are turned back into a
+        regular zip archive, which is then restored by Odoo.
+        """
+        manifest = chunking.read_manifest(manifest_path)
+        store = chunking.ChunkStore(os.path.join(os.path.dirname(manifest_path), chunking.CHUNKS_DIRECTORY))
+        tmp_dir = tempfile.mkdtemp(prefix='dailybackup-')
+        try:
+            zip_path = chunking.rebuild_archive(manifest, store, os.path.join(tmp_dir, 'restore.zip'))
+            odoo.service.db.restore_db(db_name, zip_path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.info('Function: restore_incremental_backup - Parameters: manifest_path: %s - '
+                    'db_name: %s' % (manifest_path, db_name))
+        return True
+
+    @api.multi
+    @contextlib.contextmanager
+    def _sftp_session(self):
+        """Borrow an SSH/SFTP session to the SFTP server of the record from the pool.
+
+        :return: context manager giving a tuple ``(ssh_client, sftp_client)``
+        """
+        self.ensure_one()
+        with SFTP_POOL.session(self.sftp_host, self.sftp_port, self.sftp_user, self.sftp_password) as (s, sftp):
+            yield s, sftp
+
+    @api.model
+    def _sftp_ensure_dir(self, sftp, path_to_write_to):
+        try:
+            sftp.chdir(path_to_write_to)
+            logger.info('Function: _sftp_ensure_dir - Parameters: '
+                        'path_to_write_to: %s' % path_to_write_to)
+
+        except IOError:
+            # Create directory and subdirs if they do not exist.
+            current_dir = ''
+            for dirElement in path_to_write_to.split('/'):
+                current_dir += dirElement + '/'
+                logger.info('Function: _sftp_ensure_dir - Parameters: '
+                            'current_dir: %s' % current_dir)
                 try:
-                    # Store all values in variables
-                    sftp = None
-                    dir = folder_path
-                    path_to_write_to = rec.sftp_path
-                    ip_host = rec.sftp_host
-                    port_host = rec.sftp_port
-                    user_name_login = rec.sftp_user
-                    password_login = rec.sftp_password
-
-                    logger.debug('sftp remote path: %s' % path_to_write_to)
-
-                    logger.info('Function: schedule_backup_process - Parameters: path_to_write_to: '
-                                '%s - ip_host: %s - port_host: %s - user_name_login: %s - '
-                                'password_login: %s' % (
-                                    path_to_write_to, ip_host, port_host, user_name_login, password_login))
+                    sftp.chdir(current_dir)
+                except:
+                    logger.info('(Part of the) path didn\'t exist. Creating it now at ' + current_dir)
 
-                    try:
-                        s = paramiko.SSHClient()
-                        s.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                        s.connect(ip_host, port_host, user_name_login, password_login, timeout=20)
-                        sftp = s.open_sftp()
-                        logger.info('Function: schedule_backup_process - success connecting to remote')
-                    except Exception as error:
-                        logger.critical('Error connecting to remote server! Error: ' + str(error))
-                        logger.info('Function: schedule_backup_process - Error connecting to remote'
-                                    ' server! Error: ' + str(error))
+                    # Make directory and then navigate into it
+                    sftp.mkdir(current_dir, 777)
+                    sftp.chdir(current_dir)
+                    pass
+        sftp.chdir(path_to_write_to)
+
+    @api.multi
+    def _is_backup_file(self, filename):
+        """Tell whether ``filename`` is a backup written for the database of this record."""
+        self.ensure_one()
+        parsed = parse_backup_filename(filename)
+        return bool(parsed) and parsed[1] == self.name
 
+    @api.multi
+    def _upload_to_sftp(self, folder_path):
+        """Upload the backups of the folder the SFTP server does not have yet.
+
+        Every file is tried; an error is raised afterwards when one of them
+        failed, so the upload job is retried.
+        """
+        self.ensure_one()
+        rec = self
+        # Store all values in variables
+        dir = folder_path
+        path_to_write_to = rec.sftp_path
+
+        logger.info('Function: _upload_to_sftp - Parameters: path_to_write_to: '
+                    '%s - ip_host: %s - port_host: %s - user_name_login: %s' % (
+                        path_to_write_to, rec.sftp_host, rec.sftp_port, rec.sftp_user))
+
+        failed, uploaded = [], []
+        with rec._sftp_session() as (s, sftp):
+            self._sftp_ensure_dir(sftp, path_to_write_to)
+
+            # One listing of each side instead of a stat per file.
+            local = sftp_sync.local_snapshot(dir, rec._is_backup_file)
+            remote = sftp_sync.remote_snapshot(sftp, path_to_write_to)
+            to_upload = sftp_sync.files_to_upload(local, remote)
+            logger.info('Function: _upload_to_sftp - Parameters: local files: %s - remote files: %s - '
+                        'to upload: %s' % (len(local), len(remote), len(to_upload)))
+
+            remote_chunks = None
+            with metrics.stage('upload'):
+                for f in to_upload:
+                    fullpath = os.path.join(dir, f)
                     try:
-                        sftp.chdir(path_to_write_to)
-                        logger.info('Function: schedule_backup_process - Parameters: '
-                                    'path_to_write_to: %s' % path_to_write_to)
+                        if f.endswith('.' + chunking.MANIFEST_EXTENSION):
+                            # The chunks go first, so a remote manifest
+                            # never refers to a missing chunk.
+                            remote_chunks = rec._sftp_upload_chunks(sftp, fullpath, remote_chunks)
+                        remote_path = os.path.join(path_to_write_to, f)
+                        local_artifact = self.env['dailybackup.backup.artifact'].search(
+                            [('backup_id', '=', rec.id), ('location', '=', 'local'), ('path', '=', fullpath)],
+                            limit=1)
+                        remote[f], verified = rec._sftp_put(s, sftp, fullpath, remote_path, local_artifact)
+                        logger.info('Copying File % s------ success' % fullpath)
+                        metrics.add('bytes_uploaded', remote[f].st_size)
+                        uploaded.append((remote_path, {
+                            'location': 'remote', 'size': remote[f].st_size, 'checksum': local_artifact.checksum,
+                            'algorithm': local_artifact.checksum_algorithm, 'verified': bool(verified)}))
+                    except Exception as err:
+                        logger.critical(
+                            'We couldn\'t write the file to the remote server. Error: ' + str(err))
+                        logger.info('Copying File % s------ failed' % fullpath)
+                        failed.append('%s: %s' % (f, err))
 
-                    except IOError:
-                        # Create directory and subdirs if they do not exist.
-                        current_dir = ''
-                        for dirElement in path_to_write_to.split('/'):
-                            current_dir += dirElement + '/'
-                            logger.info('Function: schedule_backup_process - Parameters: '
-                                        'current_dir: %s' % current_dir)
-                            try:
-                                sftp.chdir(current_dir)
-                            except:
-                                logger.info('(Part of the) path didn\'t exist. Creating it now at ' + current_dir)
-
-                                # Make directory and then navigate into it
-                                sftp.mkdir(current_dir, 777)
-                                sftp.chdir(current_dir)
-                                pass
-                    sftp.chdir(path_to_write_to)
-
-                    logger.info('Function: schedule_backup_process - The new file is ' + str(rec.name))
-
-
-                    # Loop over all files in the directory.
-                    for f in os.listdir(dir):
-                        logger.info('Function: schedule_backup_process - Start looping the '
-                                    'directory to upload the new file :' + str(f))
-                        if rec.name in f:
-                            logger.info('Function: schedule_backup_process - Start looping : directory')
-                            fullpath = os.path.join(dir, f)
-                            logger.info('Function: schedule_backup_process - Parameters: '
-                                        'fullpath: %s' % fullpath)
-                            if os.path.isfile(fullpath):
-                                try:
-                                    sftp.stat(os.path.join(path_to_write_to, f))
-                                    logger.debug(
-                                        'File %s already exists on the remote FTP Server ------ skipped' % fullpath)
-                                # This means the file does not exist (remote) yet!
-                                except IOError:
-                                    try:
-                                        # sftp.put(fullpath, path_to_write_to)
-                                        sftp.put(fullpath, os.path.join(path_to_write_to, f))
-                                        logger.info('Copying File % s------ success' % fullpath)
-                                    except Exception as err:
-                                        logger.critical(
-                                            'We couldn\'t write the file to the remote server. Error: ' + str(err))
-                                        logger.info('Copying File % s------ failed' % fullpath)
-
-                        # Navigate in to the correct folder.
-                        sftp.chdir(path_to_write_to)
-
-                        # Loop over all files in the directory from the back-ups.
-                        # We will check the creation date of every back-up.
-                        for file in sftp.listdir(path_to_write_to):
-                            if rec.name in file:
-                                # Get the full path
-                                fullpath = os.path.join(path_to_write_to, file)
-
-                                # Get the timestamp from the file on the external server
-                                timestamp = sftp.stat(fullpath).st_atime
-                                createtime = datetime.datetime.fromtimestamp(timestamp)
-                                now = datetime.datetime.now()
-                                delta = now - createtime
-
-                                # If the file is older than the days_to_keep_sftp
-                                # (the days to keep that the user filled in on the Odoo form it will be removed.
-                                if delta.days >= rec.days_to_keep_sftp:
-                                    # Only delete files, no directories!
-                                    if sftp.isfile(fullpath) and (".dump" in file or '.zip' in file):
-                                        logger.info("Delete too old file from SFTP servers: " + file)
-                                        sftp.unlink(file)
-                    # Close the SFTP session.
-                    sftp.close()
+        artifacts = self.env['dailybackup.backup.artifact']
+        if failed:
+            # The job is rolled back, and its retry skips the files already on the server: catalog them now.
+            for remote_path, values in uploaded:
+                artifacts._record_committed(rec, remote_path, **values)
+            raise Exception('Function: _upload_to_sftp - We could not back up to the FTP server:\n' +
+                            '\n'.join(failed))
+        for remote_path, values in uploaded:
+            artifacts._record(rec, remote_path, **values)
+
+    @api.multi
+    def _sftp_put(self, s, sftp, fullpath, remote_path, local_artifact=None):
+        """Upload one backup, over several resumable channels when it is large enough.
+
+        When ``verify_upload`` is set and the catalog has the checksum of the
+        file, the server hashes its copy and the upload fails on a mismatch.
+
+        :return: tuple ``(SFTPAttributes of the remote file, whether the checksum was verified)``
+        """
+        self.ensure_one()
+        checksum = self.verify_upload and local_artifact and local_artifact.checksum
+        algorithm = (local_artifact and local_artifact.checksum_algorithm) or 'sha256'
+        threshold = max(self.multipart_threshold_mb, 1) * 1024 * 1024
+        upload_throttle = self._upload_throttle()
+        if not self.multipart_upload or os.path.getsize(fullpath) < threshold:
+            attr = sftp.put(fullpath, remote_path, callback=upload_throttle and throttle.put_callback(upload_throttle))
+            verified = checksum and self._verify_remote_file(s, sftp, remote_path, checksum, algorithm)
+            return attr, verified
+        # The multipart upload checks the checksum before moving the file into place.
+        upload = MultipartUpload(s, fullpath, remote_path,
+                                 part_size=max(self.multipart_part_size_mb, 1) * 1024 * 1024,
+                                 channels=self.multipart_channels, throttle=upload_throttle,
+                                 expected_hash=checksum or None, algorithm=algorithm)
+        attr = upload.run()
+        return attr, checksum and upload.verified
+
+    @api.model
+    def _verify_remote_file(self, s, sftp, remote_path, checksum, algorithm='sha256'):
+        """Compare the checksum computed by the SFTP server with ``checksum``, without downloading the file.
+
+        A copy that does not match is removed from the server.
+
+        :return: True when verified, None when the server cannot compute the checksum
+        """
+        remote_hash = remote_file_hash(s, remote_path, algorithm)
+        if remote_hash is None:
+            logger.info('Function: _verify_remote_file - no remote %s for %s, only the size was checked' % (
+                algorithm, remote_path))
+            return None
+        if remote_hash != checksum:
+            try:
+                sftp.remove(remote_path)
+            except IOError:
+                pass
+            raise UploadVerificationError('Remote %s of %s differs from the local file' % (algorithm, remote_path))
+        return True
 
+    @api.multi
+    def _upload_throttle(self):
+        """Rate limiter shared by all the uploads to the SFTP server of the record, None when not limited."""
+        self.ensure_one()
+        return self.env['dailybackup.bandwidth.limit']._for_host(self.sftp_host)._throttle()
+
+    @api.multi
+    def _seconds_until_upload_window(self):
+        """Seconds before uploads to the SFTP server of the record are allowed, 0 when they are now."""
+        self.ensure_one()
+        return self.env['dailybackup.bandwidth.limit']._for_host(self.sftp_host)._seconds_until_window()
+
+    @api.multi
+    def _sftp_upload_chunks(self, sftp, manifest_path, remote_chunks=None):
+        """Upload the chunks of an incremental manifest the SFTP server does not have yet.
+
+        The chunks already on the server the manifest reuses are touched
+        when they get old, so the garbage collection of another database
+        does not delete them before this manifest is uploaded; a chunk that
+        is gone meanwhile is uploaded again.
+
+        :param remote_chunks: dict of the chunk hashes already on the server
+            and their modification time, listed once and then kept up to
+            date across manifests
+        :return: the updated dict of remote chunks
+        """
+        self.ensure_one()
+        remote_dir = os.path.join(self.sftp_path, chunking.CHUNKS_DIRECTORY)
+        if remote_chunks is None:
+            try:
+                remote_chunks = dict((attr.filename, attr.st_mtime) for attr in sftp.listdir_attr(remote_dir))
+            except IOError:
+                sftp.mkdir(remote_dir)
+                remote_chunks = {}
+        store = chunking.ChunkStore(os.path.join(os.path.dirname(manifest_path), chunking.CHUNKS_DIRECTORY))
+        needed = chunking.manifest_chunks(chunking.read_manifest(manifest_path))
+        missing = set(chunk_hash for chunk_hash in needed if chunk_hash not in remote_chunks)
+        touch_limit = time.time() - chunking.REMOTE_TOUCH_AGE
+        touched = 0
+        for chunk_hash in needed - missing:
+            if remote_chunks[chunk_hash] >= touch_limit:
+                continue
+            try:
+                sftp.utime(os.path.join(remote_dir, chunk_hash), None)
+            except IOError:
+                missing.add(chunk_hash)
+                continue
+            remote_chunks[chunk_hash] = time.time()
+            touched += 1
+        upload_throttle = self._upload_throttle()
+        for chunk_hash in missing:
+            remote_path = os.path.join(remote_dir, chunk_hash)
+            sftp.put(store.path(chunk_hash), remote_path + '.part',
+                     callback=upload_throttle and throttle.put_callback(upload_throttle))
+            sftp.posix_rename(remote_path + '.part', remote_path)
+            remote_chunks[chunk_hash] = time.time()
+        logger.info('Function: _sftp_upload_chunks - Parameters: manifest_path: %s - uploaded chunks: %s - '
+                    'touched chunks: %s' % (manifest_path, len(missing), touched))
+        return remote_chunks
+
+    @api.multi
+    def _sftp_collect_chunk_garbage(self, sftp):
+        """Delete the remote chunks no remote manifest refers to.
+
+        The manifests are listed after the chunks, and every chunk is looked
+        at again right before it is deleted: a backup of another database
+        uploaded meanwhile either has its manifest read here or touched the
+        chunks it reuses (see ``_sftp_upload_chunks``).
+        """
+        self.ensure_one()
+        remote_dir = os.path.join(self.sftp_path, chunking.CHUNKS_DIRECTORY)
+        # Chunks of a backup that is still being uploaded have no manifest yet.
+        limit = time.time() - chunking.GARBAGE_MIN_AGE
+        try:
+            remote_chunks = set(attr.filename for attr in sftp.listdir_attr(remote_dir) if attr.st_mtime < limit)
+        except IOError:
+            return 0
+        referenced = set()
+        for file in sftp.listdir(self.sftp_path):
+            if file.endswith('.' + chunking.MANIFEST_EXTENSION):
+                with sftp.open(os.path.join(self.sftp_path, file), 'r') as fp:
+                    referenced |= chunking.manifest_chunks(json.loads(fp.read().decode('utf-8')))
+        removed = 0
+        for chunk_hash in remote_chunks - referenced:
+            path = os.path.join(remote_dir, chunk_hash)
+            try:
+                if sftp.stat(path).st_mtime >= limit:
+                    continue
+                sftp.remove(path)
+            except IOError as e:
+                logger.info('Function: _sftp_collect_chunk_garbage - could not delete %s: %s' % (chunk_hash, e))
+                continue
+            removed += 1
+        logger.info('Function: _sftp_collect_chunk_garbage - removed chunks: %s' % removed)
+        return removed
+
+    @api.multi
+    def _remove_old_sftp_backups(self, sftp, remote=None):
+        """Delete the backups older than ``days_to_keep_sftp`` from the SFTP server.
+
+        :param remote: snapshot of the remote backup directory, listed here when not given
+        """
+        self.ensure_one()
+        with metrics.stage('retention'):
+            self._remove_old_sftp_files(sftp, remote)
+
+    @api.multi
+    def _remove_old_sftp_files(self, sftp, remote=None):
+        rec = self
+        path_to_write_to = rec.sftp_path
+        if remote is None:
+            remote = sftp_sync.remote_snapshot(sftp, path_to_write_to)
+
+        if rec.retention_policy == 'gfs':
+            expired = sorted(artifact.name for artifact in rec._expired_artifacts('remote')
+                             if artifact.path == os.path.join(path_to_write_to, artifact.name) and
+                             artifact.name in remote)
+        else:
+            # If the file is older than the days_to_keep_sftp
+            # (the days to keep that the user filled in on the Odoo form it will be removed.
+            expired = sftp_sync.expired_files(remote, rec._is_backup_file, rec.days_to_keep_sftp)
+        for file in expired:
+            logger.info("Delete too old file from SFTP servers: " + file)
+        failed = sftp_sync.remove_files(sftp, path_to_write_to, expired, remote)
+        self.env['dailybackup.backup.artifact'].search([
+            ('backup_id', '=', rec.id),
+            ('location', '=', 'remote'),
+            ('target_id', '=', False),
+            ('state', '=', 'present'),
+            ('path', 'in', [os.path.join(path_to_write_to, file) for file in expired if file not in failed]),
+        ]).write({'state': 'deleted'})
+
+        if rec.backup_type == 'incremental':
+            rec._sftp_collect_chunk_garbage(sftp)
+
+    @api.multi
+    def _stream_dump(self, folder_path):
+        """Dump the database once and stream it to every destination at the same time, without a local copy.
+
+        The dump runs on this thread and is fanned out to one upload thread
+        per destination (the SFTP server and the targets). Each of them
+        reads its own buffer, which spills to a temporary file of at most
+        ``stream_spool_mb`` when it falls behind, so a slow destination
+        slows down neither the dump nor the others until its spool is
+        full. When ``stream_keep_local`` is set the dump is also teed
+        into the backup folder.
+
+        :return: path of the backup on the first destination that got it
+        :raise: when the dump failed, or when a destination missed it and
+            there is no local copy for its upload job to send later
+        """
+        self.ensure_one()
+        rec = self
+        bkp_file = rec._backup_filename()
+        local_path = rec.stream_keep_local and os.path.join(folder_path, bkp_file)
+        max_buffer = max(rec.stream_buffer_mb or 0, 1) * 1024 * 1024
+        artifact_obj = self.env['dailybackup.backup.artifact']
+        hasher = []
+        verified = {}
+
+        # (name, remote path, consumer, target, empty for the SFTP server)
+        destinations = []
+        if rec.sftp_write is True:
+            remote_path = os.path.join(rec.sftp_path, bkp_file)
+            destinations.append((rec.sftp_host, remote_path, rec._sftp_stream_consumer(remote_path, hasher, verified),
+                                 None))
+        for target in rec.target_ids:
+            destinations.append((target.name, os.path.join(target.path, bkp_file), target._stream_consumer(bkp_file),
+                                 target))
+
+        # A single destination has no other destination to keep up with: it throttles the dump instead.
+        max_spool = max(rec.stream_spool_mb or 0, 0) * 1024 * 1024 if len(destinations) > 1 else 0
+
+        logger.info('Function: _stream_dump - Parameters: bkp_file: %s - destinations: %s - '
+                    'local_path: %s - max_buffer: %s - max_spool: %s' % (
+                        bkp_file, ', '.join(d[0] for d in destinations), local_path, max_buffer, max_spool))
+
+        def produce(stream):
+            if local_path:
+                with open(local_path, 'wb') as fp:
+                    hasher.append(integrity.HashingWriter(TeeWriter(stream, fp), rec.checksum_algorithm))
+                    rec._write_dump(hasher[0])
+            else:
+                hasher.append(integrity.HashingWriter(stream, rec.checksum_algorithm))
+                rec._write_dump(hasher[0])
+
+        try:
+            size, errors = fan_out(produce, [d[2] for d in destinations], max_buffer=max_buffer, max_spool=max_spool)
+        except Exception as e:
+            logger.critical('Function: _stream_dump - We could not dump %s. Error: %s' % (rec.name, e))
+            if local_path and os.path.exists(local_path):
+                os.remove(local_path)
+            raise
+        checksum = hasher[0].hexdigest()
+        metrics.add('bytes_written', size)
+        if local_path:
+            artifact_obj._record(rec, local_path, checksum=checksum, algorithm=rec.checksum_algorithm)
+
+        received, failed = [], []
+        for index, (name, remote_path, consumer, target) in enumerate(destinations):
+            if index in errors:
+                logger.critical('Function: _stream_dump - We could not stream the backup of %s to %s. '
+                                'Error: %s' % (rec.name, name, errors[index]))
+                metrics.fail('%s: %s' % (name, errors[index]))
+                failed.append('%s: %s' % (name, errors[index]))
+                continue
+            logger.info('Function: _stream_dump - streamed %s bytes to %s' % (size, name))
+            metrics.add('bytes_uploaded', size)
+            received.append((remote_path, target, {
+                'location': 'remote', 'size': size, 'checksum': checksum, 'algorithm': rec.checksum_algorithm,
+                'verified': not target and bool(verified.get('verified'))}))
+        if failed and not (local_path and os.path.exists(local_path)):
+            # No upload job can send the backup to the destinations that missed it: the dump fails and is
+            # run again. Its transaction is rolled back, the copies that did arrive are catalogued now.
+            for remote_path, target, values in received:
+                artifact_obj._record_committed(rec, remote_path, target=target, **values)
+            raise Exception('Function: _stream_dump - We could not stream the backup of %s to:\n%s' % (
+                rec.name, '\n'.join(failed)))
+        for remote_path, target, values in received:
+            artifact_obj._record(rec, remote_path, target=target, **values)
+        # Without any remote copy, the upload jobs send the local one later.
+        return received[0][0] if received else local_path
+
+    @api.multi
+    def _sftp_stream_consumer(self, remote_path, hasher, result):
+        """Fan-out consumer writing the dump to the SFTP server of the record.
+
+        It runs on its own thread, so everything it needs from the record
+        is read here. Once the dump is complete the remote checksum is
+        compared with ``hasher[0]`` when ``verify_upload`` is set, and
+        ``result['verified']`` tells whether it could be.
+        """
+        self.ensure_one()
+        rec = self
+        session_params = (rec.sftp_host, rec.sftp_port, rec.sftp_user, rec.sftp_password)
+        sftp_path = rec.sftp_path
+        remote_tmp_path = remote_path + '.part'
+        upload_throttle = rec._upload_throttle()
+        verify_upload = rec.verify_upload
+        algorithm = rec.checksum_algorithm
+
+        def consume(chunks):
+            with SFTP_POOL.session(*session_params) as (s, sftp):
+                rec._sftp_ensure_dir(sftp, sftp_path)
+                try:
+                    with sftp.open(remote_tmp_path, 'wb') as remote_file:
+                        remote_file.set_pipelined(True)
+                        for chunk in chunks:
+                            if upload_throttle:
+                                upload_throttle(len(chunk))
+                            remote_file.write(chunk)
+                    if verify_upload:
+                        result['verified'] = rec._verify_remote_file(s, sftp, remote_tmp_path,
+                                                                     hasher[0].hexdigest(), algorithm)
+                except Exception:
                     try:
-                        ir_mail_server = self.env['ir.mail_server'].search([('active', '=', 'true')], limit=1)
-                        if ir_mail_server:
-                            message = "Dear,\n\nThe backup for the server " + \
-                                      rec.host + " (IP: " + rec.sftp_host + ") succeeded"
-                            msg = ir_mail_server.build_email(
-                                        email_from=ir_mail_server.smtp_user,
-                                        email_to=[ir_mail_server.smtp_user, rec.email_to_notify],
-                                        subject='Daily Backup : Success',
-                                        body=message,
-                                    )
-                            ir_mail_server.send_email(msg)
-                            logger.info('Function: schedule_backup_process - email sent to inform the success.')
-                    except Exception as e:
-                        logger.info(
-                            'Function: schedule_backup_process - email cannot sent to inform the success due problem ' + str(
-                                e))
-
-                except Exception as e:
-                    logger.debug('Exception! We could not back up to the FTP server..')
-                    if rec.send_mail_sftp_fail:
-                        try:
-                            ir_mail_server = self.env['ir.mail_server'].search([('active', '=', 'true')], limit=1)
-                            if ir_mail_server:
-                                message = "Dear,\n\nThe backup for the server " + \
-                                          rec.host + " (IP: " + rec.sftp_host + ") failed"
-                                msg = ir_mail_server.build_email(
-                                    email_from=ir_mail_server.smtp_user,
-                                    email_to=[ir_mail_server.smtp_user, rec.email_to_notify],
-                                    subject='Daily Backup : Failed',
-                                    body=message,
-                                )
-                                ir_mail_server.send_email(msg)
-                                logger.info('Function: schedule_backup_process - Error due : ' + str(e))
-                        except Exception as e:
-                            logger.info(
-                                'Function: schedule_backup_process - email cannot sent to inform '
-                                'the failed due problem ' + str(e))
-
-
-
-
-            """
-            Remove all old files (on local server) in case this is configured..
-            """
-            if rec.autoremove:
-                dir = folder_path
-                # Loop over all files in the directory.
+                        sftp.remove(remote_tmp_path)
+                    except IOError:
+                        pass
+                    raise
+                sftp.posix_rename(remote_tmp_path, remote_path)
+        return consume
+
+    @api.multi
+    def _send_backup_mail(self, success, error=None):
+        self.ensure_one()
+        with metrics.stage('mail'):
+            self._send_backup_mail_now(success, error)
+
+    @api.multi
+    def _send_backup_mail_now(self, success, error=None):
+        rec = self
+        try:
+            ir_mail_server = self.env['ir.mail_server'].search([('active', '=', 'true')], limit=1)
+            if ir_mail_server:
+                message = "Dear,\n\nThe backup for the server " + \
+                          rec.host + " (IP: " + (rec.sftp_host or '') + ") " + ("succeeded" if success else "failed")
+                msg = ir_mail_server.build_email(
+                    email_from=ir_mail_server.smtp_user,
+                    email_to=[ir_mail_server.smtp_user, rec.email_to_notify],
+                    subject='Daily Backup : Success' if success else 'Daily Backup : Failed',
+                    body=message,
+                )
+                ir_mail_server.send_email(msg)
+                if success:
+                    logger.info('Function: _send_backup_mail - email sent to inform the success.')
+                else:
+                    logger.info('Function: _send_backup_mail - Error due : ' + str(error))
+        except Exception as e:
+            logger.info(
+                'Function: _send_backup_mail - email cannot sent to inform the result due problem ' + str(e))
+
+    @api.multi
+    def _adopt_local_files(self, folder_path):
+        """Add the backups already in the folder before the catalog existed to it."""
+        self.ensure_one()
+        artifact_obj = self.env['dailybackup.backup.artifact']
+        known = set(self.artifact_ids.filtered(lambda a: a.location == 'local').mapped('path'))
+        adopted = 0
+        for entry in os.scandir(folder_path):
+            parsed = parse_backup_filename(entry.name)
+            if parsed and parsed[1] == self.name and entry.path not in known and entry.is_file():
+                artifact_obj._record(self, entry.path, size=entry.stat().st_size, backup_date=parsed[0])
+                adopted += 1
+        logger.info('Function: _adopt_local_files - Parameters: folder_path: %s - adopted: %s' % (
+            folder_path, adopted))
+        return adopted
+
+    @api.multi
+    def _retention_plan(self, domain=None):
+        """Apply the daily / weekly / monthly policy to the catalog, for all the destinations in one pass.
+
+        Only the catalog is read: files that are not in it are never removed.
+
+        :param domain: restricts the artifacts taken into account
+        :return: dict ``{(location, target id): (kept, expired)}``, ``kept`` being a dict
+            ``{artifact: [reasons]}`` and ``expired`` the artifacts to remove
+        """
+        self.ensure_one()
+        artifact_obj = self.env['dailybackup.backup.artifact']
+        destinations = {}
+        for artifact in artifact_obj.search([('backup_id', '=', self.id), ('state', '=', 'present')] + (domain or [])):
+            if self._is_backup_file(artifact.name):
+                destinations.setdefault((artifact.location, artifact.target_id.id), []).append(artifact)
+        plan = {}
+        for destination, artifacts in destinations.items():
+            keep = retention.gfs_keep([(artifact, artifact.backup_date) for artifact in artifacts],
+                                      daily=self.keep_daily, weekly=self.keep_weekly, monthly=self.keep_monthly)
+            plan[destination] = (keep, artifact_obj.browse([a.id for a in artifacts if a not in keep]))
+        return plan
+
+    @api.multi
+    def _expired_artifacts(self, location, target=None):
+        """Backups of one destination the daily / weekly / monthly policy removes."""
+        self.ensure_one()
+        target_id = target.id if target else False
+        plan = self._retention_plan([('location', '=', location), ('target_id', '=', target_id)])
+        return plan.get((location, target_id), ({}, self.env['dailybackup.backup.artifact']))[1]
+
+    @api.multi
+    def action_preview_retention(self):
+        """Show what the daily / weekly / monthly policy would remove now, without removing anything."""
+        self.ensure_one()
+        destination_names = {
+            ('local', False): _('Local folder'),
+            ('remote', False): _('SFTP server %s') % (self.sftp_host or ''),
+        }
+        for target in self.with_context(active_test=False).target_ids:
+            destination_names[('remote', target.id)] = target.name
+        lines = []
+        plan = self._retention_plan()
+        for destination in sorted(plan, key=lambda d: (d[0], d[1] or 0)):
+            keep, expired = plan[destination]
+            lines.append(_('%s: %s kept, %s removed (%.1f MB freed)') % (
+                destination_names.get(destination, destination[0]), len(keep), len(expired),
+                sum(expired.mapped('size')) / 1024.0 / 1024.0))
+            for artifact, reasons in sorted(keep.items(), key=lambda item: item[0].backup_date, reverse=True):
+                lines.append('    + %s (%s)' % (artifact.name, ', '.join(reasons)))
+            for artifact in expired.sorted(lambda a: a.backup_date, reverse=True):
+                lines.append('    - %s' % artifact.name)
+            lines.append('')
+        logger.info('Function: action_preview_retention - Parameters: database: %s - destinations: %s' % (
+            self.name, len(plan)))
+        raise Warning(_('Retention preview for %s (keep %s daily, %s weekly, %s monthly)\n\n') % (
+            self.name, self.keep_daily, self.keep_weekly, self.keep_monthly) +
+            ('\n'.join(lines) or _('No backup in the catalog.')))
+
+    @api.multi
+    def action_restore(self):
+        """Open a new restore of the latest backup, from the local folder when it is still there."""
+        self.ensure_one()
+        if self.backup_type == 'physical':
+            raise Warning(_('Physical backups restore a whole PostgreSQL cluster, use restore_physical_backup '
+                            'for them.'))
+        artifacts = self.env['dailybackup.backup.artifact'].search([
+            ('backup_id', '=', self.id), ('state', '=', 'present'), ('name', 'not like', '.physical')])
+        if not artifacts:
+            raise Warning(_('There is no backup of %s to restore.') % self.name)
+        latest = artifacts.filtered(lambda a: a.name == artifacts[0].name)
+        return (latest.filtered(lambda a: a.location == 'local') or latest)[0].action_restore()
+
+    @api.multi
+    def _remove_old_local_backups(self, folder_path):
+        self.ensure_one()
+        rec = self
+        dir = folder_path
+        artifact_obj = self.env['dailybackup.backup.artifact']
+        if not artifact_obj.search_count([('backup_id', '=', rec.id), ('location', '=', 'local')]):
+            rec._adopt_local_files(dir)
+
+        # Only the files of the current database are in the catalog of the record
+        # (Makes it possible to save different databases in the same folder)
+        if rec.retention_policy == 'gfs':
+            expired = rec._expired_artifacts('local')
+        else:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=rec.days_to_keep)
+            expired = artifact_obj.search([
+                ('backup_id', '=', rec.id),
+                ('location', '=', 'local'),
+                ('state', '=', 'present'),
+                ('backup_date', '<=', fields.Datetime.to_string(cutoff)),
+            ])
+        expired._delete_local_files()
+
+        chunks_path = os.path.join(dir, chunking.CHUNKS_DIRECTORY)
+        if os.path.isdir(chunks_path):
+            # The chunk store is shared by every database of the folder: the
+            # manifests are read once the backups of the others are written.
+            with chunking.ChunkStore(chunks_path).locked(exclusive=True) as store:
+                referenced = set()
                 for f in os.listdir(dir):
-                    fullpath = os.path.join(dir, f)
-                    # Only delete the ones wich are from the current database
-                    # (Makes it possible to save different databases in the same folder)
-                    if rec.name in fullpath:
-                        timestamp = os.stat(fullpath).st_ctime
-                        createtime = datetime.datetime.fromtimestamp(timestamp)
-                        now = datetime.datetime.now()
-                        delta = now - createtime
-                        if delta.days >= rec.days_to_keep:
-                            # Only delete files (which are .dump and .zip), no directories.
-                            if os.path.isfile(fullpath) and (".dump" in f or '.zip' in f):
-                                logger.info("Delete local out-of-date file: " + fullpath)
-                                os.remove(fullpath)
+                    if f.endswith('.' + chunking.MANIFEST_EXTENSION):
+                        referenced |= chunking.manifest_chunks(chunking.read_manifest(os.path.join(dir, f)))
+                removed = store.collect_garbage(referenced)
+            logger.info('Function: _remove_old_local_backups - removed chunks: %s' % removed)
+
+
+class SampleFull(Exception):
+    """Raised by LimitedWriter once the sample is complete."""
+
+
+class LimitedWriter(object):
+    """File object that stops the dump after ``limit`` bytes."""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.written = 0
+
+    def write(self, data):
+        data = data[:self.limit - self.written]
+        self.stream.write(data)
+        self.written += len(data)
+        if self.written >= self.limit:
+            raise SampleFull()
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class TimeoutTransport(xmlrpclib.Transport):
+    """XML-RPC transport giving up on a busy server instead of waiting forever."""
+
+    def __init__(self, timeout, *args, **kwargs):
+        xmlrpclib.Transport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = xmlrpclib.Transport.make_connection(self, host)
+        conn.timeout = self.timeout
+        return conn
 
 
 def execute(connector, method, *args):
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, _
+from odoo.exceptions import ValidationError
+
+import logging
+
+from ..lib import throttle
+
+logger = logging.getLogger(__name__)
+
+
+class BandwidthLimit(models.Model):
+    _name = 'dailybackup.bandwidth.limit'
+    _description = 'Upload bandwidth limit'
+    _rec_name = 'sftp_host'
+
+    sftp_host = fields.Char('SFTP Server', required=True,
+                            help='IP address or host name of the SFTP server, as filled in on the backups.')
+    rate_limit_kb = fields.Integer('Max. rate (KB/s)',
+                                   help='Total upload rate to this server, shared by all the backups. '
+                                        '0 does not limit the rate.')
+    burst_kb = fields.Integer('Burst (KB)',
+                              help='Amount that may be sent at once above the rate. Defaults to one second '
+                                   'of upload.')
+    upload_windows = fields.Char('Upload windows',
+                                 help='Comma separated time ranges (server time) in which uploads to this server '
+                                      'may run, for example "22:00-06:00, 12:00-13:30". Uploads waiting for a '
+                                      'window are postponed. Empty allows uploads at any time.')
+
+    _sql_constraints = [
+        ('sftp_host_unique', 'unique(sftp_host)', 'There is already a bandwidth limit for this SFTP server.'),
+    ]
+
+    @api.constrains('upload_windows')
+    def _check_upload_windows(self):
+        for limit in self:
+            try:
+                throttle.parse_windows(limit.upload_windows)
+            except ValueError as e:
+                raise ValidationError(_('Invalid upload windows: %s') % e)
+
+    @api.model
+    def _for_host(self, sftp_host):
+        return self.search([('sftp_host', '=', sftp_host)], limit=1)
+
+    @api.multi
+    def _throttle(self):
+        """Callable that blocks until the given number of bytes may be sent, None when not limited."""
+        if not self or self.rate_limit_kb <= 0:
+            return None
+        bucket = throttle.get_bucket(self.sftp_host, self.rate_limit_kb * 1024, (self.burst_kb or 0) * 1024)
+        return bucket.consume
+
+    @api.multi
+    def _seconds_until_window(self):
+        if not self:
+            return 0
+        return throttle.seconds_until_window(throttle.parse_windows(self.upload_windows))